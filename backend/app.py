@@ -1,29 +1,66 @@
 # -*- coding: utf-8 -*-
 from fastapi import FastAPI, Request, Form, status
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import HTTPException
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 import sqlite3
 import bcrypt
 from contextlib import contextmanager
 import os
 import re
+import csv
+import gzip
+import io
+import json
+import base64
+import hashlib
 import logging
+import socket
 import sys
+import tempfile
 import traceback
+import zlib
 from typing import Union
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
+import threading
+from collections import deque, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from starlette.datastructures import MutableHeaders
+from starlette.concurrency import run_in_threadpool
+import anyio
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_values
     POSTGRES_AVAILABLE = True
 except ImportError:
     POSTGRES_AVAILABLE = False
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 
 # =======================
 # CONFIGURACIÓN DE LOGGING
@@ -51,236 +88,254 @@ else:
     logger.info(f"Usando SQLite: {DB_PATH}")
 
 
-@contextmanager
-def get_db():
-    """Context manager para manejar conexiones a la base de datos (PostgreSQL o SQLite)."""
-    if USE_POSTGRES:
-        # PostgreSQL en producción
-        max_retries = 3
-        retry_delay = 0.5
-        conn = None
-        
-        for attempt in range(max_retries):
+class PoolTimeoutError(Exception):
+    """No se obtuvo una conexión del pool dentro del tiempo de espera."""
+
+
+class ConnectionPool:
+    """Pool de conexiones reutilizables para PostgreSQL o SQLite.
+
+    - min_size: conexiones que se mantienen abiertas aunque estén ociosas
+    - max_size: máximo de conexiones abiertas (prestadas + ociosas)
+    - idle_timeout: segundos tras los cuales se cierra una conexión ociosa sobrante
+    - acquire_timeout: segundos máximos de espera cuando el pool está lleno
+    Cada conexión se verifica con SELECT 1 antes de prestarse.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300.0, acquire_timeout=10.0):
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()  # (conn, último uso)
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._counters = {
+            "created": 0,
+            "closed": 0,
+            "borrowed": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+        }
+
+    def fill(self):
+        """Abre conexiones hasta alcanzar min_size."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        """Presta una conexión sana; abre una nueva si hay cupo o espera a que se libere."""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            conn = None
+            with self._cond:
+                expired = self._reap_idle()
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("El pool de conexiones está cerrado")
+                    if self._idle:
+                        conn, _ = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"Sin conexiones disponibles tras {self.acquire_timeout}s (max_size={self.max_size})"
+                        )
+                    self._counters["waits"] += 1
+                    self._cond.wait(remaining)
+            for old in expired:
+                self._close(old)
+
+            if conn is None:
+                conn = self._open()
+            elif not self._is_healthy(conn):
+                self._counters["health_check_failures"] += 1
+                logger.warning("Conexión del pool descartada: falló el health-check")
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._counters["borrowed"] += 1
+            return conn
+
+    def release(self, conn, broken=False):
+        """Devuelve una conexión al pool, descartándola si quedó inutilizable."""
+        if not broken:
             try:
-                conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-                conn.set_session(autocommit=False)
-                break
-            except Exception as e:
-                logger.error(f"Error al conectar a PostgreSQL (intento {attempt + 1}/{max_retries}): {e}")
-                if conn:
-                    conn.close()
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    logger.critical("No se pudo establecer conexión con PostgreSQL")
-                    raise
-        
+                conn.rollback()  # nunca devolver una transacción abierta
+            except Exception:
+                broken = True
+        if broken or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """Cierra todas las conexiones ociosas y rechaza nuevos préstamos."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Estadísticas del pool para monitoreo."""
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._counters,
+            }
+
+    def _open(self):
         try:
-            yield conn
-        except Exception as e:
-            logger.error(f"Error durante operación de DB: {e}")
-            if conn:
-                conn.rollback()
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
             raise
-        finally:
-            if conn:
-                conn.close()
-    else:
-        # SQLite en desarrollo
-        max_retries = 3
-        retry_delay = 0.5
-        conn = None
-        
-        for attempt in range(max_retries):
-            try:
-                conn = sqlite3.connect(DB_PATH, timeout=10.0)
-                conn.row_factory = sqlite3.Row
-                conn.execute("PRAGMA encoding = 'UTF-8'")
-                conn.execute("SELECT 1")
-                break
-            except sqlite3.Error as e:
-                logger.error(f"Error al conectar a SQLite (intento {attempt + 1}/{max_retries}): {e}")
-                if conn:
-                    conn.close()
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    logger.critical("No se pudo establecer conexión con la base de datos")
-                    raise
-        
+        with self._cond:
+            self._counters["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._counters["closed"] += 1
+
+    def _reap_idle(self):
+        """Saca del pool las conexiones ociosas vencidas por encima de min_size (con el lock tomado)."""
+        expired = []
+        now = time.monotonic()
+        # Las más antiguas están al inicio del deque
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            expired.append(conn)
+        return expired
+
+    @staticmethod
+    def _is_healthy(conn):
+        if getattr(conn, "closed", 0):
+            return False
         try:
-            yield conn
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+
+def _connect_postgres():
+    """Abre una conexión a PostgreSQL con reintentos."""
+    max_retries = 3
+    retry_delay = 0.5
+    conn = None
+
+    for attempt in range(max_retries):
+        try:
+            conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+            conn.set_session(autocommit=False)
+            return conn
         except Exception as e:
-            logger.error(f"Error durante operación de DB: {e}")
-            if conn:
-                conn.rollback()
-            raise
-        finally:
+            logger.error(f"Error al conectar a PostgreSQL (intento {attempt + 1}/{max_retries}): {e}")
             if conn:
                 conn.close()
+                conn = None
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay)
+                retry_delay *= 2
+            else:
+                logger.critical("No se pudo establecer conexión con PostgreSQL")
+                raise
 
 
-def init_db():
-    """Inicializa la base de datos con todas las tablas necesarias."""
-    try:
-        logger.info(f"Inicializando base de datos... USE_POSTGRES={USE_POSTGRES}")
-        with get_db() as conn:
-            cursor = conn.cursor()
-            logger.info("✅ Conexión a DB exitosa")
-            
-            if USE_POSTGRES:
-                logger.info("Creando tablas PostgreSQL...")
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        email TEXT UNIQUE NOT NULL,
-                        username TEXT UNIQUE NOT NULL,
-                        birthdate TEXT NOT NULL,
-                        password_hash TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                logger.info("✅ Tabla users creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS obras (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        ubicacion TEXT,
-                        estado TEXT DEFAULT 'activa',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla obras creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS clientes (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        cedula TEXT,
-                        obra TEXT,
-                        estado TEXT DEFAULT 'activo',
-                        fecha TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla clientes creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS productos (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        precio REAL NOT NULL DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla productos creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS registros (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        fecha TEXT,
-                        obra TEXT,
-                        totalCantidad INTEGER DEFAULT 0,
-                        totalCobrar REAL DEFAULT 0,
-                        totalPagado REAL DEFAULT 0,
-                        status TEXT DEFAULT 'pendiente',
-                        clientesAdicionales TEXT,
-                        detalles TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla registros creada")
+def _connect_sqlite():
+    """Abre una conexión a SQLite con reintentos."""
+    max_retries = 3
+    retry_delay = 0.5
+    conn = None
+
+    for attempt in range(max_retries):
+        try:
+            # check_same_thread=False: la conexión pasa de un hilo a otro a través del pool
+            conn = sqlite3.connect(DB_PATH, timeout=10.0, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA encoding = 'UTF-8'")
+            conn.execute("SELECT 1")
+            return conn
+        except sqlite3.Error as e:
+            logger.error(f"Error al conectar a SQLite (intento {attempt + 1}/{max_retries}): {e}")
+            if conn:
+                conn.close()
+                conn = None
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay)
+                retry_delay *= 2
             else:
-                logger.info("Creando tablas SQLite...")
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        email TEXT UNIQUE NOT NULL,
-                        username TEXT UNIQUE NOT NULL,
-                        birthdate TEXT NOT NULL,
-                        password_hash TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                logger.info("✅ Tabla users creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS obras (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        ubicacion TEXT,
-                        estado TEXT DEFAULT 'activa',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla obras creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS clientes (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        cedula TEXT,
-                        obra TEXT,
-                        estado TEXT DEFAULT 'activo',
-                        fecha TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla clientes creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS productos (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        nombre TEXT NOT NULL,
-                        precio REAL NOT NULL DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla productos creada")
-                
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS registros (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        fecha TEXT,
-                        obra TEXT,
-                        totalCantidad INTEGER DEFAULT 0,
-                        totalCobrar REAL DEFAULT 0,
-                        totalPagado REAL DEFAULT 0,
-                        status TEXT DEFAULT 'pendiente',
-                        clientesAdicionales TEXT,
-                        detalles TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-                    )
-                """)
-                logger.info("✅ Tabla registros creada")
-            
-            conn.commit()
-            logger.info("✅ Commit realizado")
-        logger.info("✅✅✅ Base de datos inicializada CORRECTAMENTE")
-    except Exception as e:
-        logger.error(f"❌❌❌ CRÍTICO: No se pudo inicializar DB: {e}")
-        logger.error(traceback.format_exc())
+                logger.critical("No se pudo establecer conexión con la base de datos")
+                raise
 
 
-# Inicializar DB al arrancar
-init_db()
+db_pool = ConnectionPool(
+    _connect_postgres if USE_POSTGRES else _connect_sqlite,
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+    idle_timeout=float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300")),
+    acquire_timeout=float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10")),
+)
+
+
+@contextmanager
+def get_db():
+    """Context manager que presta una conexión del pool (PostgreSQL o SQLite)."""
+    conn = db_pool.acquire()
+    broken = False
+    try:
+        yield conn
+    except Exception as e:
+        logger.error(f"Error durante operación de DB: {e}")
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        db_pool.release(conn, broken=broken or bool(getattr(conn, "closed", 0)))
 
 
 def get_last_insert_id(cursor):
@@ -302,6 +357,705 @@ def sql(query, params=None):
     return (query, params) if params else (query,)
 
 
+# =======================
+# CACHÉ DE USUARIOS
+# =======================
+class UserIdCache:
+    """Caché en proceso username -> user_id con TTL y desalojo LRU.
+
+    Solo guarda usuarios existentes. Si hay REDIS_URL (y el paquete redis está
+    instalado) las invalidaciones se publican en un canal para que los demás
+    workers descarten también su copia.
+    """
+
+    CHANNEL = "fintrack:user-cache:invalidate"
+
+    def __init__(self, max_size=1024, ttl=300.0, redis_url=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> (user_id, vence)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self._redis = None
+        if redis_url and REDIS_AVAILABLE:
+            self._connect_redis(redis_url)
+        elif redis_url:
+            logger.warning("REDIS_URL definido pero el paquete redis no está instalado; caché solo local")
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(username)
+                self._counters["hits"] += 1
+                return entry[0]
+            if entry:
+                del self._entries[username]
+            self._counters["misses"] += 1
+            return None
+
+    def set(self, username, user_id):
+        with self._lock:
+            self._entries[username] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def invalidate(self, *usernames):
+        """Descarta usernames en este proceso y, si hay Redis, en los demás workers."""
+        self._drop(usernames)
+        if self._redis is not None:
+            for username in usernames:
+                try:
+                    self._redis.publish(self.CHANNEL, username)
+                except Exception as e:
+                    logger.error(f"No se pudo publicar invalidación de caché: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "shared": self._redis is not None,
+                **self._counters,
+            }
+
+    def _drop(self, usernames):
+        with self._lock:
+            for username in usernames:
+                if self._entries.pop(username, None) is not None:
+                    self._counters["invalidations"] += 1
+
+    def _connect_redis(self, url):
+        try:
+            self._redis = redis.Redis.from_url(url)
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.CHANNEL: self._on_message})
+            pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+            logger.info("Caché de usuarios compartida vía Redis")
+        except Exception as e:
+            logger.error(f"No se pudo conectar a Redis, caché solo local: {e}")
+            self._redis = None
+
+    def _on_message(self, message):
+        data = message.get("data")
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        if data:
+            self._drop((data,))
+
+
+user_id_cache = UserIdCache(
+    max_size=int(os.getenv("USER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "300")),
+    redis_url=os.getenv("REDIS_URL"),
+)
+
+
+def get_user_id(conn, username):
+    """Devuelve el id del usuario (None si no existe), consultando primero la caché."""
+    user_id = user_id_cache.get(username)
+    if user_id is not None:
+        return user_id
+    cursor = conn.cursor()
+    cursor.execute(*sql("SELECT id FROM users WHERE username = ?", (username,)))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    user_id = row["id"]
+    user_id_cache.set(username, user_id)
+    return user_id
+
+
+# =======================
+# ITEMS DE REGISTROS
+# =======================
+# registro_items guarda una fila por producto de cada registro (o por item
+# plano en los respaldos importados), derivada de `detalles` en la misma
+# transacción que el registro. detalles sigue siendo el documento que se
+# devuelve al frontend; registro_items sirve para filtrar y agregar por
+# producto, cliente o tipo sin decodificar JSON.
+
+def _num(value):
+    """Convierte a número un total recibido del cliente (None o inválido = 0)."""
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _text(value):
+    """Texto limpio o None."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _registro_items(detalles):
+    """Aplana detalles en filas (posicion, tipo, cliente, producto, cantidad, precio, costo).
+
+    Acepta los dos formatos en uso:
+    - dashboard: {clienteNombre, productos: [{nombre, cantidad, precio}], ...}
+    - respaldos: {tipo, cliente, producto, cantidad, precio, costo}
+    """
+    if isinstance(detalles, (str, bytes)):
+        try:
+            detalles = json.loads(detalles)
+        except ValueError:
+            return []
+    if not isinstance(detalles, list):
+        return []
+
+    rows = []
+    for item in detalles:
+        if not isinstance(item, dict):
+            continue
+        tipo = _text(item.get("tipo"))
+        tipo = tipo.lower() if tipo else None
+        cliente = _text(item.get("cliente") or item.get("clienteNombre"))
+        costo = _num(item["costo"]) if item.get("costo") is not None else None
+        productos = item.get("productos")
+        if isinstance(productos, list):
+            for producto in productos:
+                if not isinstance(producto, dict):
+                    continue
+                rows.append((
+                    len(rows), tipo, cliente,
+                    _text(producto.get("nombre") or producto.get("producto")),
+                    _num(producto.get("cantidad")), _num(producto.get("precio")), costo
+                ))
+        else:
+            rows.append((
+                len(rows), tipo, cliente,
+                _text(item.get("producto") or item.get("nombre")),
+                _num(item.get("cantidad")), _num(item.get("precio")), costo
+            ))
+    return rows
+
+
+def _insert_registro_items(cursor, registro_id, user_id, detalles):
+    """Inserta los items de un registro (sin borrar los anteriores)."""
+    rows = _registro_items(detalles)
+    if rows:
+        cursor.executemany(
+            sql("""INSERT INTO registro_items
+                   (registro_id, user_id, posicion, tipo, cliente, producto, cantidad, precio, costo)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""")[0],
+            [(registro_id, user_id) + row for row in rows]
+        )
+    return len(rows)
+
+
+def _replace_registro_items(cursor, registro_id, user_id, detalles):
+    """Reemplaza los items de un registro por los derivados de detalles."""
+    cursor.execute(*sql("DELETE FROM registro_items WHERE registro_id = ?", (registro_id,)))
+    return _insert_registro_items(cursor, registro_id, user_id, detalles)
+
+
+# =======================
+# NORMALIZACIÓN Y HASH DE CONTENIDO
+# =======================
+# Los normalizadores validan una fila recibida (respaldo o formulario) y la
+# llevan a los valores que se guardan; lanzan ValueError con el motivo.
+# El hash de contenido identifica una fila por sus datos normalizados: las
+# importaciones omiten las filas cuyo hash ya existe para el usuario.
+
+def _required_text(record, field):
+    value = _text(record.get(field))
+    if value is None:
+        raise ValueError(f"{field} vacío")
+    return value
+
+
+def _number(record, field, default=0.0):
+    value = record.get(field)
+    if value is None or value == "":
+        return default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} no es numérico: {value!r}")
+    if number != number or number in (float("inf"), float("-inf")):
+        raise ValueError(f"{field} no es numérico: {value!r}")
+    return number
+
+
+def _normalize_cliente(c):
+    return (_required_text(c, "nombre"), _text(c.get("cedula")), _text(c.get("obra")),
+            _text(c.get("estado")) or "activo", _text(c.get("fecha")))
+
+
+def _normalize_obra(o):
+    return (_required_text(o, "nombre"), _text(o.get("ubicacion")), _text(o.get("estado")) or "activa")
+
+
+def _normalize_producto(p):
+    return (_required_text(p, "nombre"), _number(p, "precio"))
+
+
+def _normalize_registro(r):
+    detalles = r.get("items") or r.get("detalles") or []
+    if isinstance(detalles, str):
+        try:
+            detalles = json.loads(detalles)
+        except ValueError:
+            raise ValueError("detalles no es JSON válido")
+    if not isinstance(detalles, list):
+        raise ValueError("detalles debe ser una lista")
+    
+    adicionales = []
+    for it in detalles:
+        if isinstance(it, dict) and str(it.get("tipo", "")).lower() == "adicional":
+            adicionales.append({"cliente": it.get("cliente"), "valor": it.get("costo", it.get("precio", 0))})
+    
+    fecha = r.get("fecha") or r.get("dia") or r.get("fechaRegistro")
+    return {
+        "fecha": _text(fecha),
+        "obra": _text(r.get("obra")),
+        "totalCantidad": int(_number(r, "totalCantidad")),
+        "totalCobrar": _number(r, "totalCobrar"),
+        "totalPagado": _number(r, "totalPagado"),
+        "status": _text(r.get("status")) or "pendiente",
+        "clientesAdicionales": json.dumps(adicionales) if adicionales else None,
+        # Lista vacía se guarda como NULL, igual que en create_registro
+        "detalles": json.dumps(detalles) if detalles else None,
+        "items": detalles,
+    }
+
+
+NORMALIZERS = {
+    "clientes": _normalize_cliente,
+    "obras": _normalize_obra,
+    "productos": _normalize_producto,
+    "registros": _normalize_registro,
+}
+
+
+def _record_hash(entidad, record):
+    """Hash de contenido de una fila sin normalizar; None si la fila no es válida."""
+    try:
+        return _content_hash(entidad, NORMALIZERS[entidad](record))
+    except ValueError:
+        return None
+
+
+def _content_hash(entidad, values):
+    """sha256 del contenido normalizado de una fila (tupla, o dict para registros)."""
+    if entidad == "registros":
+        values = [values[k] for k in ("fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status", "items")]
+    payload = json.dumps([entidad, list(values)], sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# =======================
+# MIGRACIONES DE ESQUEMA
+# =======================
+def _migrate_json_columns(cursor):
+    """Convierte registros.detalles y clientesAdicionales a JSON nativo.
+
+    PostgreSQL: columnas JSONB (los valores inválidos quedan en NULL).
+    SQLite: TEXT con CHECK json_valid(); requiere reconstruir la tabla.
+    """
+    if USE_POSTGRES:
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION pg_temp.fintrack_try_jsonb(value TEXT) RETURNS JSONB AS $$
+            BEGIN
+                RETURN NULLIF(value, '')::jsonb;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        for column in ("detalles", "clientesAdicionales"):
+            cursor.execute(
+                f"ALTER TABLE registros ALTER COLUMN {column} TYPE JSONB USING pg_temp.fintrack_try_jsonb({column})"
+            )
+        return
+
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'registros'")
+    row = cursor.fetchone()
+    last_id = row["seq"] if row else 0
+    cursor.execute("""
+        CREATE TABLE registros_json (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            fecha TEXT,
+            obra TEXT,
+            totalCantidad INTEGER DEFAULT 0,
+            totalCobrar REAL DEFAULT 0,
+            totalPagado REAL DEFAULT 0,
+            status TEXT DEFAULT 'pendiente',
+            clientesAdicionales TEXT CHECK (clientesAdicionales IS NULL OR json_valid(clientesAdicionales)),
+            detalles TEXT CHECK (detalles IS NULL OR json_valid(detalles)),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO registros_json
+            (id, user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, clientesAdicionales, detalles, created_at)
+        SELECT id, user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status,
+               CASE WHEN json_valid(clientesAdicionales) THEN json(clientesAdicionales) END,
+               CASE WHEN json_valid(detalles) THEN json(detalles) END,
+               created_at
+        FROM registros
+    """)
+    cursor.execute("DROP TABLE registros")
+    cursor.execute("ALTER TABLE registros_json RENAME TO registros")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_registros_user_fecha ON registros (user_id, fecha, created_at)")
+    # Conservar el contador AUTOINCREMENT para no reutilizar ids borrados
+    cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'registros'", (last_id,))
+
+
+def _backfill_registro_items(cursor):
+    """Llena registro_items a partir de los detalles ya guardados."""
+    cursor.execute("SELECT id, user_id, detalles FROM registros WHERE detalles IS NOT NULL")
+    for registro in cursor.fetchall():
+        _insert_registro_items(cursor, registro["id"], registro["user_id"], registro["detalles"])
+
+
+def _backfill_content_hash(cursor):
+    """Agrega content_hash a las tablas importables y lo calcula para las filas existentes.
+
+    Si hay filas repetidas, solo la más antigua recibe el hash (las demás
+    quedan en NULL hasta que se deduplique).
+    """
+    for table in NORMALIZERS:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN content_hash TEXT")
+        _assign_content_hashes(cursor, table)
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_user_hash ON {table} (user_id, content_hash)")
+
+
+def _assign_content_hashes(cursor, table):
+    """Calcula content_hash para todas las filas de la tabla (la más antigua de cada contenido)."""
+    cursor.execute(f"SELECT * FROM {table} ORDER BY id")
+    seen = set()
+    updates = []
+    for row in cursor.fetchall():
+        digest = _record_hash(table, dict(row))
+        if digest is None or (row["user_id"], digest) in seen:
+            continue
+        seen.add((row["user_id"], digest))
+        updates.append((digest, row["id"]))
+    cursor.executemany(sql(f"UPDATE {table} SET content_hash = ? WHERE id = ?")[0], updates)
+
+
+def _rehash_content(cursor):
+    """Recalcula content_hash de todas las filas con los normalizadores actuales.
+
+    Los números faltantes se normalizaban como 0 en lugar de 0.0, así que
+    esas filas tenían un hash distinto al de la misma fila reimportada.
+    """
+    for table in NORMALIZERS:
+        cursor.execute(f"UPDATE {table} SET content_hash = NULL")
+        _assign_content_hashes(cursor, table)
+
+
+def _hash_every_row(cursor):
+    """Guarda content_hash en todas las filas, también en las copias repetidas.
+
+    El índice (user_id, content_hash) deja de ser único: así la importación
+    cuenta las copias que ya tiene el usuario con una consulta por índice.
+    """
+    for table in NORMALIZERS:
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table}_user_hash")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_hash ON {table} (user_id, content_hash)")
+        cursor.execute(f"SELECT * FROM {table} WHERE content_hash IS NULL")
+        updates = []
+        for row in cursor.fetchall():
+            digest = _record_hash(table, dict(row))
+            if digest is not None:
+                updates.append((digest, row["id"]))
+        if updates:
+            cursor.executemany(sql(f"UPDATE {table} SET content_hash = ? WHERE id = ?")[0], updates)
+
+
+def _add_sync_columns(cursor):
+    """Agrega version y updated_at a las tablas sincronizables.
+
+    Las filas existentes reciben una versión nueva de su usuario (así since=0
+    las incluye) y updated_at = created_at.
+    """
+    cursor.execute("UPDATE users SET data_version = data_version + 1")
+    for table in NORMALIZERS:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP")
+        cursor.execute(
+            f"""UPDATE {table} SET updated_at = created_at,
+                       version = (SELECT data_version FROM users WHERE users.id = {table}.user_id)"""
+        )
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_version ON {table} (user_id, version, id)")
+
+
+# Cada migración es (versión, descripción, pasos). Un paso es una sentencia
+# SQL, que puede usar {pk} para la clave primaria autoincremental (cambia
+# según el motor), o una función que recibe el cursor.
+# Las versiones aplicadas se registran en la tabla schema_migrations.
+# Nunca modificar una migración ya publicada: agregar una nueva al final.
+MIGRATIONS = [
+    (1, "Tablas base", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id {pk},
+            email TEXT UNIQUE NOT NULL,
+            username TEXT UNIQUE NOT NULL,
+            birthdate TEXT NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS obras (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            ubicacion TEXT,
+            estado TEXT DEFAULT 'activa',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS clientes (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            cedula TEXT,
+            obra TEXT,
+            estado TEXT DEFAULT 'activo',
+            fecha TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS productos (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            precio REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS registros (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            fecha TEXT,
+            obra TEXT,
+            totalCantidad INTEGER DEFAULT 0,
+            totalCobrar REAL DEFAULT 0,
+            totalPagado REAL DEFAULT 0,
+            status TEXT DEFAULT 'pendiente',
+            clientesAdicionales TEXT,
+            detalles TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (2, "Índices por usuario", [
+        "CREATE INDEX IF NOT EXISTS idx_registros_user_fecha ON registros (user_id, fecha, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_clientes_user_created ON clientes (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_obras_user_created ON obras (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_productos_user_created ON productos (user_id, created_at)",
+    ]),
+    (3, "Resumen de registros por usuario, obra y fecha", [
+        """
+        CREATE TABLE IF NOT EXISTS registros_resumen (
+            user_id INTEGER NOT NULL,
+            obra TEXT NOT NULL DEFAULT '',
+            fecha TEXT NOT NULL DEFAULT '',
+            totalCobrar REAL NOT NULL DEFAULT 0,
+            totalPagado REAL NOT NULL DEFAULT 0,
+            totalCantidad INTEGER NOT NULL DEFAULT 0,
+            registros INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, obra, fecha),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        INSERT INTO registros_resumen (user_id, obra, fecha, totalCobrar, totalPagado, totalCantidad, registros)
+        SELECT user_id, COALESCE(obra, ''), COALESCE(fecha, ''),
+               SUM(COALESCE(totalCobrar, 0)), SUM(COALESCE(totalPagado, 0)), SUM(COALESCE(totalCantidad, 0)), COUNT(*)
+        FROM registros
+        GROUP BY user_id, COALESCE(obra, ''), COALESCE(fecha, '')
+        """,
+    ]),
+    (4, "detalles y clientesAdicionales como JSON nativo", [
+        _migrate_json_columns,
+    ]),
+    (5, "Items de registros normalizados", [
+        """
+        CREATE TABLE IF NOT EXISTS registro_items (
+            id {pk},
+            registro_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            posicion INTEGER NOT NULL DEFAULT 0,
+            tipo TEXT,
+            cliente TEXT,
+            producto TEXT,
+            cantidad REAL NOT NULL DEFAULT 0,
+            precio REAL NOT NULL DEFAULT 0,
+            costo REAL,
+            FOREIGN KEY (registro_id) REFERENCES registros(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_registro_items_registro ON registro_items (registro_id)",
+        "CREATE INDEX IF NOT EXISTS idx_registro_items_user_producto ON registro_items (user_id, producto)",
+        "CREATE INDEX IF NOT EXISTS idx_registro_items_user_cliente ON registro_items (user_id, cliente)",
+        "CREATE INDEX IF NOT EXISTS idx_registro_items_user_tipo ON registro_items (user_id, tipo)",
+        _backfill_registro_items,
+    ]),
+    (6, "Hash de contenido para importaciones idempotentes", [
+        _backfill_content_hash,
+    ]),
+    (7, "Trabajos en segundo plano", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            parametros TEXT,
+            progreso TEXT,
+            resultado TEXT,
+            archivo TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_estado ON jobs (estado)",
+    ]),
+    (8, "Versión de datos por usuario", [
+        "ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (9, "Versión de datos por usuario y entidad", [
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            user_id INTEGER NOT NULL,
+            entidad TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, entidad),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (10, "Sincronización incremental: version, updated_at y eliminaciones", [
+        "ALTER TABLE users ADD COLUMN sync_floor INTEGER NOT NULL DEFAULT 0",
+        _add_sync_columns,
+        """
+        CREATE TABLE IF NOT EXISTS tombstones (
+            id {pk},
+            user_id INTEGER NOT NULL,
+            entidad TEXT NOT NULL,
+            entidad_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_tombstones_user_version ON tombstones (user_id, version, id)",
+        "CREATE INDEX IF NOT EXISTS idx_tombstones_deleted ON tombstones (deleted_at)",
+    ]),
+    (11, "Recalcular content_hash (números faltantes como 0.0)", [_rehash_content]),
+    (12, "content_hash en todas las filas (índice no único)", [_hash_every_row]),
+    (13, "Proceso dueño de cada trabajo", [
+        "ALTER TABLE jobs ADD COLUMN owner TEXT",
+    ]),
+]
+
+# Identificador del advisory lock de PostgreSQL que serializa las migraciones
+# cuando arrancan varios workers a la vez.
+MIGRATIONS_LOCK_ID = 727001
+
+
+def run_migrations(conn):
+    """Aplica en orden las migraciones pendientes. Devuelve las versiones aplicadas."""
+    ddl = {"pk": "SERIAL PRIMARY KEY" if USE_POSTGRES else "INTEGER PRIMARY KEY AUTOINCREMENT"}
+    cursor = conn.cursor()
+    if USE_POSTGRES:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row["version"] for row in cursor.fetchall()}
+
+        newly_applied = []
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Aplicando migración {version}: {description}")
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement.format(**ddl))
+                cursor.execute(*sql(
+                    "INSERT INTO schema_migrations (version, description) VALUES (?, ?)",
+                    (version, description)
+                ))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.error(f"❌ Falló la migración {version}: {description}")
+                raise
+            newly_applied.append(version)
+            logger.info(f"✅ Migración {version} aplicada")
+        return newly_applied
+    finally:
+        if USE_POSTGRES:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+            conn.commit()
+
+
+def init_db():
+    """Inicializa la base de datos aplicando las migraciones pendientes."""
+    try:
+        logger.info(f"Inicializando base de datos... USE_POSTGRES={USE_POSTGRES}")
+        with get_db() as conn:
+            logger.info("✅ Conexión a DB exitosa")
+            applied = run_migrations(conn)
+            if applied:
+                logger.info(f"✅ Migraciones aplicadas: {applied}")
+            else:
+                logger.info("✅ Esquema al día, sin migraciones pendientes")
+        logger.info("✅✅✅ Base de datos inicializada CORRECTAMENTE")
+    except Exception as e:
+        logger.error(f"❌❌❌ CRÍTICO: No se pudo inicializar DB: {e}")
+        logger.error(traceback.format_exc())
+
+
+# Inicializar DB al arrancar
+init_db()
+
+try:
+    db_pool.fill()
+except Exception as e:
+    logger.error(f"No se pudo precargar el pool de conexiones: {e}")
+
+
 def ensure_demo_user():
     """Crea un usuario de prueba si no existe para facilitar el acceso.
 
@@ -346,10 +1100,6 @@ ensure_demo_user()
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 if os.path.exists(frontend_path):
     app.mount("/frontend", StaticFiles(directory=frontend_path), name="frontend")
-    # Montar la carpeta assets directamente para que sea accesible desde /assets
-    assets_path = os.path.join(frontend_path, "assets")
-    if os.path.exists(assets_path):
-        app.mount("/assets", StaticFiles(directory=assets_path), name="assets")
     # Montar archivos JS directamente
     app.mount("/api.js", StaticFiles(directory=frontend_path, html=True), name="static_js")
 
@@ -357,50 +1107,143 @@ if os.path.exists(frontend_path):
 templates = Jinja2Templates(directory="templates")
 
 # =======================
-# MIDDLEWARE DE ERROR HANDLING GLOBAL
+# MIDDLEWARE (ASGI PURO)
 # =======================
-@app.middleware("http")
-async def error_handling_middleware(request: Request, call_next):
-    """Middleware que captura todas las excepciones no manejadas."""
-    try:
-        return await call_next(request)
-    except Exception as exc:
-        logger.error(f"Error no manejado en {request.method} {request.url.path}: {exc}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content={"message": "Error interno del servidor. El error ha sido registrado."},
-        )
+# Un solo middleware ASGI hace lo que antes hacían error_handling_middleware
+# y UTF8Middleware (ambos sobre BaseHTTPMiddleware): ajusta las cabeceras en
+# http.response.start, sin agregar tareas ni copiar el cuerpo.
+# También comprime con gzip las respuestas de texto (JSON, CSV, NDJSON) a
+# partir de COMPRESS_MIN_BYTES; las de streaming se comprimen bloque a bloque.
+# Lo que ya trae Content-Encoding (archivos estáticos precomprimidos) pasa tal cual.
 
-# Middleware para UTF-8 y anti-caché
-class UTF8Middleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        
-        # Forzar UTF-8 en todas las respuestas de texto
-        if 'content-type' in response.headers:
-            content_type = response.headers['content-type']
-            # JSON
-            if 'application/json' in content_type and 'charset' not in content_type:
-                response.headers['content-type'] = 'application/json; charset=utf-8'
-            # HTML
-            elif 'text/html' in content_type and 'charset' not in content_type:
-                response.headers['content-type'] = 'text/html; charset=utf-8'
-            # JavaScript
-            elif 'javascript' in content_type and 'charset' not in content_type:
-                response.headers['content-type'] = content_type + '; charset=utf-8'
-        
-        # Agregar cabeceras anti-caché para archivos HTML, CSS, JS e imágenes
-        if any(request.url.path.endswith(ext) for ext in ['.html', '.css', '.js', '.png', '.jpg', '.svg', '.jpeg']) or request.url.path == '/':
-            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-            response.headers['Pragma'] = 'no-cache'
-            response.headers['Expires'] = '0'
-        
-        return response
+# Tipos de contenido de texto a los que se agrega charset=utf-8 si no lo traen
+CHARSET_TYPES = (b"application/json", b"text/html", b"javascript")
+# Archivos del frontend que el navegador debe revalidar antes de usar su copia
+# (si la respuesta no fijó su propio Cache-Control)
+NO_CACHE_SUFFIXES = ('.html', '.css', '.js', '.png', '.jpg', '.svg', '.jpeg')
+NO_CACHE_HEADERS = (("Cache-Control", "no-cache"),)
+# Compresión de respuestas dinámicas
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "application/x-ndjson")
 
-app.add_middleware(UTF8Middleware)
 
-# CORS para permitir peticiones desde el frontend (archivo local o localhost)
+@lru_cache(maxsize=1024)
+def _cache_headers_for(path):
+    """Cabeceras de caché por defecto para una ruta (la regla se calcula una vez por ruta)."""
+    if path == '/' or path.endswith(NO_CACHE_SUFFIXES):
+        return NO_CACHE_HEADERS
+    return ()
+
+
+def _fix_charset(headers):
+    """Agrega charset=utf-8 al content-type de texto que no lo declara."""
+    content_type = headers.get("content-type")
+    if not content_type or "charset" in content_type:
+        return
+    raw = content_type.encode("latin-1")
+    if any(t in raw for t in CHARSET_TYPES):
+        headers["content-type"] = content_type + "; charset=utf-8"
+
+
+def _accepts_gzip(scope):
+    for name, value in scope["headers"]:
+        if name == b"accept-encoding":
+            return b"gzip" in value
+    return False
+
+
+def _should_compress(message, headers):
+    """La respuesta es texto, no viene comprimida y no se sabe chica de antemano."""
+    if message["status"] < 200 or message["status"] in (204, 206, 304):
+        return False
+    if "content-encoding" in headers:
+        return False
+    if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+        return False
+    length = headers.get("content-length")
+    return length is None or int(length) >= COMPRESS_MIN_BYTES
+
+
+class AppMiddleware:
+    """Middleware ASGI: charset UTF-8, cabeceras anti-caché, gzip y captura de errores no manejados."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        cache_headers = _cache_headers_for(scope["path"])
+        accepts_gzip = _accepts_gzip(scope)
+        response_started = False
+        # http.response.start retenido hasta ver el primer bloque del cuerpo
+        pending_start = None
+        compressor = None
+
+        async def send_wrapper(message):
+            nonlocal response_started, pending_start, compressor
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                _fix_charset(headers)
+                if cache_headers and "cache-control" not in headers:
+                    for name, value in cache_headers:
+                        headers[name] = value
+                if accepts_gzip and _should_compress(message, headers):
+                    pending_start = message
+                    return
+                response_started = True
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if pending_start is not None:
+                    start, pending_start = pending_start, None
+                    if more_body or len(body) >= COMPRESS_MIN_BYTES:
+                        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+                        headers = MutableHeaders(scope=start)
+                        headers["Content-Encoding"] = "gzip"
+                        headers.add_vary_header("Accept-Encoding")
+                        etag = headers.get("etag")
+                        if etag and not etag.startswith("W/"):
+                            headers["ETag"] = "W/" + etag
+                        if "content-length" in headers:
+                            del headers["content-length"]
+                    if compressor is not None:
+                        body = compressor.compress(body)
+                        if not more_body:
+                            body += compressor.flush()
+                            headers["Content-Length"] = str(len(body))
+                        message["body"] = body
+                    response_started = True
+                    await send(start)
+                elif compressor is not None:
+                    body = compressor.compress(body)
+                    if not more_body:
+                        body += compressor.flush()
+                    message["body"] = body
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exc:
+            logger.error(f"Error no manejado en {scope['method']} {scope['path']}: {exc}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            if response_started:
+                # Ya se enviaron las cabeceras: solo queda cortar la respuesta
+                raise
+            pending_start = compressor = None
+            response = JSONResponse(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                content={"message": "Error interno del servidor. El error ha sido registrado."},
+            )
+            await response(scope, receive, send_wrapper)
+
+
+app.add_middleware(AppMiddleware)
+
+# CORS para permitir peticiones desde el frontend (archivo local o localhost)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # en producción, especifica orígenes permitidos
@@ -410,88 +1253,264 @@ app.add_middleware(
 )
 
 
+# =======================
+# ARCHIVOS ESTÁTICOS
+# =======================
+# Las páginas y scripts del frontend se sirven desde memoria con sus variantes
+# gzip/brotli calculadas una sola vez, ETag fuerte y 304 con If-None-Match.
+# Las referencias a assets/ y api.js dentro del HTML se reescriben con
+# ?v=<hash del contenido>: esas URLs no cambian mientras el archivo no cambie,
+# así que se sirven con caché inmutable de un año. El HTML se revalida siempre
+# (no-cache), lo que cuesta un 304 sin cuerpo si no cambió.
+
+STATIC_COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json", ".txt"}
+STATIC_MIN_COMPRESS_BYTES = 512
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+STATIC_REVALIDATE = "no-cache"
+# El charset de los tipos de texto lo agregan Response y AppMiddleware
+STATIC_MEDIA_TYPES = {
+    ".html": "text/html",
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".txt": "text/plain",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".pdf": "application/pdf",
+}
+# src="assets/..." / href="/assets/..." / src="api.js", con o sin ?v= previo
+FINGERPRINT_RE = re.compile(
+    r"""((?:src|href)=["'])(/?)(assets/[^"'?#$]+|api\.js)(?:\?v=[^"'#]*)?(["'])"""
+)
+
+
+class StaticAsset:
+    """Un archivo del frontend con su hash y, si es texto, sus variantes comprimidas."""
+
+    __slots__ = ("path", "media_type", "stat", "fingerprint", "body", "variants")
+
+    def __init__(self, path, media_type, stat, fingerprint, body=None, variants=None):
+        self.path = path
+        self.media_type = media_type
+        self.stat = stat
+        self.fingerprint = fingerprint
+        self.body = body
+        # codificación -> (bytes, etag)
+        self.variants = variants or {}
+
+    @property
+    def etag(self):
+        return f'"{self.fingerprint}"'
+
+
+class StaticAssets:
+    """Caché de archivos estáticos; se recalcula si el archivo cambia en disco."""
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self._assets = {}
+        # Reentrante: cargar un HTML calcula el hash de los assets que enlaza
+        self._lock = threading.RLock()
+
+    def _resolve(self, relpath):
+        path = os.path.realpath(os.path.join(self.root, relpath))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def get(self, relpath):
+        path = self._resolve(relpath)
+        if path is None:
+            return None
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        asset = self._assets.get(path)
+        if asset is None or asset.stat != stat:
+            with self._lock:
+                asset = self._load(path, stat)
+                self._assets[path] = asset
+        return asset
+
+    def fingerprint(self, relpath):
+        asset = self.get(relpath)
+        return asset.fingerprint if asset else None
+
+    def preload(self):
+        """Calcula al arrancar los hashes y las variantes comprimidas de todo el frontend."""
+        if not os.path.isdir(self.root):
+            return
+        count = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if self.get(os.path.relpath(os.path.join(dirpath, name), self.root)):
+                    count += 1
+        logger.info(f"Archivos estáticos preparados: {count} (brotli={'sí' if BROTLI_AVAILABLE else 'no'})")
+
+    def _load(self, path, stat):
+        ext = os.path.splitext(path)[1].lower()
+        media_type = STATIC_MEDIA_TYPES.get(ext, "application/octet-stream")
+        if ext not in STATIC_COMPRESSIBLE:
+            # Binarios (imágenes, PDF): solo el hash; el contenido se envía desde disco
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(block)
+            return StaticAsset(path, media_type, stat, digest.hexdigest()[:16])
+
+        with open(path, "rb") as f:
+            body = f.read()
+        if ext == ".html":
+            body = self._fingerprint_links(body.decode("utf-8"), os.path.dirname(path)).encode("utf-8")
+        fingerprint = hashlib.sha256(body).hexdigest()[:16]
+        variants = {}
+        if len(body) >= STATIC_MIN_COMPRESS_BYTES:
+            if BROTLI_AVAILABLE:
+                variants["br"] = (brotli.compress(body, quality=11), f'"{fingerprint}-br"')
+            variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{fingerprint}-gz"')
+        return StaticAsset(path, media_type, stat, fingerprint, body, variants)
+
+    def _fingerprint_links(self, html, base_dir):
+        """Agrega ?v=<hash> a las referencias locales del HTML."""
+        def replace(match):
+            prefix, slash, ref, quote = match.groups()
+            relpath = os.path.relpath(os.path.join(self.root if slash else base_dir, ref), self.root)
+            fingerprint = self.fingerprint(relpath)
+            if not fingerprint:
+                return match.group(0)
+            return f"{prefix}{slash}{ref}?v={fingerprint}{quote}"
+        return FINGERPRINT_RE.sub(replace, html)
+
+
+static_assets = StaticAssets(frontend_path)
+
+
+@app.on_event("startup")
+def preload_static_assets():
+    try:
+        static_assets.preload()
+    except Exception as e:
+        logger.error(f"No se pudieron precomprimir los archivos estáticos: {e}")
+
+
+def _accepted_encodings(request):
+    accept = request.headers.get("accept-encoding", "")
+    return {part.split(";")[0].strip().lower() for part in accept.split(",")}
+
+
+def _etag_matches(request, etags):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        candidates.add(tag[2:] if tag.startswith("W/") else tag)
+    return any(etag in candidates for etag in etags)
+
+
+def static_response(request, relpath):
+    """Respuesta para un archivo del frontend: 304, variante comprimida o archivo original."""
+    asset = static_assets.get(relpath)
+    if asset is None:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+
+    # Solo la URL con el hash vigente es inmutable; el resto se revalida con el ETag
+    if asset.media_type.startswith("text/html") or request.query_params.get("v") != asset.fingerprint:
+        cache_control = STATIC_REVALIDATE
+    else:
+        cache_control = STATIC_IMMUTABLE
+
+    accepted = _accepted_encodings(request)
+    encoding = next((enc for enc in ("br", "gzip") if enc in asset.variants and enc in accepted), None)
+    etag = asset.variants[encoding][1] if encoding else asset.etag
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if asset.variants:
+        headers["Vary"] = "Accept-Encoding"
+
+    all_etags = [asset.etag] + [tag for _, tag in asset.variants.values()]
+    if _etag_matches(request, all_etags):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(content=asset.variants[encoding][0], media_type=asset.media_type, headers=headers)
+    if asset.body is not None:
+        return Response(content=asset.body, media_type=asset.media_type, headers=headers)
+    return FileResponse(asset.path, media_type=asset.media_type, headers=headers)
+
+
 @app.get("/")
-async def home():
+async def home(request: Request):
     """Sirve la página de login (index.html)."""
-    index_path = os.path.join(frontend_path, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(
-            index_path,
-            media_type="text/html; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Content-Type": "text/html; charset=utf-8"
-            }
-        )
-    return {"message": "Bienvenido a la API"}
+    if static_assets.get("index.html") is None:
+        return {"message": "Bienvenido a la API"}
+    return static_response(request, "index.html")
 
 
 @app.get("/index.html")
-async def index_html():
+async def index_html(request: Request):
     """Sirve la página de login (index.html)."""
-    index_path = os.path.join(frontend_path, "index.html")
-    if os.path.exists(index_path):
-        return FileResponse(
-            index_path,
-            media_type="text/html; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Content-Type": "text/html; charset=utf-8"
-            }
-        )
-    return {"detail": "Not Found"}
+    return static_response(request, "index.html")
 
 
 @app.get("/register.html")
-async def register_html():
+async def register_html(request: Request):
     """Sirve la página de registro."""
-    register_path = os.path.join(frontend_path, "register.html")
-    if os.path.exists(register_path):
-        return FileResponse(
-            register_path,
-            media_type="text/html; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Content-Type": "text/html; charset=utf-8"
-            }
-        )
-    return {"detail": "Not Found"}
+    return static_response(request, "register.html")
 
 
 @app.get("/dashboard.html")
-async def dashboard():
+async def dashboard(request: Request):
     """Sirve la página de dashboard."""
-    dashboard_path = os.path.join(frontend_path, "dashboard.html")
-    if os.path.exists(dashboard_path):
-        return FileResponse(
-            dashboard_path, 
-            media_type="text/html; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Content-Type": "text/html; charset=utf-8"
-            }
-        )
-    return {"detail": "Not Found"}
+    return static_response(request, "dashboard.html")
 
 
 @app.get("/api.js")
-async def api_js():
+async def api_js(request: Request):
     """Sirve el archivo api.js."""
-    api_path = os.path.join(frontend_path, "api.js")
-    if os.path.exists(api_path):
-        return FileResponse(
-            api_path, 
-            media_type="application/javascript; charset=utf-8", 
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Content-Type": "application/javascript; charset=utf-8"
-            }
-        )
-    return {"detail": "Not Found"}
+    return static_response(request, "api.js")
+
+
+@app.get("/assets/{path:path}")
+async def assets(request: Request, path: str):
+    """Sirve imágenes y documentos de frontend/assets."""
+    return static_response(request, os.path.join("assets", path))
+
+
+# Hilos donde Starlette ejecuta los endpoints síncronos (DB, bcrypt, openpyxl)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "40"))
+_thread_limiter = None
+
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    """Dimensiona el pool de hilos para el trabajo bloqueante."""
+    global _thread_limiter
+    _thread_limiter = anyio.to_thread.current_default_thread_limiter()
+    _thread_limiter.total_tokens = WORKER_THREADS
+    logger.info(f"Pool de hilos configurado con {WORKER_THREADS} hilos")
+
+
+def thread_pool_stats():
+    """Ocupación del pool de hilos: hilos activos y tareas en cola."""
+    if _thread_limiter is None:
+        return {"max_threads": WORKER_THREADS, "active": 0, "queued": 0}
+    st = _thread_limiter.statistics()
+    return {"max_threads": int(st.total_tokens), "active": st.borrowed_tokens, "queued": st.tasks_waiting}
+
+
+@app.on_event("shutdown")
+def close_db_pool():
+    """Cierra las conexiones del pool al detener el servidor."""
+    db_pool.close()
 
 
 @app.get("/health")
-async def health():
+def health():
     """Endpoint de salud para verificar que el backend está activo."""
     try:
         # Verificar conexión a base de datos
@@ -518,7 +1537,7 @@ async def health():
 
 
 @app.get("/api/status")
-async def api_status():
+def api_status():
     """Endpoint de status detallado para monitoring."""
     try:
         # Test DB
@@ -540,7 +1559,11 @@ async def api_status():
                 "api": "healthy"
             },
             "stats": {
-                "total_users": user_count
+                "total_users": user_count,
+                "db_pool": db_pool.stats(),
+                "thread_pool": thread_pool_stats(),
+                "user_cache": user_id_cache.stats(),
+                "jobs": job_queue.stats()
             }
         }
     except Exception as e:
@@ -570,7 +1593,7 @@ async def login(request: Request, username: str = Form(...), password: str = For
 
 
 @app.post("/api/login")
-async def api_login(username: str = Form(...), password: str = Form(...)):
+def api_login(username: str = Form(...), password: str = Form(...)):
     """API para login desde el frontend - verifica contra DB."""
     logger.info(f"POST /api/login - username: {username}")
     try:
@@ -600,7 +1623,7 @@ async def api_login(username: str = Form(...), password: str = Form(...)):
 
 
 @app.post("/api/register")
-async def api_register(
+def api_register(
     email: str = Form(...),
     username: str = Form(...),
     birthdate: str = Form(...),
@@ -658,7 +1681,7 @@ async def api_register(
 
 # ----- Endpoints de Ajustes / Perfil -----
 @app.get("/api/user")
-async def get_user(username: str):
+def get_user(username: str):
     """Obtiene datos públicos del usuario (email, username, birthdate, created_at)."""
     with get_db() as conn:
         cursor = conn.cursor()
@@ -675,7 +1698,7 @@ async def get_user(username: str):
 
 
 @app.post("/api/settings/update-email")
-async def update_email(username: str = Form(...), email: str = Form(...)):
+def update_email(username: str = Form(...), email: str = Form(...)):
     """Actualiza el correo del usuario con validación básica y unicidad."""
     if "@" not in email or "." not in email:
         raise HTTPException(status_code=400, detail={"message": "Correo inválido"})
@@ -701,7 +1724,7 @@ async def update_email(username: str = Form(...), email: str = Form(...)):
 
 
 @app.post("/api/settings/update-username")
-async def update_username(username: str = Form(...), new_username: str = Form(...)):
+def update_username(username: str = Form(...), new_username: str = Form(...)):
     """Actualiza el nombre de usuario (mínimo 3 caracteres y único)."""
     if len(new_username) < 3:
         raise HTTPException(status_code=400, detail={"message": "El usuario debe tener al menos 3 caracteres"})
@@ -721,11 +1744,12 @@ async def update_username(username: str = Form(...), new_username: str = Form(..
             conn.commit()
         except Exception:
             raise HTTPException(status_code=400, detail={"message": "El usuario ya existe"})
+        user_id_cache.invalidate(username, new_username)
     return {"success": True}
 
 
 @app.post("/api/settings/update-password")
-async def update_password(
+def update_password(
     username: str = Form(...),
     current_password: str = Form(...),
     new_password: str = Form(...),
@@ -757,27 +1781,234 @@ async def update_password(
     return {"success": True}
 
 
+# ===============================================
+# VERSIÓN DE DATOS Y GET CONDICIONAL
+# ===============================================
+# users.data_version es un contador por usuario que sube en la misma
+# transacción que cada escritura de sus datos. data_versions guarda, por
+# entidad, el valor del contador en el último cambio de esa entidad, y cada
+# fila, el de su última alta o cambio (columna version); las bajas dejan una
+# fila en tombstones con la versión en que ocurrieron. Todas las versiones
+# son comparables entre sí y nunca bajan, lo que permite /api/sync?since=.
+# Los listados y reportes usan la versión de su entidad como ETag: si el
+# cliente ya la tiene se responde 304 sin recorrer las tablas ni serializar.
+# El ETag es débil porque la misma versión puede viajar comprimida o no.
+
+DATA_ENTITIES = ("clientes", "obras", "productos", "registros")
+DATA_CACHE_CONTROL = "private, no-cache"
+
+
+def _bump_data_version(cursor, user_id, *entidades):
+    """Sube la versión del usuario, la asigna a esas entidades y la devuelve.
+
+    Se llama antes de escribir las filas, que guardan la versión devuelta.
+    El UPDATE bloquea la fila del usuario hasta el commit, así las escrituras
+    de un mismo usuario se confirman en el orden de sus versiones.
+    No confirma la transacción.
+    """
+    cursor.execute(*sql("UPDATE users SET data_version = data_version + 1 WHERE id = ?", (user_id,)))
+    cursor.execute(*sql("SELECT data_version FROM users WHERE id = ?", (user_id,)))
+    version = cursor.fetchone()["data_version"]
+    _stamp_entities(cursor, user_id, version, *entidades)
+    return version
+
+
+def _lock_user(cursor, user_id):
+    """Toma el mismo bloqueo que _bump_data_version sin cambiar la versión.
+
+    Para leer y luego escribir según lo leído (p.ej. los hashes de una
+    importación) sin que otra escritura del usuario se intercale.
+    """
+    cursor.execute(*sql("UPDATE users SET data_version = data_version WHERE id = ?", (user_id,)))
+
+
+def _stamp_entities(cursor, user_id, version, *entidades):
+    """Registra que esas entidades cambiaron en `version`."""
+    for entidad in entidades:
+        cursor.execute(*sql(
+            """INSERT INTO data_versions (user_id, entidad, version) VALUES (?, ?, ?)
+               ON CONFLICT (user_id, entidad) DO UPDATE SET version = excluded.version""",
+            (user_id, entidad, version)
+        ))
+
+
+def _data_versions(conn, user_id):
+    """(versión general, {entidad: versión}); 0 para lo que nunca cambió."""
+    cursor = conn.cursor()
+    cursor.execute(*sql("SELECT data_version FROM users WHERE id = ?", (user_id,)))
+    row = cursor.fetchone()
+    cursor.execute(*sql("SELECT entidad, version FROM data_versions WHERE user_id = ?", (user_id,)))
+    versiones = {r["entidad"]: r["version"] for r in cursor.fetchall()}
+    return (row["data_version"] if row else 0), {e: versiones.get(e, 0) for e in DATA_ENTITIES}
+
+
+def _data_etag(conn, user_id, entidad):
+    """ETag de una entidad del usuario: id y versión (el id cambia si se recrea el usuario)."""
+    cursor = conn.cursor()
+    cursor.execute(*sql("SELECT version FROM data_versions WHERE user_id = ? AND entidad = ?", (user_id, entidad)))
+    row = cursor.fetchone()
+    return f'"{user_id}-{row["version"] if row else 0}"'
+
+
+def _conditional_get(request, conn, user_id, entidad):
+    """Devuelve (cabeceras de caché, respuesta 304 o None) para un GET sobre una entidad del usuario."""
+    etag = _data_etag(conn, user_id, entidad)
+    headers = {"ETag": "W/" + etag, "Cache-Control": DATA_CACHE_CONTROL}
+    if _etag_matches(request, [etag]):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+# ===============================================
+# SERIALIZACIÓN JSON
+# ===============================================
+# Los listados y reportes devuelven FastJSONResponse ya armada: así FastAPI
+# no pasa el resultado por jsonable_encoder (que recorre cada valor) y el
+# cuerpo se genera de una vez con orjson, o con json si no está instalado.
+
+def _json_default(value):
+    """Serializa fechas como lo hace FastAPI (ISO 8601) y Decimal como número."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def _json_bytes(value):
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(value, default=_json_default)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content):
+        return _json_bytes(content)
+
+
+def _tuple_cursor(conn):
+    """Cursor que devuelve tuplas en lugar de sqlite3.Row / RealDictRow."""
+    if USE_POSTGRES:
+        return conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+# ===============================================
+# PAGINACIÓN Y PROYECCIÓN DE LISTADOS
+# ===============================================
+# Los listados aceptan `limit` (paginación por keyset, sin OFFSET) y `fields`
+# (columnas a devolver). Sin `limit` se devuelve todo, como siempre.
+# El cursor es opaco: codifica los valores de la clave de orden de la última
+# fila entregada y la siguiente página continúa estrictamente después de ella.
+
+PAGE_MAX_LIMIT = 1000
+
+
+def _encode_cursor(values):
+    raw = json.dumps(values, default=str, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail={"message": "Cursor inválido"})
+    return values
+
+
+def _parse_fields(fields, allowed):
+    """Valida el parámetro fields=a,b,c contra las columnas permitidas."""
+    if not fields:
+        return list(allowed)
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail={"message": f"Campos desconocidos: {', '.join(unknown)}"})
+    return requested
+
+
+def _fetch_page(conn, table, allowed, order_keys, where, params, fields=None, limit=None, cursor=None, expressions=None):
+    """Lista filas de `table` ordenadas de forma descendente por `order_keys`.
+
+    order_keys son expresiones SQL que forman una clave única (la última es el id).
+    expressions permite leer un campo con otra expresión SQL (p.ej. un cast).
+    Devuelve (filas, next_cursor); next_cursor es None si no hay más páginas.
+    """
+    columns = _parse_fields(fields, allowed)
+    if limit is not None and not 1 <= limit <= PAGE_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail={"message": f"limit debe estar entre 1 y {PAGE_MAX_LIMIT}"})
+
+    # Alias entre comillas: conserva mayúsculas (totalCobrar) también en PostgreSQL
+    expressions = expressions or {}
+    select = [f'{expressions.get(c, c)} AS "{c}"' for c in columns]
+    select += [f"{expr} AS _k{i}" for i, expr in enumerate(order_keys)]
+    query = f"SELECT {', '.join(select)} FROM {table} WHERE {where}"
+    params = list(params)
+
+    if cursor:
+        query += f" AND ({', '.join(order_keys)}) < ({', '.join('?' for _ in order_keys)})"
+        params += _decode_cursor(cursor, len(order_keys))
+
+    query += " ORDER BY " + ", ".join(f"_k{i} DESC" for i in range(len(order_keys)))
+    if limit is not None:
+        # Una fila extra indica si existe una página siguiente
+        query += " LIMIT ?"
+        params.append(limit + 1)
+
+    # Tuplas: cada fila se convierte en dict una sola vez, sin las claves _k
+    cur = _tuple_cursor(conn)
+    cur.execute(*sql(query, params))
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(list(rows[-1][len(columns):]))
+
+    return [dict(zip(columns, row)) for row in rows], next_cursor
+
+
+def _page_response(key, items, next_cursor, limit, headers=None):
+    """Arma la respuesta del listado; next_cursor solo aparece si se paginó."""
+    result = {key: items}
+    if limit is not None:
+        result["next_cursor"] = next_cursor
+    return FastJSONResponse(result, headers=headers)
+
+
 # ===============================================
 # ENDPOINTS PARA CLIENTES
 # ===============================================
 
 @app.get("/api/clientes")
-async def get_clientes(username: str):
-    """Obtiene todos los clientes del usuario."""
+def get_clientes(request: Request, username: str, limit: int = None, cursor: str = None, fields: str = None):
+    """Obtiene los clientes del usuario (paginados si se indica limit)."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "clientes")
+            if not_modified:
+                return not_modified
             
             # Obtener clientes
-            cursor = conn.execute(
-                "SELECT id, nombre, cedula, obra, estado, fecha, created_at FROM clientes WHERE user_id = ? ORDER BY created_at DESC",
-                (user["id"],)
+            clientes, next_cursor = _fetch_page(
+                conn, "clientes",
+                ["id", "nombre", "cedula", "obra", "estado", "fecha", "created_at"],
+                ["created_at", "id"],
+                "user_id = ?", [user_id],
+                fields=fields, limit=limit, cursor=cursor
             )
-            clientes = [dict(row) for row in cursor.fetchall()]
-            return {"clientes": clientes}
+            return _page_response("clientes", clientes, next_cursor, limit, cache_headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -786,7 +2017,7 @@ async def get_clientes(username: str):
 
 
 @app.post("/api/clientes")
-async def create_cliente(
+def create_cliente(
     username: str = Form(...),
     nombre: str = Form(...),
     cedula: str = Form(None),
@@ -799,22 +2030,25 @@ async def create_cliente(
         with get_db() as conn:
             cursor = conn.cursor()
             # Obtener user_id
-            cursor.execute(*sql("SELECT id FROM users WHERE username = ?", (username,)))
-            user = cursor.fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
+            version = _bump_data_version(cursor, user_id, "clientes")
+            content_hash = _record_hash("clientes",
+                                        {"nombre": nombre, "cedula": cedula, "obra": obra, "estado": estado, "fecha": fecha})
+            
             # Insertar cliente y obtener ID
             if USE_POSTGRES:
                 cursor.execute(
-                    "INSERT INTO clientes (user_id, nombre, cedula, obra, estado, fecha) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-                    (user["id"] if isinstance(user, dict) else user[0], nombre, cedula, obra, estado, fecha)
+                    "INSERT INTO clientes (user_id, nombre, cedula, obra, estado, fecha, content_hash, version, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP) RETURNING id",
+                    (user_id, nombre, cedula, obra, estado, fecha, content_hash, version)
                 )
-                new_id = cursor.fetchone()[0]
+                new_id = cursor.fetchone()["id"]
             else:
                 cursor.execute(
-                    "INSERT INTO clientes (user_id, nombre, cedula, obra, estado, fecha) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user["id"] if isinstance(user, dict) else user[0], nombre, cedula, obra, estado, fecha)
+                    "INSERT INTO clientes (user_id, nombre, cedula, obra, estado, fecha, content_hash, version, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                    (user_id, nombre, cedula, obra, estado, fecha, content_hash, version)
                 )
                 new_id = cursor.lastrowid
             conn.commit()
@@ -826,7 +2060,7 @@ async def create_cliente(
 
 
 @app.put("/api/clientes/{cliente_id}")
-async def update_cliente(
+def update_cliente(
     cliente_id: int,
     username: str = Form(...),
     nombre: str = Form(...),
@@ -839,23 +2073,28 @@ async def update_cliente(
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
             # Verificar que el cliente pertenece al usuario
             cliente = conn.execute(
                 "SELECT id FROM clientes WHERE id = ? AND user_id = ?",
-                (cliente_id, user["id"])
+                (cliente_id, user_id)
             ).fetchone()
             
             if not cliente:
                 raise HTTPException(status_code=404, detail={"message": "Cliente no encontrado"})
             
+            version = _bump_data_version(conn.cursor(), user_id, "clientes")
+            content_hash = _record_hash("clientes",
+                                        {"nombre": nombre, "cedula": cedula, "obra": obra, "estado": estado, "fecha": fecha})
+            
             # Actualizar cliente
             conn.execute(
-                "UPDATE clientes SET nombre = ?, cedula = ?, obra = ?, estado = ?, fecha = ? WHERE id = ?",
-                (nombre, cedula, obra, estado, fecha, cliente_id)
+                "UPDATE clientes SET nombre = ?, cedula = ?, obra = ?, estado = ?, fecha = ?, content_hash = ?, "
+                "version = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (nombre, cedula, obra, estado, fecha, content_hash, version, cliente_id)
             )
             conn.commit()
             
@@ -868,24 +2107,21 @@ async def update_cliente(
 
 
 @app.delete("/api/clientes/{cliente_id}")
-async def delete_cliente(cliente_id: int, username: str):
+def delete_cliente(cliente_id: int, username: str):
     """Elimina un cliente."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
-            # Verificar y eliminar
-            result = conn.execute(
-                "DELETE FROM clientes WHERE id = ? AND user_id = ?",
-                (cliente_id, user["id"])
-            )
-            conn.commit()
-            
-            if result.rowcount == 0:
+            # Verificar y eliminar (si no existe, get_db revierte la versión)
+            cursor = conn.cursor()
+            version = _bump_data_version(cursor, user_id, "clientes")
+            if not _delete_where(cursor, user_id, "clientes", "id = ? AND user_id = ?", (cliente_id, user_id), version):
                 raise HTTPException(status_code=404, detail={"message": "Cliente no encontrado"})
+            conn.commit()
             
             return {"success": True}
     except HTTPException:
@@ -900,22 +2136,27 @@ async def delete_cliente(cliente_id: int, username: str):
 # ===============================================
 
 @app.get("/api/obras")
-async def get_obras(username: str):
-    """Obtiene todas las obras del usuario."""
+def get_obras(request: Request, username: str, limit: int = None, cursor: str = None, fields: str = None):
+    """Obtiene las obras del usuario (paginadas si se indica limit)."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "obras")
+            if not_modified:
+                return not_modified
             
             # Obtener obras
-            cursor = conn.execute(
-                "SELECT id, nombre, ubicacion, estado, created_at FROM obras WHERE user_id = ? ORDER BY created_at DESC",
-                (user["id"],)
+            obras, next_cursor = _fetch_page(
+                conn, "obras",
+                ["id", "nombre", "ubicacion", "estado", "created_at"],
+                ["created_at", "id"],
+                "user_id = ?", [user_id],
+                fields=fields, limit=limit, cursor=cursor
             )
-            obras = [dict(row) for row in cursor.fetchall()]
-            return {"obras": obras}
+            return _page_response("obras", obras, next_cursor, limit, cache_headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -924,7 +2165,7 @@ async def get_obras(username: str):
 
 
 @app.post("/api/obras")
-async def create_obra(
+def create_obra(
     username: str = Form(...),
     nombre: str = Form(...),
     ubicacion: str = Form(None),
@@ -934,14 +2175,18 @@ async def create_obra(
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
+            version = _bump_data_version(conn.cursor(), user_id, "obras")
+            content_hash = _record_hash("obras", {"nombre": nombre, "ubicacion": ubicacion, "estado": estado})
+            
             # Insertar obra
             cursor = conn.execute(
-                "INSERT INTO obras (user_id, nombre, ubicacion, estado) VALUES (?, ?, ?, ?)",
-                (user["id"], nombre, ubicacion, estado)
+                "INSERT INTO obras (user_id, nombre, ubicacion, estado, content_hash, version, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                (user_id, nombre, ubicacion, estado, content_hash, version)
             )
             conn.commit()
             
@@ -952,7 +2197,7 @@ async def create_obra(
 
 
 @app.put("/api/obras/{obra_id}")
-async def update_obra(
+def update_obra(
     obra_id: int,
     username: str = Form(...),
     nombre: str = Form(...),
@@ -963,23 +2208,27 @@ async def update_obra(
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
             # Verificar que la obra pertenece al usuario
             obra = conn.execute(
                 "SELECT id FROM obras WHERE id = ? AND user_id = ?",
-                (obra_id, user["id"])
+                (obra_id, user_id)
             ).fetchone()
             
             if not obra:
                 raise HTTPException(status_code=404, detail={"message": "Obra no encontrada"})
             
+            version = _bump_data_version(conn.cursor(), user_id, "obras")
+            content_hash = _record_hash("obras", {"nombre": nombre, "ubicacion": ubicacion, "estado": estado})
+            
             # Actualizar obra
             conn.execute(
-                "UPDATE obras SET nombre = ?, ubicacion = ?, estado = ? WHERE id = ?",
-                (nombre, ubicacion, estado, obra_id)
+                "UPDATE obras SET nombre = ?, ubicacion = ?, estado = ?, content_hash = ?, "
+                "version = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (nombre, ubicacion, estado, content_hash, version, obra_id)
             )
             conn.commit()
             
@@ -992,24 +2241,21 @@ async def update_obra(
 
 
 @app.delete("/api/obras/{obra_id}")
-async def delete_obra(obra_id: int, username: str):
+def delete_obra(obra_id: int, username: str):
     """Elimina una obra."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
-            # Verificar y eliminar
-            result = conn.execute(
-                "DELETE FROM obras WHERE id = ? AND user_id = ?",
-                (obra_id, user["id"])
-            )
-            conn.commit()
-            
-            if result.rowcount == 0:
+            # Verificar y eliminar (si no existe, get_db revierte la versión)
+            cursor = conn.cursor()
+            version = _bump_data_version(cursor, user_id, "obras")
+            if not _delete_where(cursor, user_id, "obras", "id = ? AND user_id = ?", (obra_id, user_id), version):
                 raise HTTPException(status_code=404, detail={"message": "Obra no encontrada"})
+            conn.commit()
             
             return {"success": True}
     except HTTPException:
@@ -1024,22 +2270,27 @@ async def delete_obra(obra_id: int, username: str):
 # ===============================================
 
 @app.get("/api/productos")
-async def get_productos(username: str):
-    """Obtiene todos los productos del usuario."""
+def get_productos(request: Request, username: str, limit: int = None, cursor: str = None, fields: str = None):
+    """Obtiene los productos del usuario (paginados si se indica limit)."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "productos")
+            if not_modified:
+                return not_modified
             
             # Obtener productos
-            cursor = conn.execute(
-                "SELECT id, nombre, precio, created_at FROM productos WHERE user_id = ? ORDER BY created_at DESC",
-                (user["id"],)
+            productos, next_cursor = _fetch_page(
+                conn, "productos",
+                ["id", "nombre", "precio", "created_at"],
+                ["created_at", "id"],
+                "user_id = ?", [user_id],
+                fields=fields, limit=limit, cursor=cursor
             )
-            productos = [dict(row) for row in cursor.fetchall()]
-            return {"productos": productos}
+            return _page_response("productos", productos, next_cursor, limit, cache_headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -1048,7 +2299,7 @@ async def get_productos(username: str):
 
 
 @app.post("/api/productos")
-async def create_producto(
+def create_producto(
     username: str = Form(...),
     nombre: str = Form(...),
     precio: float = Form(0)
@@ -1057,14 +2308,18 @@ async def create_producto(
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
+            version = _bump_data_version(conn.cursor(), user_id, "productos")
+            content_hash = _record_hash("productos", {"nombre": nombre, "precio": precio})
+            
             # Insertar producto
             cursor = conn.execute(
-                "INSERT INTO productos (user_id, nombre, precio) VALUES (?, ?, ?)",
-                (user["id"], nombre, precio)
+                "INSERT INTO productos (user_id, nombre, precio, content_hash, version, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                (user_id, nombre, precio, content_hash, version)
             )
             conn.commit()
             
@@ -1075,7 +2330,7 @@ async def create_producto(
 
 
 @app.put("/api/productos/{producto_id}")
-async def update_producto(
+def update_producto(
     producto_id: int,
     username: str = Form(...),
     nombre: str = Form(...),
@@ -1085,23 +2340,27 @@ async def update_producto(
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
             # Verificar que el producto pertenece al usuario
             producto = conn.execute(
                 "SELECT id FROM productos WHERE id = ? AND user_id = ?",
-                (producto_id, user["id"])
+                (producto_id, user_id)
             ).fetchone()
             
             if not producto:
                 raise HTTPException(status_code=404, detail={"message": "Producto no encontrado"})
             
+            version = _bump_data_version(conn.cursor(), user_id, "productos")
+            content_hash = _record_hash("productos", {"nombre": nombre, "precio": precio})
+            
             # Actualizar producto
             conn.execute(
-                "UPDATE productos SET nombre = ?, precio = ? WHERE id = ?",
-                (nombre, precio, producto_id)
+                "UPDATE productos SET nombre = ?, precio = ?, content_hash = ?, "
+                "version = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (nombre, precio, content_hash, version, producto_id)
             )
             conn.commit()
             
@@ -1114,24 +2373,21 @@ async def update_producto(
 
 
 @app.delete("/api/productos/{producto_id}")
-async def delete_producto(producto_id: int, username: str):
+def delete_producto(producto_id: int, username: str):
     """Elimina un producto."""
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
-            # Verificar y eliminar
-            result = conn.execute(
-                "DELETE FROM productos WHERE id = ? AND user_id = ?",
-                (producto_id, user["id"])
-            )
-            conn.commit()
-            
-            if result.rowcount == 0:
+            # Verificar y eliminar (si no existe, get_db revierte la versión)
+            cursor = conn.cursor()
+            version = _bump_data_version(cursor, user_id, "productos")
+            if not _delete_where(cursor, user_id, "productos", "id = ? AND user_id = ?", (producto_id, user_id), version):
                 raise HTTPException(status_code=404, detail={"message": "Producto no encontrado"})
+            conn.commit()
             
             return {"success": True}
     except HTTPException:
@@ -1141,63 +2397,197 @@ async def delete_producto(producto_id: int, username: str):
         raise HTTPException(status_code=500, detail={"message": "Error al eliminar producto"})
 
 
+# ===============================================
+# RESUMEN DE REGISTROS (obra/fecha)
+# ===============================================
+# registros_resumen guarda los totales de registros agrupados por
+# (user_id, obra, fecha). Se actualiza en la misma transacción que cada
+# escritura de registros, así los reportes no recorren el histórico.
+# Obra/fecha nulas se guardan como cadena vacía.
+
+def _resumen_apply(cursor, user_id, obra, fecha, cobrar, pagado, cantidad, registros):
+    """Suma (o resta, con valores negativos) un delta a la fila de resumen correspondiente."""
+    key = (user_id, obra or '', fecha or '')
+    cursor.execute(*sql(
+        """INSERT INTO registros_resumen (user_id, obra, fecha, totalCobrar, totalPagado, totalCantidad, registros)
+           VALUES (?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (user_id, obra, fecha) DO UPDATE SET
+               totalCobrar = registros_resumen.totalCobrar + excluded.totalCobrar,
+               totalPagado = registros_resumen.totalPagado + excluded.totalPagado,
+               totalCantidad = registros_resumen.totalCantidad + excluded.totalCantidad,
+               registros = registros_resumen.registros + excluded.registros""",
+        key + (cobrar, pagado, int(cantidad), registros)
+    ))
+    if registros < 0:
+        cursor.execute(*sql(
+            "DELETE FROM registros_resumen WHERE user_id = ? AND obra = ? AND fecha = ? AND registros <= 0",
+            key
+        ))
+
+
+def _resumen_add(cursor, user_id, registro, sign=1):
+    """Agrega (sign=1) o quita (sign=-1) un registro del resumen."""
+    _resumen_apply(
+        cursor, user_id, registro.get('obra'), registro.get('fecha'),
+        sign * _num(registro.get('totalCobrar')),
+        sign * _num(registro.get('totalPagado')),
+        sign * _num(registro.get('totalCantidad')),
+        sign
+    )
+
+
+def verify_resumen(conn, user_id=None, repair=False):
+    """Recalcula el resumen desde registros y lo compara con lo guardado.
+
+    Devuelve la lista de diferencias. Con repair=True reconstruye el resumen
+    (de un usuario o de todos) en la misma transacción.
+    """
+    user_filter = " WHERE user_id = ?" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else None
+    cursor = conn.cursor()
+
+    cursor.execute(*sql(
+        f"""SELECT user_id, COALESCE(obra, '') AS obra, COALESCE(fecha, '') AS fecha,
+                   SUM(COALESCE(totalCobrar, 0)) AS cobrar, SUM(COALESCE(totalPagado, 0)) AS pagado,
+                   SUM(COALESCE(totalCantidad, 0)) AS cantidad, COUNT(*) AS registros
+            FROM registros{user_filter}
+            GROUP BY user_id, COALESCE(obra, ''), COALESCE(fecha, '')""",
+        params
+    ))
+    expected = {(r["user_id"], r["obra"], r["fecha"]): r for r in cursor.fetchall()}
+
+    cursor.execute(*sql(
+        f"""SELECT user_id, obra, fecha, totalCobrar AS cobrar, totalPagado AS pagado,
+                   totalCantidad AS cantidad, registros
+            FROM registros_resumen{user_filter}""",
+        params
+    ))
+    actual = {(r["user_id"], r["obra"], r["fecha"]): r for r in cursor.fetchall()}
+
+    def values(r):
+        if r is None:
+            return None
+        return {
+            "totalCobrar": r["cobrar"] or 0,
+            "totalPagado": r["pagado"] or 0,
+            "totalCantidad": r["cantidad"] or 0,
+            "registros": r["registros"],
+        }
+
+    drift = []
+    for key in sorted(set(expected) | set(actual), key=str):
+        exp_v, act_v = values(expected.get(key)), values(actual.get(key))
+        if exp_v is None or act_v is None or any(abs(exp_v[k] - act_v[k]) > 0.005 for k in exp_v):
+            drift.append({"user_id": key[0], "obra": key[1], "fecha": key[2], "esperado": exp_v, "actual": act_v})
+
+    if repair and drift:
+        cursor.execute(*sql(f"DELETE FROM registros_resumen{user_filter}", params))
+        cursor.execute(*sql(
+            f"""INSERT INTO registros_resumen (user_id, obra, fecha, totalCobrar, totalPagado, totalCantidad, registros)
+                SELECT user_id, COALESCE(obra, ''), COALESCE(fecha, ''),
+                       SUM(COALESCE(totalCobrar, 0)), SUM(COALESCE(totalPagado, 0)), SUM(COALESCE(totalCantidad, 0)), COUNT(*)
+                FROM registros{user_filter}
+                GROUP BY user_id, COALESCE(obra, ''), COALESCE(fecha, '')""",
+            params
+        ))
+        for drift_user_id in {d["user_id"] for d in drift}:
+            _bump_data_version(cursor, drift_user_id, "registros")
+        conn.commit()
+        logger.info(f"Resumen de registros reconstruido ({len(drift)} diferencias corregidas)")
+
+    return drift
+
+
 # ===============================================
 # ENDPOINTS PARA REGISTROS
 # ===============================================
 
+# Columnas de registros que guardan JSON (JSONB en PostgreSQL, TEXT validado en SQLite)
+REGISTROS_JSON_COLUMNS = ("clientesAdicionales", "detalles")
+
+
+def _registro_json(registro):
+    """Un registro como objeto JSON (bytes), con las columnas JSON insertadas sin decodificar.
+
+    Las columnas JSON se quitan del dict y se agregan al final del objeto.
+    """
+    raw = [(key, registro.pop(key)) for key in REGISTROS_JSON_COLUMNS if key in registro]
+    body = _json_bytes(registro)
+    if not raw:
+        return body
+    extra = b",".join(b'"%s":%s' % (key.encode("ascii"), (value or "[]").encode("utf-8")) for key, value in raw)
+    return body[:-1] + (b"," if registro else b"") + extra + b"}"
+
+
+def _registros_response(registros, next_cursor, limit, headers=None):
+    """Arma la respuesta JSON de registros sin decodificar las columnas JSON.
+
+    El texto guardado en detalles/clientesAdicionales ya es JSON válido (lo
+    garantiza la base de datos), así que se inserta tal cual en la respuesta.
+    """
+    body = b'{"registros":[' + b",".join(_registro_json(r) for r in registros) + b"]"
+    if limit is not None:
+        body += b',"next_cursor":' + _json_bytes(next_cursor)
+    body += b"}"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _item_tipo_filter(tipo):
+    """Condición SQL: el registro tiene algún item con ese tipo (sin distinguir mayúsculas)."""
+    condition = (
+        "EXISTS (SELECT 1 FROM registro_items"
+        " WHERE registro_items.registro_id = registros.id AND registro_items.tipo = ?)"
+    )
+    return condition, [tipo.strip().lower()]
+
+
 @app.get("/api/registros")
-async def get_registros(username: str, obra: str = None, fecha_inicio: str = None, fecha_fin: str = None):
-    """Obtiene todos los registros del usuario con filtros opcionales."""
+def get_registros(
+    request: Request,
+    username: str,
+    obra: str = None,
+    fecha_inicio: str = None,
+    fecha_fin: str = None,
+    item_tipo: str = None,
+    limit: int = None,
+    cursor: str = None,
+    fields: str = None
+):
+    """Obtiene los registros del usuario con filtros opcionales.
+
+    Con limit se pagina por (fecha, created_at, id) y la respuesta incluye
+    next_cursor. Con fields se pueden omitir las columnas JSON pesadas
+    (detalles, clientesAdicionales) en las vistas de listado. item_tipo
+    filtra los registros que tienen algún item de ese tipo (p.ej. adicional).
+    """
     try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "registros")
+            if not_modified:
+                return not_modified
             
-            # Construir query con filtros
-            query = "SELECT id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, clientesAdicionales, detalles, created_at FROM registros WHERE user_id = ?"
-            params = [user["id"]]
-            
-            if obra:
-                query += " AND obra = ?"
-                params.append(obra)
-            
-            if fecha_inicio:
-                query += " AND fecha >= ?"
-                params.append(fecha_inicio)
-            
-            if fecha_fin:
-                query += " AND fecha <= ?"
-                params.append(fecha_fin)
-            
-            query += " ORDER BY fecha DESC, created_at DESC"
-            
-            # Obtener registros
-            cursor = conn.execute(query, params)
-            registros = [dict(row) for row in cursor.fetchall()]
-            
-            # Parsear JSON fields
-            for registro in registros:
-                if registro.get('clientesAdicionales'):
-                    try:
-                        import json
-                        registro['clientesAdicionales'] = json.loads(registro['clientesAdicionales'])
-                    except:
-                        registro['clientesAdicionales'] = []
-                else:
-                    registro['clientesAdicionales'] = []
-                    
-                if registro.get('detalles'):
-                    try:
-                        import json
-                        registro['detalles'] = json.loads(registro['detalles'])
-                    except:
-                        registro['detalles'] = []
-                else:
-                    registro['detalles'] = []
+            # Obtener registros con filtros
+            where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin)
+            if item_tipo:
+                condition, extra = _item_tipo_filter(item_tipo)
+                where += f" AND {condition}"
+                params += extra
+            # En PostgreSQL se leen las columnas JSONB como texto para no decodificarlas
+            expressions = {c: f"{c}::text" for c in REGISTROS_JSON_COLUMNS} if USE_POSTGRES else None
+            registros, next_cursor = _fetch_page(
+                conn, "registros",
+                ["id", "fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status",
+                 "clientesAdicionales", "detalles", "created_at"],
+                ["COALESCE(fecha, '')", "created_at", "id"],
+                where, params,
+                fields=fields, limit=limit, cursor=cursor, expressions=expressions
+            )
             
-            return {"registros": registros}
+            return _registros_response(registros, next_cursor, limit, cache_headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -1209,40 +2599,8 @@ async def get_registros(username: str, obra: str = None, fecha_inicio: str = Non
 async def create_registro(request: Request):
     """Crea un nuevo registro."""
     try:
-        import json
         body = await request.json()
-        
-        username = body.get('username')
-        fecha = body.get('fecha')
-        obra = body.get('obra')
-        totalCantidad = body.get('totalCantidad', 0)
-        totalCobrar = body.get('totalCobrar', 0)
-        totalPagado = body.get('totalPagado', 0)
-        status = body.get('status', 'pendiente')
-        clientesAdicionales = body.get('clientesAdicionales', [])
-        detalles = body.get('detalles', [])
-        
-        with get_db() as conn:
-            # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
-            
-            # Convertir listas a JSON
-            clientesAdicionales_json = json.dumps(clientesAdicionales) if clientesAdicionales else None
-            detalles_json = json.dumps(detalles) if detalles else None
-            
-            # Insertar registro
-            cursor = conn.execute(
-                """INSERT INTO registros 
-                   (user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, clientesAdicionales, detalles) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (user["id"], fecha, obra, totalCantidad, totalCobrar, totalPagado, status, 
-                 clientesAdicionales_json, detalles_json)
-            )
-            conn.commit()
-            
-            return {"success": True, "id": cursor.lastrowid}
+        return await run_in_threadpool(_create_registro, body)
     except HTTPException:
         raise
     except Exception as e:
@@ -1250,84 +2608,142 @@ async def create_registro(request: Request):
         raise HTTPException(status_code=500, detail={"message": f"Error al crear registro: {str(e)}"})
 
 
+def _create_registro(body):
+    """Inserta el registro (se ejecuta en el pool de hilos)."""
+    import json
+    username = body.get('username')
+    fecha = body.get('fecha')
+    obra = body.get('obra')
+    # La columna es entera (como en _normalize_registro); el resumen y el hash usan el mismo valor
+    totalCantidad = body['totalCantidad'] = int(_num(body.get('totalCantidad')))
+    totalCobrar = body.get('totalCobrar', 0)
+    totalPagado = body.get('totalPagado', 0)
+    status = body.get('status', 'pendiente')
+    clientesAdicionales = body.get('clientesAdicionales', [])
+    detalles = body.get('detalles', [])
+    
+    with get_db() as conn:
+        # Obtener user_id
+        user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+        
+        # Convertir listas a JSON
+        clientesAdicionales_json = json.dumps(clientesAdicionales) if clientesAdicionales else None
+        detalles_json = json.dumps(detalles) if detalles else None
+        
+        # Insertar registro y obtener ID
+        cursor = conn.cursor()
+        version = _bump_data_version(cursor, user_id, "registros")
+        content_hash = _record_hash("registros", body)
+        query = """INSERT INTO registros 
+               (user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, clientesAdicionales, detalles, content_hash,
+                version, updated_at) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)"""
+        params = (user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, 
+                  clientesAdicionales_json, detalles_json, content_hash, version)
+        if USE_POSTGRES:
+            cursor.execute(*sql(query + " RETURNING id", params))
+            new_id = cursor.fetchone()["id"]
+        else:
+            cursor.execute(query, params)
+            new_id = cursor.lastrowid
+        _insert_registro_items(cursor, new_id, user_id, detalles)
+        _resumen_add(cursor, user_id, body)
+        conn.commit()
+        
+        return {"success": True, "id": new_id}
+
+
 @app.put("/api/registros/{registro_id}")
 async def update_registro(registro_id: int, request: Request):
     """Actualiza un registro existente."""
     try:
-        import json
         body = await request.json()
+        return await run_in_threadpool(_update_registro, registro_id, body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error al actualizar registro: {e}")
+        raise HTTPException(status_code=500, detail={"message": f"Error al actualizar registro: {str(e)}"})
+
+
+def _update_registro(registro_id, body):
+    """Actualiza el registro (se ejecuta en el pool de hilos)."""
+    import json
+    username = body.get('username')
+    fecha = body.get('fecha')
+    obra = body.get('obra')
+    # La columna es entera (como en _normalize_registro); el resumen y el hash usan el mismo valor
+    totalCantidad = body['totalCantidad'] = int(_num(body.get('totalCantidad')))
+    totalCobrar = body.get('totalCobrar', 0)
+    totalPagado = body.get('totalPagado', 0)
+    status = body.get('status', 'pendiente')
+    clientesAdicionales = body.get('clientesAdicionales', [])
+    detalles = body.get('detalles', [])
+    
+    with get_db() as conn:
+        # Obtener user_id
+        user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+        
+        # Verificar que el registro pertenece al usuario
+        registro = conn.execute(
+            "SELECT id, fecha, obra, totalCantidad, totalCobrar, totalPagado FROM registros WHERE id = ? AND user_id = ?",
+            (registro_id, user_id)
+        ).fetchone()
+        
+        if not registro:
+            raise HTTPException(status_code=404, detail={"message": "Registro no encontrado"})
         
-        username = body.get('username')
-        fecha = body.get('fecha')
-        obra = body.get('obra')
-        totalCantidad = body.get('totalCantidad', 0)
-        totalCobrar = body.get('totalCobrar', 0)
-        totalPagado = body.get('totalPagado', 0)
-        status = body.get('status', 'pendiente')
-        clientesAdicionales = body.get('clientesAdicionales', [])
-        detalles = body.get('detalles', [])
+        # Convertir listas a JSON
+        clientesAdicionales_json = json.dumps(clientesAdicionales) if clientesAdicionales else None
+        detalles_json = json.dumps(detalles) if detalles else None
         
+        resumen_cursor = conn.cursor()
+        version = _bump_data_version(resumen_cursor, user_id, "registros")
+        content_hash = _record_hash("registros", body)
+        
+        # Actualizar registro
+        conn.execute(
+            """UPDATE registros 
+               SET fecha = ?, obra = ?, totalCantidad = ?, totalCobrar = ?, 
+                   totalPagado = ?, status = ?, clientesAdicionales = ?, detalles = ?, content_hash = ?,
+                   version = ?, updated_at = CURRENT_TIMESTAMP
+               WHERE id = ?""",
+            (fecha, obra, totalCantidad, totalCobrar, totalPagado, status, 
+             clientesAdicionales_json, detalles_json, content_hash, version, registro_id)
+        )
+        _replace_registro_items(resumen_cursor, registro_id, user_id, detalles)
+        _resumen_add(resumen_cursor, user_id, dict(registro), sign=-1)
+        _resumen_add(resumen_cursor, user_id, body)
+        conn.commit()
+        
+        return {"success": True}
+
+
+@app.delete("/api/registros/{registro_id}")
+def delete_registro(registro_id: int, username: str):
+    """Elimina un registro."""
+    try:
         with get_db() as conn:
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
             
-            # Verificar que el registro pertenece al usuario
-            registro = conn.execute(
-                "SELECT id FROM registros WHERE id = ? AND user_id = ?",
-                (registro_id, user["id"])
-            ).fetchone()
-            
-            if not registro:
+            # Eliminar (con sus items) y descontar del resumen; si no existe,
+            # get_db revierte la versión
+            cursor = conn.cursor()
+            version = _bump_data_version(cursor, user_id, "registros")
+            if not _delete_where(cursor, user_id, "registros", "id = ? AND user_id = ?", (registro_id, user_id), version):
                 raise HTTPException(status_code=404, detail={"message": "Registro no encontrado"})
-            
-            # Convertir listas a JSON
-            clientesAdicionales_json = json.dumps(clientesAdicionales) if clientesAdicionales else None
-            detalles_json = json.dumps(detalles) if detalles else None
-            
-            # Actualizar registro
-            conn.execute(
-                """UPDATE registros 
-                   SET fecha = ?, obra = ?, totalCantidad = ?, totalCobrar = ?, 
-                       totalPagado = ?, status = ?, clientesAdicionales = ?, detalles = ?
-                   WHERE id = ?""",
-                (fecha, obra, totalCantidad, totalCobrar, totalPagado, status, 
-                 clientesAdicionales_json, detalles_json, registro_id)
-            )
             conn.commit()
             
             return {"success": True}
     except HTTPException:
         raise
-    except Exception as e:
-        logger.error(f"Error al actualizar registro: {e}")
-        raise HTTPException(status_code=500, detail={"message": f"Error al actualizar registro: {str(e)}"})
-
-
-@app.delete("/api/registros/{registro_id}")
-async def delete_registro(registro_id: int, username: str):
-    """Elimina un registro."""
-    try:
-        with get_db() as conn:
-            # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
-            
-            # Verificar y eliminar
-            result = conn.execute(
-                "DELETE FROM registros WHERE id = ? AND user_id = ?",
-                (registro_id, user["id"])
-            )
-            conn.commit()
-            
-            if result.rowcount == 0:
-                raise HTTPException(status_code=404, detail={"message": "Registro no encontrado"})
-            
-            return {"success": True}
-    except HTTPException:
-        raise
     except Exception as e:
         logger.error(f"Error al eliminar registro: {e}")
         raise HTTPException(status_code=500, detail={"message": "Error al eliminar registro"})
@@ -1337,88 +2753,126 @@ async def delete_registro(registro_id: int, username: str):
 # ENDPOINT PARA REPORTES/ESTADÍSTICAS
 # ===============================================
 
+def _registros_where(user_id, obra=None, fecha_inicio=None, fecha_fin=None, prefix="", sin_fecha=False):
+    """Arma la cláusula WHERE (con placeholders ?) para filtrar los registros de un usuario.
+
+    prefix califica las columnas cuando la consulta une varias tablas (p.ej. "r.").
+    Con sin_fecha=True el rango de fechas no excluye los registros sin fecha,
+    como hace el dashboard en las vistas General y Detallado.
+    """
+    where = f"{prefix}user_id = ?"
+    params = [user_id]
+
+    if obra:
+        where += f" AND {prefix}obra = ?"
+        params.append(obra)
+
+    for valor, op in ((fecha_inicio, ">="), (fecha_fin, "<=")):
+        if not valor:
+            continue
+        condition = f"{prefix}fecha {op} ?"
+        if sin_fecha:
+            condition = f"({prefix}fecha IS NULL OR {prefix}fecha = '' OR {condition})"
+        where += f" AND {condition}"
+        params.append(valor)
+
+    return where, params
+
+
+def _report_totals(row):
+    """Convierte una fila agregada (cobrar, pagado, cantidad) al formato de reportes."""
+    cobrar = row["cobrar"] or 0
+    pagado = row["pagado"] or 0
+    return {
+        'totalCobrar': cobrar,
+        'totalCobrado': pagado,
+        'totalPendiente': cobrar - pagado,
+        'totalCantidad': row["cantidad"] or 0
+    }
+
+
+def _resumen_where(user_id, obra=None, fecha_inicio=None, fecha_fin=None):
+    """Igual que _registros_where pero para registros_resumen."""
+    where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin)
+    if fecha_inicio or fecha_fin:
+        # En el resumen las fechas nulas se guardan como '' y no deben entrar en un rango
+        where += " AND fecha <> ''"
+    return where, params
+
+
+def _report_group_by(cursor, key, empty_label, where, params, order):
+    """Totales agrupados por obra o fecha, leídos de registros_resumen."""
+    # Alias en minúsculas: PostgreSQL pliega los identificadores sin comillas
+    cursor.execute(*sql(
+        f"""SELECT COALESCE(NULLIF({key}, ''), ?) AS clave,
+                   SUM(totalCobrar) AS cobrar,
+                   SUM(totalPagado) AS pagado,
+                   SUM(totalCantidad) AS cantidad
+            FROM registros_resumen
+            WHERE {where}
+            GROUP BY 1
+            ORDER BY clave {order}""",
+        [empty_label] + params
+    ))
+    return {row["clave"]: _report_totals(row) for row in cursor.fetchall()}
+
+
 @app.get("/api/reportes")
-async def get_reportes(username: str, obra: str = None, fecha_inicio: str = None, fecha_fin: str = None):
-    """Genera estadísticas y reportes basados en los registros."""
+def get_reportes(request: Request, username: str, obra: str = None, fecha_inicio: str = None, fecha_fin: str = None, incluir_registros: bool = False):
+    """Genera estadísticas y reportes basados en los registros.
+
+    Los totales se leen de registros_resumen, así el costo depende de la
+    cantidad de días y obras y no de la cantidad de registros. Las filas
+    individuales solo se devuelven si se pide incluir_registros=true.
+    """
     try:
         with get_db() as conn:
+            cursor = conn.cursor()
             # Obtener user_id
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "registros")
+            if not_modified:
+                return not_modified
             
-            # Construir query con filtros
-            query = "SELECT fecha, obra, totalCantidad, totalCobrar, totalPagado, status FROM registros WHERE user_id = ?"
-            params = [user["id"]]
-            
-            if obra:
-                query += " AND obra = ?"
-                params.append(obra)
-            
-            if fecha_inicio:
-                query += " AND fecha >= ?"
-                params.append(fecha_inicio)
-            
-            if fecha_fin:
-                query += " AND fecha <= ?"
-                params.append(fecha_fin)
+            where, params = _resumen_where(user_id, obra, fecha_inicio, fecha_fin)
             
-            query += " ORDER BY fecha DESC"
-            
-            # Obtener registros
-            cursor = conn.execute(query, params)
-            registros = [dict(row) for row in cursor.fetchall()]
-            
-            # Calcular estadísticas
-            total_cobrar = sum(r['totalCobrar'] or 0 for r in registros)
-            total_cobrado = sum(r['totalPagado'] or 0 for r in registros)
-            total_pendiente = total_cobrar - total_cobrado
-            total_cantidad = sum(r['totalCantidad'] or 0 for r in registros)
-            
-            # Agrupar por obra
-            por_obra = {}
-            for r in registros:
-                obra_nombre = r['obra'] or 'Sin obra'
-                if obra_nombre not in por_obra:
-                    por_obra[obra_nombre] = {
-                        'totalCobrar': 0,
-                        'totalCobrado': 0,
-                        'totalPendiente': 0,
-                        'totalCantidad': 0
-                    }
-                por_obra[obra_nombre]['totalCobrar'] += r['totalCobrar'] or 0
-                por_obra[obra_nombre]['totalCobrado'] += r['totalPagado'] or 0
-                por_obra[obra_nombre]['totalPendiente'] += (r['totalCobrar'] or 0) - (r['totalPagado'] or 0)
-                por_obra[obra_nombre]['totalCantidad'] += r['totalCantidad'] or 0
+            # Totales generales
+            cursor.execute(*sql(
+                f"""SELECT SUM(totalCobrar) AS cobrar,
+                           SUM(totalPagado) AS pagado,
+                           SUM(totalCantidad) AS cantidad,
+                           SUM(registros) AS registros
+                    FROM registros_resumen
+                    WHERE {where}""",
+                params
+            ))
+            row = cursor.fetchone()
+            totales = _report_totals(row)
+            totales['totalRegistros'] = row["registros"] or 0
             
-            # Agrupar por fecha
-            por_fecha = {}
-            for r in registros:
-                fecha = r['fecha'] or 'Sin fecha'
-                if fecha not in por_fecha:
-                    por_fecha[fecha] = {
-                        'totalCobrar': 0,
-                        'totalCobrado': 0,
-                        'totalPendiente': 0,
-                        'totalCantidad': 0
-                    }
-                por_fecha[fecha]['totalCobrar'] += r['totalCobrar'] or 0
-                por_fecha[fecha]['totalCobrado'] += r['totalPagado'] or 0
-                por_fecha[fecha]['totalPendiente'] += (r['totalCobrar'] or 0) - (r['totalPagado'] or 0)
-                por_fecha[fecha]['totalCantidad'] += r['totalCantidad'] or 0
+            # Agrupar por obra y por fecha
+            por_obra = _report_group_by(cursor, "obra", "Sin obra", where, params, "ASC")
+            por_fecha = _report_group_by(cursor, "fecha", "Sin fecha", where, params, "DESC")
             
-            return {
-                "totales": {
-                    "totalCobrar": total_cobrar,
-                    "totalCobrado": total_cobrado,
-                    "totalPendiente": total_pendiente,
-                    "totalCantidad": total_cantidad,
-                    "totalRegistros": len(registros)
-                },
+            result = {
+                "totales": totales,
                 "porObra": por_obra,
-                "porFecha": por_fecha,
-                "registros": registros
+                "porFecha": por_fecha
             }
+            
+            if incluir_registros:
+                where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin)
+                columns = ["fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status"]
+                rows_cursor = _tuple_cursor(conn)
+                rows_cursor.execute(*sql(
+                    f"SELECT {', '.join(columns)} FROM registros WHERE {where} ORDER BY fecha DESC",
+                    params
+                ))
+                result["registros"] = [dict(zip(columns, row)) for row in rows_cursor.fetchall()]
+            
+            return FastJSONResponse(result, headers=cache_headers)
     except HTTPException:
         raise
     except Exception as e:
@@ -1426,338 +2880,2109 @@ async def get_reportes(username: str, obra: str = None, fecha_inicio: str = None
         raise HTTPException(status_code=500, detail={"message": "Error al generar reportes"})
 
 
-@app.post("/api/import-backup")
-async def import_backup(request: Request):
-    """Importa clientes, obras, productos, registros en bulk desde un JSON."""
+# Agrupaciones permitidas en /api/reportes/items (columna de registro_items)
+REPORTE_ITEMS_AGRUPACIONES = {"producto": "Sin producto", "cliente": "Sin cliente", "tipo": "Sin tipo"}
+
+
+@app.get("/api/reportes/items")
+def get_reportes_items(request: Request, username: str, agrupar: str = "producto", obra: str = None, fecha_inicio: str = None, fecha_fin: str = None):
+    """Totales por producto, cliente o tipo de item, calculados desde registro_items."""
     try:
-        import json
-        body = await request.json()
-        
-        username = body.get('username')
-        clientes_data = body.get('clientes', [])
-        obras_data = body.get('obras', [])
-        productos_data = body.get('productos', [])
-        registros_data = body.get('registros', [])
-        
+        if agrupar not in REPORTE_ITEMS_AGRUPACIONES:
+            raise HTTPException(
+                status_code=400,
+                detail={"message": f"agrupar debe ser uno de: {', '.join(REPORTE_ITEMS_AGRUPACIONES)}"}
+            )
         with get_db() as conn:
-            user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-            if not user:
+            cursor = conn.cursor()
+            user_id = get_user_id(conn, username)
+            if user_id is None:
                 raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
-            
-            user_id = user["id"]
-            counts = {"clientes": 0, "obras": 0, "productos": 0, "registros": 0}
-            
-            for c in clientes_data:
-                try:
-                    conn.execute(
-                        "INSERT INTO clientes (user_id, nombre, cedula, obra, estado, fecha) VALUES (?, ?, ?, ?, ?, ?)",
-                        (user_id, c.get("nombre", ""), c.get("cedula"), c.get("obra"), c.get("estado", "activo"), c.get("fecha"))
-                    )
-                    counts["clientes"] += 1
-                except Exception as e:
-                    logger.warning(f"Error importing cliente: {e}")
-            
-            for o in obras_data:
-                try:
-                    conn.execute(
-                        "INSERT INTO obras (user_id, nombre, ubicacion, estado) VALUES (?, ?, ?, ?)",
-                        (user_id, o.get("nombre", ""), o.get("ubicacion"), o.get("estado", "activa"))
-                    )
-                    counts["obras"] += 1
-                except Exception as e:
-                    logger.warning(f"Error importing obra: {e}")
-            
-            for p in productos_data:
-                try:
-                    conn.execute(
-                        "INSERT INTO productos (user_id, nombre, precio) VALUES (?, ?, ?)",
-                        (user_id, p.get("nombre", ""), float(p.get("precio", 0)))
-                    )
-                    counts["productos"] += 1
-                except Exception as e:
-                    logger.warning(f"Error importing producto: {e}")
-            
-            for r in registros_data:
-                try:
-                    detalles = r.get("items") or r.get("detalles") or []
-                    detalles_json = json.dumps(detalles) if detalles else None
-                    
-                    adicionales = []
-                    for it in detalles:
-                        if str(it.get("tipo", "")).lower() == "adicional":
-                            adicionales.append({"cliente": it.get("cliente"), "valor": it.get("costo", it.get("precio", 0))})
-                    adicionales_json = json.dumps(adicionales) if adicionales else None
-                    
-                    conn.execute(
-                        """INSERT INTO registros 
-                           (user_id, fecha, obra, totalCantidad, totalCobrar, totalPagado, status, clientesAdicionales, detalles)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (user_id, r.get("fecha"), r.get("obra"), r.get("totalCantidad", 0), 
-                         r.get("totalCobrar", 0), r.get("totalPagado", 0), r.get("status", "pendiente"),
-                         adicionales_json, detalles_json)
-                    )
-                    counts["registros"] += 1
-                except Exception as e:
-                    logger.warning(f"Error importing registro: {e}")
-            
-            conn.commit()
-            return {"success": True, "imported": counts}
+            cache_headers, not_modified = _conditional_get(request, conn, user_id, "registros")
+            if not_modified:
+                return not_modified
+
+            where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin, prefix="r.")
+            cursor.execute(*sql(
+                f"""SELECT COALESCE(NULLIF(i.{agrupar}, ''), ?) AS clave,
+                           SUM(i.cantidad) AS cantidad,
+                           SUM(i.cantidad * i.precio) AS total,
+                           SUM(COALESCE(i.costo, 0)) AS costo,
+                           COUNT(DISTINCT i.registro_id) AS registros
+                    FROM registro_items i
+                    JOIN registros r ON r.id = i.registro_id
+                    WHERE {where}
+                    GROUP BY 1
+                    ORDER BY total DESC, clave ASC""",
+                [REPORTE_ITEMS_AGRUPACIONES[agrupar]] + params
+            ))
+            items = {
+                row["clave"]: {
+                    "cantidad": row["cantidad"] or 0,
+                    "total": row["total"] or 0,
+                    "costo": row["costo"] or 0,
+                    "registros": row["registros"],
+                }
+                for row in cursor.fetchall()
+            }
+            return FastJSONResponse({"agrupar": agrupar, "items": items}, headers=cache_headers)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error en import-backup: {e}")
-        raise HTTPException(status_code=500, detail={"message": f"Error al importar: {str(e)}"})
+        logger.error(f"Error al generar reporte por items: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al generar reporte por items"})
 
 
-# ----- Endpoints de Administración (con clave secreta) -----
-ADMIN_SECRET = os.getenv("ADMIN_SECRET", "admin_secret_key_2026")
+# ===============================================
+# SINCRONIZACIÓN
+# ===============================================
 
-@app.post("/api/admin/verify-password")
-async def admin_verify_password(
-    username: str = Form(...),
-    password: str = Form(...),
-    admin_secret: str = Form(...)
-):
-    """Endpoint de administración para verificar si una contraseña es correcta."""
-    if admin_secret != ADMIN_SECRET:
-        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
-    
+@app.get("/api/sync/version")
+def get_sync_version(username: str):
+    """Versión de los datos del usuario, general y por entidad.
+
+    Permite saber si algo cambió sin descargar las tablas: si la versión de
+    una entidad es la misma que en la última lectura, su listado no cambió.
+    """
     try:
         with get_db() as conn:
-            cursor = conn.execute(
-                "SELECT password_hash FROM users WHERE username = ?",
-                (username,)
-            )
-            row = cursor.fetchone()
-            
-            if not row:
-                return {"success": False, "message": f"Usuario '{username}' no encontrado"}
-            
-            password_hash = row["password_hash"]
-            is_valid = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
-            
-            return {
-                "success": True,
-                "username": username,
-                "password_valid": is_valid,
-                "message": "Contraseña correcta" if is_valid else "Contraseña incorrecta"
-            }
+            user_id = get_user_id(conn, username)
+            if user_id is None:
+                raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            version, entidades = _data_versions(conn, user_id)
+            return FastJSONResponse({"version": version, "entidades": entidades},
+                                    headers={"Cache-Control": "no-store"})
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error verificando contraseña: {e}")
-        raise HTTPException(status_code=500, detail={"message": str(e)})
+        logger.error(f"Error al obtener versión de datos: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al obtener versión de datos"})
 
 
-@app.post("/api/admin/reset-password")
-async def admin_reset_password(
-    username: str = Form(...),
-    new_password: str = Form(...),
-    admin_secret: str = Form(...)
-):
-    """Endpoint de administración para resetear contraseña de un usuario."""
-    if admin_secret != ADMIN_SECRET:
-        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
-    
-    if len(new_password) < 6:
-        raise HTTPException(status_code=400, detail={"message": "La contraseña debe tener al menos 6 caracteres"})
-    
+# GET /api/sync?since=N devuelve las filas con version > N (altas y cambios)
+# y los ids eliminados desde N (tombstones), hasta la versión actual. El
+# cliente guarda "version" de la respuesta y la envía como since la próxima
+# vez. Las páginas recorren las entidades y luego tombstones en orden de
+# (version, id); el cursor fija la versión tope de la primera página, así
+# lo escrito mientras se pagina queda para la siguiente sincronización.
+# Los tombstones se borran tras SYNC_TOMBSTONE_DAYS (al arrancar y luego
+# desde /api/sync cada SYNC_PURGE_INTERVAL segundos); users.sync_floor guarda
+# la mayor versión borrada y un since menor recibe la copia completa.
+
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "90"))
+SYNC_PURGE_INTERVAL = int(os.getenv("SYNC_PURGE_INTERVAL", "3600"))
+
+SYNC_COLUMNS = {
+    "clientes": ("id", "nombre", "cedula", "obra", "estado", "fecha", "created_at", "updated_at"),
+    "obras": ("id", "nombre", "ubicacion", "estado", "created_at", "updated_at"),
+    "productos": ("id", "nombre", "precio", "created_at", "updated_at"),
+    "registros": ("id", "fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status",
+                  "clientesAdicionales", "detalles", "created_at", "updated_at"),
+}
+SYNC_SOURCES = DATA_ENTITIES + ("tombstones",)
+
+
+def _sync_source_query(fuente):
+    """SELECT de una fuente de cambios: columnas y luego version, id."""
+    if fuente == "tombstones":
+        select = "entidad, entidad_id"
+    else:
+        columns = SYNC_COLUMNS[fuente]
+        if fuente == "registros" and USE_POSTGRES:
+            columns = [f'{c}::text AS "{c}"' if c in REGISTROS_JSON_COLUMNS else f'{c} AS "{c}"' for c in columns]
+        else:
+            columns = [f'{c} AS "{c}"' for c in columns]
+        select = ", ".join(columns)
+    return f"""SELECT {select}, version AS _k0, id AS _k1 FROM {fuente}
+               WHERE user_id = ? AND version > ? AND version <= ? AND (version, id) > (?, ?)
+               ORDER BY _k0, _k1 LIMIT ?"""
+
+
+def _sync_changes(conn, user_id, since, limit, cursor=None):
+    """Una página de cambios. Devuelve (hasta, completo, cambios, eliminados, next_cursor)."""
+    cur = conn.cursor()
+    if cursor:
+        hasta, desde, inicio, ultima_version, ultimo_id = _decode_cursor(cursor, 5)
+        if not all(isinstance(v, int) for v in (hasta, desde, inicio, ultima_version, ultimo_id)) \
+                or not 0 <= inicio < len(SYNC_SOURCES):
+            raise HTTPException(status_code=400, detail={"message": "Cursor inválido"})
+    else:
+        cur.execute(*sql("SELECT data_version, sync_floor FROM users WHERE id = ?", (user_id,)))
+        row = cur.fetchone()
+        hasta = row["data_version"]
+        # Sin los tombstones ya purgados (o con una versión que no es de este
+        # usuario) no se pueden calcular las bajas: se envía todo
+        desde = since if row["sync_floor"] <= since <= hasta else 0
+        inicio, ultima_version, ultimo_id = 0, desde, 0
+    completo = desde == 0
+
+    cambios = {e: [] for e in DATA_ENTITIES}
+    eliminados = {e: [] for e in DATA_ENTITIES}
+    restantes = limit
+    next_cursor = None
+    fuentes = DATA_ENTITIES if completo else SYNC_SOURCES
+    tuples = _tuple_cursor(conn)
+    for indice in range(inicio, len(fuentes)):
+        fuente = fuentes[indice]
+        if indice > inicio:
+            ultima_version, ultimo_id = desde, 0
+        tuples.execute(*sql(_sync_source_query(fuente),
+                            (user_id, desde, hasta, ultima_version, ultimo_id, restantes + 1)))
+        rows = tuples.fetchall()
+        mas = len(rows) > restantes
+        rows = rows[:restantes]
+        if fuente == "tombstones":
+            # Si una purga corrió entre la lectura de sync_floor y la de los
+            # tombstones, pueden faltar bajas: el cliente debe empezar de nuevo
+            cur.execute(*sql("SELECT sync_floor FROM users WHERE id = ?", (user_id,)))
+            if cur.fetchone()["sync_floor"] > desde:
+                raise HTTPException(
+                    status_code=409,
+                    detail={"message": "Se purgaron bajas durante la sincronización; vuelve a sincronizar"}
+                )
+            for entidad, entidad_id, _, _ in rows:
+                eliminados[entidad].append(entidad_id)
+        else:
+            columns = SYNC_COLUMNS[fuente]
+            cambios[fuente].extend(dict(zip(columns, row)) for row in rows)
+        restantes -= len(rows)
+        if mas:
+            next_cursor = _encode_cursor([hasta, desde, indice, rows[-1][-2], rows[-1][-1]])
+            break
+        if restantes == 0 and indice + 1 < len(fuentes):
+            next_cursor = _encode_cursor([hasta, desde, indice + 1, desde, 0])
+            break
+    return hasta, completo, cambios, eliminados, next_cursor
+
+
+@app.get("/api/sync")
+def get_sync(username: str, since: int = 0, limit: int = PAGE_MAX_LIMIT, cursor: str = None):
+    """Cambios de los datos del usuario desde la versión `since`.
+
+    Devuelve version (el since de la próxima llamada), completo (true si es
+    la copia entera y el cliente debe reemplazar la suya), cambios (filas
+    nuevas o modificadas por entidad), eliminados (ids por entidad) y
+    next_cursor mientras queden páginas.
+    """
+    if since < 0:
+        raise HTTPException(status_code=400, detail={"message": "since no puede ser negativo"})
+    if not 1 <= limit <= PAGE_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail={"message": f"limit debe estar entre 1 y {PAGE_MAX_LIMIT}"})
+    _purge_tombstones_due()
     try:
         with get_db() as conn:
-            # Verificar que usuario existe
-            cursor = conn.execute("SELECT id FROM users WHERE username = ?", (username,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=404, detail={"message": f"Usuario '{username}' no encontrado"})
-            
-            # Hashear nueva contraseña
-            password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            
-            # Actualizar contraseña
-            conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (password_hash, username))
-            conn.commit()
-            
-            logger.info(f"Contraseña reseteada exitosamente para usuario: {username}")
-            return {
-                "success": True,
-                "message": f"Contraseña actualizada para '{username}'",
-                "username": username
-            }
+            user_id = get_user_id(conn, username)
+            if user_id is None:
+                raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            hasta, completo, cambios, eliminados, next_cursor = _sync_changes(conn, user_id, since, limit, cursor)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error reseteando contraseña: {e}")
-        raise HTTPException(status_code=500, detail={"message": str(e)})
+        logger.error(f"Error al sincronizar datos: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al sincronizar datos"})
 
+    # Los registros llevan sus columnas JSON sin decodificar, como en /api/registros
+    partes = [b'"%s":[%s]' % (e.encode("ascii"), b",".join(_json_bytes(f) for f in cambios[e]))
+              for e in DATA_ENTITIES if e != "registros"]
+    partes.append(b'"registros":[' + b",".join(_registro_json(r) for r in cambios["registros"]) + b"]")
+    body = (b'{"version":' + _json_bytes(hasta)
+            + b',"completo":' + _json_bytes(completo)
+            + b',"cambios":{' + b",".join(partes) + b"}"
+            + b',"eliminados":' + _json_bytes(eliminados)
+            + b',"next_cursor":' + _json_bytes(next_cursor) + b"}")
+    return Response(content=body, media_type="application/json", headers={"Cache-Control": "no-store"})
 
-@app.get("/api/admin/list-users")
-async def admin_list_users(admin_secret: str):
-    """Lista todos los usuarios (solo email y username, sin contraseñas)."""
-    if admin_secret != ADMIN_SECRET:
-        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
-    
+
+@app.on_event("startup")
+def purge_tombstones():
+    """Borra los tombstones de más de SYNC_TOMBSTONE_DAYS días y sube sync_floor."""
+    limite = (datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
     try:
         with get_db() as conn:
-            cursor = conn.execute(
-                "SELECT id, email, username, birthdate, created_at FROM users ORDER BY created_at DESC"
-            )
-            users = []
-            for row in cursor.fetchall():
-                users.append({
-                    "id": row["id"],
-                    "email": row["email"],
-                    "username": row["username"],
-                    "birthdate": row["birthdate"],
-                    "created_at": row["created_at"]
-                })
-            
-            return {"success": True, "users": users, "count": len(users)}
+            cursor = conn.cursor()
+            cursor.execute(*sql(
+                """UPDATE users SET sync_floor = (
+                       SELECT MAX(version) FROM tombstones WHERE tombstones.user_id = users.id AND deleted_at < ?)
+                   WHERE id IN (SELECT user_id FROM tombstones WHERE deleted_at < ?)""",
+                (limite, limite)
+            ))
+            cursor.execute(*sql("DELETE FROM tombstones WHERE deleted_at < ?", (limite,)))
+            conn.commit()
+            if cursor.rowcount:
+                logger.info(f"{cursor.rowcount} tombstones de sincronización purgados")
     except Exception as e:
-        logger.error(f"Error listando usuarios: {e}")
-        raise HTTPException(status_code=500, detail={"message": str(e)})
+        logger.error(f"No se pudieron purgar los tombstones: {e}")
 
 
-# Exportar Excel con estilos profesionales completos
-@app.post("/api/reportes/export-excel")
-async def export_reportes_excel(request: Request):
-    """Genera archivo Excel con estilos completos usando openpyxl.
-    
-    Formato garantizado:
-    - Usuario: Arial 12, Negrita, Centrado, Celda combinada
-    - Título: Arial 18, Negrita, Centrado, Celda combinada
-    - Fechas: Arial 12, Negrita, Centrado, Celda combinada
-    - Encabezados de columnas: Arial 11, Negrita, Fondo gris
-    - Datos: Arial 10
-    - Totales: Negrita, Fondo gris
+# El arranque ya purgó: la próxima purga toca dentro de un intervalo
+_tombstones_lock = threading.Lock()
+_tombstones_next_purge = time.monotonic() + SYNC_PURGE_INTERVAL
+
+
+def _purge_tombstones_due():
+    """Purga los tombstones si pasó SYNC_PURGE_INTERVAL desde la última vez.
+
+    Los servidores que corren meses sin reiniciar también aplican
+    SYNC_TOMBSTONE_DAYS. Solo la petición que reserva el turno purga; las
+    demás siguen sin esperar.
     """
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-        from openpyxl.utils import get_column_letter
-        from fastapi.responses import Response
-        import io
+    global _tombstones_next_purge
+    with _tombstones_lock:
+        if time.monotonic() < _tombstones_next_purge:
+            return
+        _tombstones_next_purge = time.monotonic() + SYNC_PURGE_INTERVAL
+    purge_tombstones()
 
-        data = await request.json()
-        rows = data.get('rows', [])
-        headers = data.get('headers', [])
-        username = data.get('username', 'Usuario')
-        title = data.get('title', 'Reporte')
-        date_range = data.get('date_range', '')
-        currency_cols = data.get('currency_cols', [])
-        mode = data.get('mode', 'general')
-        totals = data.get('totals', None)
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'Reportes'
-
-        # Definir estilos profesionales
-        font_usuario = Font(name='Arial', bold=True, size=12)
-        font_titulo = Font(name='Arial', bold=True, size=18)
-        font_fechas = Font(name='Arial', bold=True, size=12)
-        font_col_header = Font(name='Arial', bold=True, size=11)
-        font_data = Font(name='Arial', size=10)
-        font_totals = Font(name='Arial', bold=True, size=10)
-        
-        align_center = Alignment(horizontal='center', vertical='center')
-        align_left = Alignment(horizontal='left', vertical='center')
-        align_right = Alignment(horizontal='right', vertical='center')
-        
-        fill_gray = PatternFill(start_color='F0F0F0', end_color='F0F0F0', fill_type='solid')
-        fill_header = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
-        
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
 
-        # Fila 1: Usuario (combinar celdas)
-        ws.merge_cells(f'A1:{get_column_letter(len(headers))}1')
-        cell = ws['A1']
-        cell.value = username
-        cell.font = font_usuario
-        cell.alignment = align_center
-
-        # Fila 2: Título (combinar celdas)
-        ws.merge_cells(f'A2:{get_column_letter(len(headers))}2')
-        cell = ws['A2']
-        cell.value = title
-        cell.font = font_titulo
-        cell.alignment = align_center
-
-        # Fila 3: Rango de fechas (combinar celdas)
-        ws.merge_cells(f'A3:{get_column_letter(len(headers))}3')
-        cell = ws['A3']
-        cell.value = date_range
-        cell.font = font_fechas
-        cell.alignment = align_center
-
-        # Fila 4: vacía (espacio)
-        
-        # Fila 5: Encabezados de columnas
-        for col_idx, header in enumerate(headers, start=1):
-            cell = ws.cell(row=5, column=col_idx, value=header)
-            cell.font = font_col_header
-            cell.alignment = align_center
-            cell.fill = fill_header
-            cell.border = thin_border
-
-        # Filas 6+: Datos
-        for r_idx, row in enumerate(rows, start=6):
-            for c_idx, value in enumerate(row, start=1):
-                cell = ws.cell(row=r_idx, column=c_idx, value=value)
-                cell.font = font_data
-                cell.border = thin_border
-                
-                # Alineación según tipo de dato
-                if (c_idx - 1) in currency_cols:
-                    cell.alignment = align_right
-                    if isinstance(value, (int, float)):
-                        cell.number_format = '#,##0.00'
-                elif headers[c_idx - 1] in ['Estado']:
-                    cell.alignment = align_center
-                else:
-                    cell.alignment = align_left
-
-        # Fila de totales (si existe)
-        if totals:
-            totals_row = len(rows) + 6
-            for c_idx, value in enumerate(totals, start=1):
-                cell = ws.cell(row=totals_row, column=c_idx, value=value)
-                cell.font = font_totals
-                cell.fill = fill_gray
-                cell.border = thin_border
-                
-                if (c_idx - 1) in currency_cols and isinstance(value, (int, float)):
-                    cell.alignment = align_right
-                    cell.number_format = '#,##0.00'
-                else:
-                    cell.alignment = align_right if c_idx > 1 else align_left
+# ===============================================
+# IMPORTACIÓN MASIVA
+# ===============================================
+# Cada fila del respaldo se valida y normaliza primero; las válidas se
+# insertan por lotes (executemany en SQLite, execute_values en PostgreSQL)
+# y las inválidas se devuelven en `rechazados` con el motivo.
 
-        # Ajustar anchos de columna por modo
-        col_widths_map = {
-            'general': [16, 22, 12, 16, 16, 16, 12],
-            'detallado': [16, 22, 16, 22, 12, 16, 16, 16, 12],
-            'diario': [22, 22] + [14] * max(0, (len(headers) - 3)) + [16]
-        }
-        widths = col_widths_map.get(mode, [16] * len(headers))
-        for c_idx, width in enumerate(widths, start=1):
-            if c_idx <= len(headers):
-                ws.column_dimensions[get_column_letter(c_idx)].width = width
-
-        # Generar archivo
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
-
-        filename = f"reportes_{mode}_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
-        return Response(
-            content=buf.getvalue(),
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename=\"{filename}\""}
-        )
+IMPORT_ENTITIES = ("clientes", "obras", "productos", "registros")
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+
+# entidad -> (tabla, columnas, normalizador)
+IMPORT_TABLES = {
+    "clientes": ("clientes", ("nombre", "cedula", "obra", "estado", "fecha"), _normalize_cliente),
+    "obras": ("obras", ("nombre", "ubicacion", "estado"), _normalize_obra),
+    "productos": ("productos", ("nombre", "precio"), _normalize_producto),
+    "registros": ("registros", ("fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status",
+                                "clientesAdicionales", "detalles"), _normalize_registro),
+}
+
+
+def _bulk_insert(cursor, table, columns, rows, returning_ids=False):
+    """Inserta filas por lotes de IMPORT_BATCH_SIZE.
+
+    Con returning_ids devuelve los ids generados, en el orden de las filas.
+    """
+    ids = []
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+    for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+        batch = rows[start:start + IMPORT_BATCH_SIZE]
+        if USE_POSTGRES:
+            if returning_ids:
+                result = execute_values(cursor, query + "%s RETURNING id", batch, page_size=len(batch), fetch=True)
+                ids.extend(row["id"] for row in result)
+            else:
+                execute_values(cursor, query + "%s", batch, page_size=len(batch))
+        else:
+            cursor.executemany(query + f"({', '.join('?' for _ in columns)})", batch)
+            if returning_ids:
+                # La transacción tiene el bloqueo de escritura, así que los ids
+                # AUTOINCREMENT del lote son consecutivos y terminan en seq.
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+                last_id = cursor.fetchone()["seq"]
+                ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+    return ids
+
+
+def _existing_counts(cursor, table, user_id, hashes):
+    """Cuántas filas del usuario tienen cada contenido de `hashes` ({hash: filas})."""
+    hashes = list(hashes)
+    counts = {}
+    for start in range(0, len(hashes), IMPORT_BATCH_SIZE):
+        chunk = hashes[start:start + IMPORT_BATCH_SIZE]
+        cursor.execute(*sql(
+            f"""SELECT content_hash, COUNT(*) AS n FROM {table}
+                WHERE user_id = ? AND content_hash IN ({', '.join('?' for _ in chunk)})
+                GROUP BY content_hash""",
+            [user_id] + chunk
+        ))
+        counts.update((row["content_hash"], row["n"]) for row in cursor.fetchall())
+    return counts
+
+
+def _import_records(cursor, user_id, entidad, records, offset=0, ocurrencias=None):
+    """Valida e inserta un lote de una entidad. Devuelve (insertados, omitidos, rechazados).
+
+    offset es el índice de la primera fila del lote dentro del respaldo.
+    Las filas repetidas se comparan por cantidad: la n-ésima copia de un
+    contenido en el respaldo se omite si el usuario ya tiene n filas con ese
+    contenido. Así reimportar un respaldo no duplica, y las filas que el
+    respaldo trae repetidas (dos ventas iguales el mismo día) se conservan.
+    ocurrencias ({hash: copias vistas}) lleva la cuenta entre lotes del
+    mismo respaldo.
+    """
+    if ocurrencias is None:
+        ocurrencias = {}
+    table, columns, normalize = IMPORT_TABLES[entidad]
+    rows = []
+    hashes = []
+    rechazados = []
+    for index, record in enumerate(records, offset):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("se esperaba un objeto")
+            row = normalize(record)
+        except ValueError as e:
+            rechazados.append({"entidad": entidad, "indice": index, "motivo": str(e)})
+            continue
+        rows.append(row)
+        hashes.append(_content_hash(entidad, row))
+    
+    # Bloquear antes de contar: un reintento simultáneo del mismo respaldo
+    # espera al commit y ve las filas ya insertadas
+    _lock_user(cursor, user_id)
+    existentes = _existing_counts(cursor, table, user_id, set(hashes))
+    nuevos = []
+    for row, digest in zip(rows, hashes):
+        copia = ocurrencias[digest] = ocurrencias.get(digest, 0) + 1
+        if copia <= existentes.get(digest, 0):
+            continue
+        existentes[digest] = copia
+        nuevos.append((row, digest))
+    omitidos = len(rows) - len(nuevos)
+    rows = [row for row, _ in nuevos]
+    
+    if not rows:
+        return 0, omitidos, rechazados
+    version = _bump_data_version(cursor, user_id, entidad)
+    sync = (version, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+    insert_columns = ("user_id",) + columns + ("content_hash", "version", "updated_at")
+    
+    if entidad != "registros":
+        _bulk_insert(cursor, table, insert_columns, [(user_id,) + row + (digest,) + sync for row, digest in nuevos])
+        return len(rows), omitidos, rechazados
+    
+    values = [(user_id,) + tuple(r[c] for c in columns) + (digest,) + sync for r, digest in nuevos]
+    ids = _bulk_insert(cursor, table, insert_columns, values, returning_ids=True)
+    
+    items = []
+    resumen = {}
+    for registro_id, r in zip(ids, rows):
+        items.extend((registro_id, user_id) + item for item in _registro_items(r["items"]))
+        delta = resumen.setdefault((r["obra"], r["fecha"]), [0.0, 0.0, 0.0, 0])
+        delta[0] += r["totalCobrar"]
+        delta[1] += r["totalPagado"]
+        delta[2] += r["totalCantidad"]
+        delta[3] += 1
+    _bulk_insert(cursor, "registro_items",
+                 ("registro_id", "user_id", "posicion", "tipo", "cliente", "producto", "cantidad", "precio", "costo"),
+                 items)
+    
+    # Actualizar el resumen una vez por (obra, fecha)
+    for (obra, fecha), (cobrar, pagado, cantidad, n) in resumen.items():
+        _resumen_apply(cursor, user_id, obra, fecha, cobrar, pagado, cantidad, n)
+    
+    return len(rows), omitidos, rechazados
+
+
+@app.post("/api/import-backup")
+async def import_backup(request: Request):
+    """Importa clientes, obras, productos, registros en bulk desde un JSON."""
+    try:
+        body = await request.json()
+        return await run_in_threadpool(_import_backup, body)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error en export_reportes_excel: {e}")
-        raise HTTPException(status_code=500, detail={"message": str(e)})
+        logger.error(f"Error en import-backup: {e}")
+        raise HTTPException(status_code=500, detail={"message": f"Error al importar: {str(e)}"})
+
+
+def _import_backup(body, progreso=None):
+    """Inserta el respaldo (se ejecuta en el pool de hilos).
+
+    progreso(entidad, importados) se llama al terminar cada entidad; si lanza
+    una excepción la transacción completa se revierte.
+    """
+    username = body.get('username')
+    
+    with get_db() as conn:
+        user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+        
+        cursor = conn.cursor()
+        counts = {}
+        omitidos = {}
+        rechazados = []
+        for entidad in IMPORT_ENTITIES:
+            records = body.get(entidad) or []
+            if not isinstance(records, list):
+                rechazados.append({"entidad": entidad, "indice": None, "motivo": "se esperaba una lista"})
+                records = []
+            counts[entidad], omitidos[entidad], rejected = _import_records(cursor, user_id, entidad, records)
+            rechazados.extend(rejected)
+            if progreso:
+                progreso(entidad, dict(counts))
+        
+        conn.commit()
+        if rechazados:
+            logger.warning(f"import-backup de {username}: {len(rechazados)} filas rechazadas")
+        return {"success": True, "imported": counts, "omitidos": omitidos, "rechazados": rechazados}
+
+
+# Límites de la importación por streaming
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(4 * 1024 * 1024)))
+IMPORT_MAX_REJECTED = 1000
+
+
+class _StreamImport:
+    """Estado de una importación NDJSON: lotes pendientes por entidad y contadores."""
+
+    def __init__(self, username, user_id, checkpoint=None):
+        self.username = username
+        self.user_id = user_id
+        self.pending = {entidad: [] for entidad in IMPORT_ENTITIES}
+        self.counts = {entidad: 0 for entidad in IMPORT_ENTITIES}
+        self.omitidos = {entidad: 0 for entidad in IMPORT_ENTITIES}
+        # Filas ya confirmadas por entidad (incluye las de un intento anterior)
+        self.seen = dict(checkpoint) if checkpoint else {entidad: 0 for entidad in IMPORT_ENTITIES}
+        # Copias de cada contenido vistas en este envío, por entidad
+        self.ocurrencias = {entidad: {} for entidad in IMPORT_ENTITIES}
+        self.rechazados = []
+        self.rechazados_total = 0
+        self.lineas = 0
+        self.lotes = 0
+
+    def reject(self, entidad, indice, motivo, linea=None):
+        self.rechazados_total += 1
+        if len(self.rechazados) < IMPORT_MAX_REJECTED:
+            rechazo = {"entidad": entidad, "indice": indice, "motivo": motivo}
+            if linea is not None:
+                rechazo["linea"] = linea
+            self.rechazados.append(rechazo)
+
+    def add_line(self, line):
+        """Agrega una línea NDJSON; devuelve la entidad cuyo lote quedó lleno (o None)."""
+        self.lineas += 1
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self.reject(None, None, "línea no es JSON válido", self.lineas)
+            return None
+        entidad = record.get("entidad") if isinstance(record, dict) else None
+        if entidad not in IMPORT_ENTITIES:
+            self.reject(None, None, f"entidad desconocida: {entidad!r}", self.lineas)
+            return None
+        self.pending[entidad].append(record.get("datos"))
+        return entidad if len(self.pending[entidad]) >= IMPORT_BATCH_SIZE else None
+
+    def flush(self, entidad):
+        """Inserta y confirma el lote pendiente de una entidad (se ejecuta en el pool de hilos)."""
+        records = self.pending[entidad]
+        if not records:
+            return
+        self.pending[entidad] = []
+        with get_db() as conn:
+            inserted, omitidos, rejected = _import_records(conn.cursor(), self.user_id, entidad, records,
+                                                           self.seen[entidad], self.ocurrencias[entidad])
+            conn.commit()
+        self.seen[entidad] += len(records)
+        self.counts[entidad] += inserted
+        self.omitidos[entidad] += omitidos
+        for r in rejected:
+            self.reject(r["entidad"], r["indice"], r["motivo"])
+        self.lotes += 1
+        logger.info(
+            f"import-stream {self.username}: lote {self.lotes} ({entidad}), "
+            f"{sum(self.seen.values())} filas procesadas"
+        )
+
+    def flush_all(self):
+        for entidad in IMPORT_ENTITIES:
+            self.flush(entidad)
+
+    def progress(self):
+        return {
+            "imported": self.counts,
+            "omitidos": self.omitidos,
+            "rechazados": self.rechazados,
+            "rechazados_total": self.rechazados_total,
+            "lineas": self.lineas,
+            "lotes": self.lotes,
+            "checkpoint": dict(self.seen),
+        }
+
+    def result(self):
+        return {"success": True, **self.progress()}
+
+
+@app.post("/api/import-backup/stream")
+async def import_backup_stream(request: Request, username: str, checkpoint: str = None):
+    """Importa un respaldo NDJSON sin cargarlo completo en memoria.
+
+    Cada línea es {"entidad": "clientes|obras|productos|registros", "datos": {...}}.
+    Las filas se insertan en lotes de IMPORT_BATCH_SIZE y cada lote se confirma
+    por separado: si la importación falla, los lotes anteriores quedan guardados
+    y la respuesta trae `checkpoint` (filas confirmadas por entidad). Para
+    reanudar, el cliente reenvía desde ese punto pasando el mismo checkpoint;
+    como las filas ya guardadas se omiten por hash, reenviar de más es
+    inofensivo. Al reanudar no se cuentan las copias anteriores al
+    checkpoint: una fila que repite otra ya confirmada se omite.
+    """
+    try:
+        previous = json.loads(checkpoint) if checkpoint else {}
+        previous = {entidad: int(previous.get(entidad) or 0) for entidad in IMPORT_ENTITIES}
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail={"message": "checkpoint inválido"})
+
+    def lookup_user():
+        with get_db() as conn:
+            return get_user_id(conn, username)
+
+    user_id = await run_in_threadpool(lookup_user)
+    if user_id is None:
+        raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+
+    state = _StreamImport(username, user_id, previous)
+    try:
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            if len(buffer) > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail={"message": f"Línea mayor a {IMPORT_MAX_LINE_BYTES} bytes", **state.progress()}
+                )
+            for line in lines:
+                full = state.add_line(line)
+                if full:
+                    await run_in_threadpool(state.flush, full)
+        if buffer.strip():
+            state.add_line(buffer)
+        await run_in_threadpool(state.flush_all)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en import-backup/stream: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail={"message": f"Error al importar: {str(e)}", **state.progress()}
+        )
+
+    if state.rechazados_total:
+        logger.warning(f"import-stream de {username}: {state.rechazados_total} filas rechazadas")
+    return state.result()
+
+
+# ===============================================
+# DEDUPLICACIÓN
+# ===============================================
+# Las filas repetidas se detectan en la base con ROW_NUMBER() OVER
+# (PARTITION BY clave): en cada grupo se conserva la fila con rn = 1 y se
+# eliminan las demás en una sola transacción. Mismas reglas que tenía
+# scripts/maintenance.py: se conserva la más antigua y, en registros, la
+# que tiene detalles no vacíos gana.
+
+# detalles no vacío (mismo criterio en JSONB y en TEXT)
+_HAS_DETALLES_SQL = "COALESCE(CAST(detalles AS TEXT), '[]') NOT IN ('[]', '{}', 'null', '\"\"')"
+
+# entidad -> (expresiones de la clave, orden dentro del grupo: la primera fila se conserva)
+DEDUPE_RULES = {
+    "clientes": (
+        ["COALESCE(nombre, '')", "COALESCE(obra, '')", "COALESCE(cedula, '')"],
+        "created_at, id",
+    ),
+    "obras": (
+        ["COALESCE(nombre, '')"],
+        "created_at, id",
+    ),
+    "productos": (
+        ["COALESCE(nombre, '')", "COALESCE(precio, 0)"],
+        "created_at, id",
+    ),
+    "registros": (
+        ["COALESCE(fecha, '')", "COALESCE(obra, '')", "CAST(COALESCE(totalCantidad, 0) AS INTEGER)",
+         "COALESCE(totalCobrar, 0)", "COALESCE(totalPagado, 0)", "COALESCE(status, '')"],
+        f"CASE WHEN {_HAS_DETALLES_SQL} THEN 0 ELSE 1 END, created_at, id",
+    ),
+}
+
+
+def _delete_where(cursor, user_id, entidad, where, params, version):
+    """Elimina las filas de una entidad que cumplen `where`. Devuelve cuántas se eliminaron.
+
+    Deja una fila en tombstones por cada una, con la versión de la baja.
+    En registros también descuenta del resumen y borra sus items.
+    """
+    cursor.execute(*sql(
+        f"""INSERT INTO tombstones (user_id, entidad, entidad_id, version)
+            SELECT user_id, ?, id, ? FROM {entidad} WHERE {where}""",
+        [entidad, version] + list(params)
+    ))
+    if entidad == "registros":
+        cursor.execute(*sql(
+            f"""SELECT obra, fecha, SUM(COALESCE(totalCobrar, 0)) AS cobrar, SUM(COALESCE(totalPagado, 0)) AS pagado,
+                       SUM(COALESCE(totalCantidad, 0)) AS cantidad, COUNT(*) AS n
+                FROM registros WHERE {where}
+                GROUP BY obra, fecha""",
+            params
+        ))
+        for row in cursor.fetchall():
+            _resumen_apply(cursor, user_id, row["obra"], row["fecha"],
+                           -row["cobrar"], -row["pagado"], -row["cantidad"], -row["n"])
+        cursor.execute(*sql(f"DELETE FROM registro_items WHERE registro_id IN (SELECT id FROM registros WHERE {where})", params))
+    cursor.execute(*sql(f"DELETE FROM {entidad} WHERE {where}", params))
+    return cursor.rowcount
+
+
+def dedupe_entity(cursor, user_id, entidad, aplicar=False, fecha_inicio=None, fecha_fin=None, version=None):
+    """Busca (y con aplicar=True elimina) las filas repetidas de una entidad.
+
+    Con aplicar=True, `version` es la versión de datos que reciben las bajas.
+    No confirma la transacción: lo hace quien llama.
+    """
+    keys, order = DEDUPE_RULES[entidad]
+    if entidad == "registros":
+        where, params = _registros_where(user_id, None, fecha_inicio, fecha_fin)
+    else:
+        where, params = "user_id = ?", [user_id]
+    ranked = f"""SELECT id, ROW_NUMBER() OVER (PARTITION BY {', '.join(keys)} ORDER BY {order}) AS rn
+                 FROM {entidad} WHERE {where}"""
+
+    cursor.execute(*sql(f"SELECT id, rn FROM ({ranked}) ranked ORDER BY id", params))
+    rows = cursor.fetchall()
+    duplicados = [row["id"] for row in rows if row["rn"] > 1]
+    result = {
+        "total": len(rows),
+        "grupos": sum(1 for row in rows if row["rn"] == 1),
+        "duplicados": len(duplicados),
+        "ids": duplicados,
+        "eliminados": 0,
+    }
+    if not aplicar or not duplicados:
+        return result
+
+    dup_ids = f"SELECT id FROM ({ranked}) ranked WHERE rn > 1"
+    result["eliminados"] = _delete_where(cursor, user_id, entidad, f"id IN ({dup_ids})", params, version)
+    return result
+
+
+def _dedupe_entities(entidad):
+    """Entidades a revisar para el valor de `entidad` recibido ("todas" o una sola)."""
+    entidades = list(DEDUPE_RULES) if entidad == "todas" else [entidad]
+    if any(e not in DEDUPE_RULES for e in entidades):
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"entidad debe ser una de: todas, {', '.join(DEDUPE_RULES)}"}
+        )
+    return entidades
+
+
+def _run_dedupe(username, entidades, aplicar=False, fecha_inicio=None, fecha_fin=None, progreso=None):
+    """Deduplica las entidades del usuario en una sola transacción.
+
+    progreso(entidad, resultados) se llama tras revisar cada entidad; si lanza
+    una excepción no se confirma nada.
+    """
+    with get_db() as conn:
+        user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+
+        cursor = conn.cursor()
+        # La versión se toma antes de borrar; si no hubo cambios se revierte
+        version = _bump_data_version(cursor, user_id) if aplicar else None
+        resultados = {}
+        for e in entidades:
+            resultados[e] = dedupe_entity(cursor, user_id, e, aplicar, fecha_inicio, fecha_fin, version)
+            if progreso:
+                progreso(e, resultados)
+        if aplicar:
+            total = sum(r["eliminados"] for r in resultados.values())
+            cambiadas = [e for e, r in resultados.items() if r["eliminados"]]
+            if cambiadas:
+                _stamp_entities(cursor, user_id, version, *cambiadas)
+                conn.commit()
+            else:
+                conn.rollback()
+            logger.info(f"Dedupe de {username}: {total} filas eliminadas")
+        return {"success": True, "aplicado": aplicar, "resultados": resultados}
+
+
+@app.post("/api/dedupe")
+def dedupe(
+    username: str = Form(...),
+    entidad: str = Form("todas"),
+    aplicar: bool = Form(False),
+    fecha_inicio: str = Form(None),
+    fecha_fin: str = Form(None)
+):
+    """Elimina filas repetidas del usuario en una sola transacción.
+
+    Sin aplicar=true solo informa qué se eliminaría (ids de los duplicados).
+    fecha_inicio/fecha_fin limitan la búsqueda en registros.
+    """
+    entidades = _dedupe_entities(entidad)
+    try:
+        return _run_dedupe(username, entidades, aplicar, fecha_inicio, fecha_fin)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en dedupe: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al eliminar duplicados"})
+
+
+# ===============================================
+# ELIMINACIÓN MASIVA
+# ===============================================
+
+BULK_DELETE_ENTITIES = ("registros", "clientes", "obras", "productos")
+
+
+def _ids_condition(ids):
+    """Condición `id` en la lista, con un solo parámetro (sin límite de variables)."""
+    if USE_POSTGRES:
+        return "id = ANY(?)", [list(ids)]
+    return "id IN (SELECT value FROM json_each(?))", [json.dumps(list(ids))]
+
+
+def _bulk_where(user_id, entidad, body):
+    """Arma el WHERE de la eliminación masiva a partir de ids y/o filtros del body."""
+    where, params = "user_id = ?", [user_id]
+    filtered = False
+
+    ids = body.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise HTTPException(status_code=400, detail={"message": "ids debe ser una lista de enteros"})
+        condition, extra = _ids_condition(ids)
+        where += f" AND {condition}"
+        params += extra
+        filtered = True
+
+    obra = body.get("obra")
+    fecha_inicio = body.get("fecha_inicio")
+    fecha_fin = body.get("fecha_fin")
+    if entidad in ("registros", "clientes"):
+        if obra:
+            where += " AND obra = ?"
+            params.append(obra)
+        if fecha_inicio:
+            where += " AND fecha >= ?"
+            params.append(fecha_inicio)
+        if fecha_fin:
+            where += " AND fecha <= ?"
+            params.append(fecha_fin)
+        filtered = filtered or bool(obra or fecha_inicio or fecha_fin)
+    elif entidad == "obras" and obra:
+        where += " AND nombre = ?"
+        params.append(obra)
+        filtered = True
+
+    if not filtered and body.get("todos") is not True:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"Indique ids, un filtro válido para {entidad} o todos=true"}
+        )
+    return where, params
+
+
+@app.post("/api/bulk-delete")
+async def bulk_delete(request: Request):
+    """Elimina en una sola transacción muchas filas por ids o por filtro."""
+    try:
+        body = await request.json()
+        return await run_in_threadpool(_bulk_delete, body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en bulk-delete: {e}")
+        raise HTTPException(status_code=500, detail={"message": f"Error al eliminar: {str(e)}"})
+
+
+def _bulk_delete(body):
+    """Ejecuta la eliminación masiva (se ejecuta en el pool de hilos).
+
+    body: username, entidad (registros|clientes|obras|productos) y al menos uno
+    de: ids, obra, fecha_inicio, fecha_fin, o todos=true. entidad=todas con
+    todos=true purga todos los datos del usuario. Con simular=true solo cuenta
+    las filas que se eliminarían.
+    """
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail={"message": "Se esperaba un objeto JSON"})
+    entidad = body.get("entidad")
+    entidades = list(BULK_DELETE_ENTITIES) if entidad == "todas" else [entidad]
+    if any(e not in BULK_DELETE_ENTITIES for e in entidades):
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"entidad debe ser una de: todas, {', '.join(BULK_DELETE_ENTITIES)}"}
+        )
+    if entidad == "todas" and (body.get("todos") is not True
+                               or any(body.get(k) for k in ("ids", "obra", "fecha_inicio", "fecha_fin"))):
+        raise HTTPException(status_code=400, detail={"message": "entidad=todas solo admite todos=true (purga completa)"})
+    simular = body.get("simular") is True
+
+    with get_db() as conn:
+        user_id = get_user_id(conn, body.get("username"))
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+
+        cursor = conn.cursor()
+        # La versión se toma antes de borrar; si no hubo cambios se revierte
+        version = None if simular else _bump_data_version(cursor, user_id)
+        eliminados = {}
+        for e in entidades:
+            where, params = _bulk_where(user_id, e, body)
+            if simular:
+                cursor.execute(*sql(f"SELECT COUNT(*) AS n FROM {e} WHERE {where}", params))
+                eliminados[e] = cursor.fetchone()["n"]
+            else:
+                eliminados[e] = _delete_where(cursor, user_id, e, where, params, version)
+        if not simular:
+            cambiadas = [e for e, n in eliminados.items() if n]
+            if cambiadas:
+                _stamp_entities(cursor, user_id, version, *cambiadas)
+                conn.commit()
+            else:
+                conn.rollback()
+            logger.info(f"bulk-delete de {body.get('username')}: {eliminados}")
+        return {"success": True, "simulado": simular, "eliminados": eliminados}
+
+
+# ----- Endpoints de Administración (con clave secreta) -----
+ADMIN_SECRET = os.getenv("ADMIN_SECRET", "admin_secret_key_2026")
+
+@app.post("/api/admin/verify-password")
+def admin_verify_password(
+    username: str = Form(...),
+    password: str = Form(...),
+    admin_secret: str = Form(...)
+):
+    """Endpoint de administración para verificar si una contraseña es correcta."""
+    if admin_secret != ADMIN_SECRET:
+        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
+    
+    try:
+        with get_db() as conn:
+            cursor = conn.execute(
+                "SELECT password_hash FROM users WHERE username = ?",
+                (username,)
+            )
+            row = cursor.fetchone()
+            
+            if not row:
+                return {"success": False, "message": f"Usuario '{username}' no encontrado"}
+            
+            password_hash = row["password_hash"]
+            is_valid = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+            
+            return {
+                "success": True,
+                "username": username,
+                "password_valid": is_valid,
+                "message": "Contraseña correcta" if is_valid else "Contraseña incorrecta"
+            }
+    except Exception as e:
+        logger.error(f"Error verificando contraseña: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+@app.post("/api/admin/reset-password")
+def admin_reset_password(
+    username: str = Form(...),
+    new_password: str = Form(...),
+    admin_secret: str = Form(...)
+):
+    """Endpoint de administración para resetear contraseña de un usuario."""
+    if admin_secret != ADMIN_SECRET:
+        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
+    
+    if len(new_password) < 6:
+        raise HTTPException(status_code=400, detail={"message": "La contraseña debe tener al menos 6 caracteres"})
+    
+    try:
+        with get_db() as conn:
+            # Verificar que usuario existe
+            cursor = conn.execute("SELECT id FROM users WHERE username = ?", (username,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail={"message": f"Usuario '{username}' no encontrado"})
+            
+            # Hashear nueva contraseña
+            password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            
+            # Actualizar contraseña
+            conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (password_hash, username))
+            conn.commit()
+            user_id_cache.invalidate(username)
+            
+            logger.info(f"Contraseña reseteada exitosamente para usuario: {username}")
+            return {
+                "success": True,
+                "message": f"Contraseña actualizada para '{username}'",
+                "username": username
+            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error reseteando contraseña: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+@app.get("/api/admin/list-users")
+def admin_list_users(admin_secret: str):
+    """Lista todos los usuarios (solo email y username, sin contraseñas)."""
+    if admin_secret != ADMIN_SECRET:
+        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
+    
+    try:
+        with get_db() as conn:
+            cursor = conn.execute(
+                "SELECT id, email, username, birthdate, created_at FROM users ORDER BY created_at DESC"
+            )
+            users = []
+            for row in cursor.fetchall():
+                users.append({
+                    "id": row["id"],
+                    "email": row["email"],
+                    "username": row["username"],
+                    "birthdate": row["birthdate"],
+                    "created_at": row["created_at"]
+                })
+            
+            return {"success": True, "users": users, "count": len(users)}
+    except Exception as e:
+        logger.error(f"Error listando usuarios: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+@app.post("/api/admin/resumen/verify")
+def admin_verify_resumen(
+    admin_secret: str = Form(...),
+    username: str = Form(None),
+    reparar: bool = Form(False)
+):
+    """Verifica registros_resumen contra registros y, con reparar=true, lo reconstruye."""
+    if admin_secret != ADMIN_SECRET:
+        raise HTTPException(status_code=403, detail={"message": "Acceso denegado"})
+    
+    try:
+        with get_db() as conn:
+            user_id = None
+            if username:
+                user_id = get_user_id(conn, username)
+                if user_id is None:
+                    raise HTTPException(status_code=404, detail={"message": f"Usuario '{username}' no encontrado"})
+            
+            drift = verify_resumen(conn, user_id=user_id, repair=reparar)
+            if drift:
+                logger.warning(f"Resumen de registros con {len(drift)} diferencias (usuario={username or 'todos'})")
+            return {
+                "success": True,
+                "ok": not drift,
+                "diferencias": drift,
+                "reparado": bool(drift) and reparar
+            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error verificando resumen: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+# Exportar Excel con estilos profesionales completos
+@app.post("/api/reportes/export-excel")
+async def export_reportes_excel(request: Request):
+    """Genera archivo Excel con estilos completos usando openpyxl.
+    
+    Formato garantizado:
+    - Usuario: Arial 12, Negrita, Centrado, Celda combinada
+    - Título: Arial 18, Negrita, Centrado, Celda combinada
+    - Fechas: Arial 12, Negrita, Centrado, Celda combinada
+    - Encabezados de columnas: Arial 11, Negrita, Fondo gris
+    - Datos: Arial 10
+    - Totales: Negrita, Fondo gris
+
+    El libro se escribe en modo streaming a un archivo temporal que se envía
+    por partes y se borra al terminar la respuesta.
+    """
+    try:
+        data = await request.json()
+        mode = data.get('mode', 'general')
+        path = await run_in_threadpool(
+            _excel_report_file,
+            data.get('rows', []),
+            data.get('headers', []),
+            username=data.get('username', 'Usuario'),
+            title=data.get('title', 'Reporte'),
+            date_range=data.get('date_range', ''),
+            currency_cols=data.get('currency_cols', []),
+            mode=mode,
+            totals=data.get('totals', None)
+        )
+        return _temp_file_response(path, f"reportes_{mode}_{datetime.now().strftime('%Y-%m-%d')}.xlsx")
+    except Exception as e:
+        logger.error(f"Error en export_reportes_excel: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+# ============================================================================
+# EXPORTACIÓN EXCEL EN STREAMING
+# ============================================================================
+
+EXCEL_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+EXCEL_COL_WIDTHS = {
+    'general': [16, 22, 12, 16, 16, 16, 12],
+    'detallado': [16, 22, 16, 22, 12, 16, 16, 16, 12],
+}
+
+
+def _excel_col_widths(mode, ncols):
+    """Anchos de columna según el modo del reporte."""
+    if mode == 'diario':
+        return [22, 22] + [14] * max(0, ncols - 3) + [16]
+    return EXCEL_COL_WIDTHS.get(mode, [16] * ncols)
+
+
+def _excel_named_styles():
+    """Estilos con nombre del reporte; cada celda referencia uno en lugar de copiar fuentes y bordes."""
+    from openpyxl.styles import NamedStyle, Font, Alignment, PatternFill, Border, Side
+
+    align_center = Alignment(horizontal='center', vertical='center')
+    align_left = Alignment(horizontal='left', vertical='center')
+    align_right = Alignment(horizontal='right', vertical='center')
+    fill_gray = PatternFill(start_color='F0F0F0', end_color='F0F0F0', fill_type='solid')
+    fill_header = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
+    thin = Side(style='thin')
+    thin_border = Border(left=thin, right=thin, top=thin, bottom=thin)
+
+    def style(name, font, alignment, fill=None, border=None, number_format=None):
+        ns = NamedStyle(name=name, font=font, alignment=alignment)
+        if fill is not None:
+            ns.fill = fill
+        if border is not None:
+            ns.border = border
+        if number_format:
+            ns.number_format = number_format
+        return ns
+
+    font_data = Font(name='Arial', size=10)
+    font_totals = Font(name='Arial', bold=True, size=10)
+    return [
+        style('ft_usuario', Font(name='Arial', bold=True, size=12), align_center),
+        style('ft_titulo', Font(name='Arial', bold=True, size=18), align_center),
+        style('ft_fechas', Font(name='Arial', bold=True, size=12), align_center),
+        style('ft_encabezado', Font(name='Arial', bold=True, size=11), align_center, fill_header, thin_border),
+        style('ft_dato', font_data, align_left, border=thin_border),
+        style('ft_dato_centro', font_data, align_center, border=thin_border),
+        style('ft_dato_derecha', font_data, align_right, border=thin_border),
+        style('ft_moneda', font_data, align_right, border=thin_border, number_format='#,##0.00'),
+        style('ft_total', font_totals, align_right, fill_gray, thin_border),
+        style('ft_total_izq', font_totals, align_left, fill_gray, thin_border),
+        style('ft_total_moneda', font_totals, align_right, fill_gray, thin_border, '#,##0.00'),
+    ]
+
+
+def _write_excel_report(path, rows, headers, username='Usuario', title='Reporte',
+                        date_range='', currency_cols=(), mode='general', totals=None,
+                        progreso=None):
+    """Escribe el reporte en `path` con un libro write_only de openpyxl.
+
+    `rows` puede ser cualquier iterable (lista o cursor de la DB): cada fila se
+    serializa y se descarta, así que la memoria no crece con el número de filas.
+    progreso(filas) se llama cada EXPORT_FETCH_SIZE filas.
+    Devuelve el número de filas de datos escritas.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    for named_style in _excel_named_styles():
+        wb.add_named_style(named_style)
+    ws = wb.create_sheet('Reportes')
+
+    ncols = len(headers)
+    currency_cols = set(currency_cols or ())
+
+    # En modo write_only los anchos y las celdas combinadas se fijan antes de escribir filas
+    for c_idx, width in enumerate(_excel_col_widths(mode, ncols), start=1):
+        if c_idx <= ncols:
+            ws.column_dimensions[get_column_letter(c_idx)].width = width
+    if ncols > 1:
+        last = get_column_letter(ncols)
+        for r in (1, 2, 3):
+            ws.merged_cells.add(f'A{r}:{last}{r}')
+
+    def cell(value, style):
+        c = WriteOnlyCell(ws, value=value)
+        c.style = style
+        return c
+
+    # Filas 1-3: usuario, título y rango de fechas; fila 4 vacía
+    ws.append([cell(username, 'ft_usuario')])
+    ws.append([cell(title, 'ft_titulo')])
+    ws.append([cell(date_range, 'ft_fechas')])
+    ws.append([])
+
+    # Fila 5: encabezados de columnas
+    ws.append([cell(h, 'ft_encabezado') for h in headers])
+
+    # Estilo de cada columna calculado una sola vez
+    col_styles = []
+    for idx in range(ncols):
+        if idx in currency_cols:
+            col_styles.append('ft_dato_derecha')
+        elif headers[idx] in ['Estado']:
+            col_styles.append('ft_dato_centro')
+        else:
+            col_styles.append('ft_dato')
+
+    # Filas 6+: datos
+    count = 0
+    for row in rows:
+        out = []
+        for idx, value in enumerate(row):
+            style = col_styles[idx] if idx < ncols else 'ft_dato'
+            if style == 'ft_dato_derecha' and isinstance(value, (int, float)):
+                style = 'ft_moneda'
+            out.append(cell(value, style))
+        ws.append(out)
+        count += 1
+        if progreso and count % EXPORT_FETCH_SIZE == 0:
+            progreso(count)
+
+    # Fila de totales (si existe)
+    if totals:
+        out = []
+        for idx, value in enumerate(totals):
+            if idx in currency_cols and isinstance(value, (int, float)):
+                style = 'ft_total_moneda'
+            else:
+                style = 'ft_total' if idx > 0 else 'ft_total_izq'
+            out.append(cell(value, style))
+        ws.append(out)
+
+    wb.save(path)
+    return count
+
+
+def _excel_report_file(rows, headers, directorio=None, **opciones):
+    """Escribe el reporte en un archivo temporal y devuelve su ruta (se ejecuta en el pool de hilos)."""
+    fd, path = tempfile.mkstemp(prefix='fintrack_', suffix='.xlsx', dir=directorio)
+    os.close(fd)
+    try:
+        _write_excel_report(path, rows, headers, **opciones)
+    except Exception:
+        _remove_file(path)
+        raise
+    return path
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"No se pudo borrar el archivo temporal {path}: {e}")
+
+
+def _temp_file_response(path, filename, media_type=EXCEL_MEDIA_TYPE):
+    """Envía el archivo por partes y lo borra cuando termina la respuesta."""
+    from starlette.background import BackgroundTask
+
+    return FileResponse(
+        path,
+        media_type=media_type,
+        filename=filename,
+        background=BackgroundTask(_remove_file, path)
+    )
+
+
+# ----------------------------------------------------------------------------
+# Exportación generada en el servidor a partir de los filtros
+# ----------------------------------------------------------------------------
+
+EXCEL_REPORT_MODES = ("general", "detallado", "diario")
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "2000"))
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+
+
+def _server_cursor(conn):
+    """Cursor que trae las filas por partes: cursor con nombre (del lado del servidor) en PostgreSQL."""
+    if USE_POSTGRES:
+        cursor = conn.cursor(name="fintrack_export")
+        cursor.itersize = EXPORT_FETCH_SIZE
+        return cursor
+    return conn.cursor()
+
+
+def _fecha_texto(fecha):
+    """YYYY-MM-DD -> DD-MM-YYYY (como se muestra en el dashboard)."""
+    return '-'.join(reversed(fecha.split('-'))) if fecha else ''
+
+
+def _dia_texto(fecha):
+    """Encabezado de una columna del modo Por Día ("Viernes 15-03-2024").
+
+    Las fechas que no son YYYY-MM-DD (importadas como "15/03/2024") se
+    muestran tal cual en lugar de fallar.
+    """
+    try:
+        dia = date.fromisoformat(fecha)
+    except ValueError:
+        return fecha
+    return f"{DIAS_SEMANA[dia.weekday()]} {_fecha_texto(fecha)}"
+
+
+def _estado_pago(cobrar, pagado):
+    """Estado calculado con los montos, igual que en la vista de reportes."""
+    if pagado >= cobrar and cobrar > 0:
+        return 'pagado'
+    return 'parcial' if pagado > 0 else 'pendiente'
+
+
+def _clientes_por_obra(cursor, user_id):
+    """Devuelve (cedula por nombre de cliente, nombres de clientes por obra)."""
+    cursor.execute(*sql("SELECT nombre, cedula, obra FROM clientes WHERE user_id = ? ORDER BY id", (user_id,)))
+    cedulas, por_obra = {}, {}
+    for row in cursor.fetchall():
+        cedulas.setdefault(row["nombre"], row["cedula"] or '')
+        por_obra.setdefault(row["obra"], []).append(row["nombre"])
+    return cedulas, por_obra
+
+
+def _clientes_registro(texto):
+    """Nombres en clientesAdicionales de un registro (leído como texto JSON).
+
+    El dashboard guarda nombres; los respaldos importados, objetos {"cliente", "valor"}.
+    """
+    if not texto:
+        return []
+    try:
+        clientes = json.loads(texto)
+    except ValueError:
+        return []
+    if not isinstance(clientes, list):
+        return []
+    nombres = [c.get("cliente") if isinstance(c, dict) else c for c in clientes]
+    return [str(n) for n in nombres if n]
+
+
+@contextmanager
+def _export_registros(conn, where, params):
+    """Cursor sobre los registros filtrados (fecha más reciente primero) que se lee por partes."""
+    cursor = _server_cursor(conn)
+    try:
+        # Alias en minúsculas: PostgreSQL pliega los identificadores sin comillas
+        cursor.execute(*sql(
+            f"""SELECT fecha, obra,
+                       totalCantidad AS cantidad,
+                       totalCobrar AS cobrar,
+                       totalPagado AS pagado,
+                       CAST(clientesAdicionales AS TEXT) AS clientes
+                FROM registros
+                WHERE {where}
+                ORDER BY COALESCE(fecha, '') DESC, id DESC""",
+            params
+        ))
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def _filas_general(registros):
+    """Modo General: una fila por registro."""
+    for r in registros:
+        cobrar = r["cobrar"] or 0
+        pagado = r["pagado"] or 0
+        yield [r["fecha"] or '', r["obra"] or '', r["cantidad"] or 0,
+               cobrar, pagado, cobrar - pagado, _estado_pago(cobrar, pagado)]
+
+
+def _filas_detallado(registros, cedulas, por_obra):
+    """Modo Detallado: una fila por cliente y registro, con los montos repartidos por igual.
+
+    Las filas de cada fecha se ordenan por cliente; solo se retiene una fecha a la vez.
+    """
+    dia, pendientes = None, []
+    for r in registros:
+        fecha = r["fecha"] or ''
+        if fecha != dia:
+            pendientes.sort(key=lambda fila: fila[1].casefold())
+            yield from pendientes
+            dia, pendientes = fecha, []
+        obra = r["obra"] or ''
+        nombres = _clientes_registro(r["clientes"]) or por_obra.get(obra) or ['']
+        cobrar = (r["cobrar"] or 0) / len(nombres)
+        pagado = (r["pagado"] or 0) / len(nombres)
+        cantidad = (r["cantidad"] or 0) / len(nombres)
+        for nombre in nombres:
+            pendientes.append([fecha, nombre, cedulas.get(nombre, ''), obra, cantidad,
+                               cobrar, pagado, cobrar - pagado, _estado_pago(cobrar, pagado)])
+    pendientes.sort(key=lambda fila: fila[1].casefold())
+    yield from pendientes
+
+
+def _pivot_diario(registros, por_obra, fecha_inicio, fecha_fin):
+    """Modo Por Día: A Cobrar por obra y cliente en columnas por fecha.
+
+    Devuelve (días, filas, totales por día). El tamaño depende de la cantidad
+    de combinaciones obra/cliente y de días, no de la cantidad de registros.
+    """
+    celdas = {}
+    fechas = set()
+    for r in registros:
+        fecha = r["fecha"]
+        if not fecha:
+            continue
+        fechas.add(fecha)
+        obra = r["obra"] or ''
+        nombres = _clientes_registro(r["clientes"]) or por_obra.get(obra) or ['Sin Cliente']
+        monto = (r["cobrar"] or 0) / len(nombres)
+        for nombre in nombres:
+            por_dia = celdas.setdefault((obra, nombre), {})
+            por_dia[fecha] = por_dia.get(fecha, 0) + monto
+
+    if fecha_inicio and fecha_fin:
+        inicio, fin = date.fromisoformat(fecha_inicio), date.fromisoformat(fecha_fin)
+        dias = [date.fromordinal(d).isoformat() for d in range(inicio.toordinal(), fin.toordinal() + 1)]
+    else:
+        dias = sorted(fechas)
+
+    totales_dia = [0] * len(dias)
+    filas = []
+    for (obra, nombre) in sorted(celdas, key=lambda k: (k[1].casefold(), k[0].casefold())):
+        por_dia = celdas[(obra, nombre)]
+        valores = [por_dia.get(d, 0) for d in dias]
+        for i, v in enumerate(valores):
+            totales_dia[i] += v
+        filas.append([obra, nombre] + valores + [sum(valores)])
+    return dias, filas, totales_dia
+
+
+def _excel_report_from_db(username, obra=None, fecha_inicio=None, fecha_fin=None, mode='general',
+                          directorio=None, progreso=None):
+    """Genera el reporte leyendo los registros con un cursor y devuelve la ruta del archivo temporal."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+
+        cedulas, por_obra = _clientes_por_obra(cursor, user_id)
+        # El diario reparte por día, así que ahí los registros sin fecha no cuentan
+        where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin, sin_fecha=mode != 'diario')
+        opciones = {
+            'username': username,
+            'date_range': f"Desde {_fecha_texto(fecha_inicio)} hasta {_fecha_texto(fecha_fin)}",
+            'mode': mode,
+            'directorio': directorio,
+            'progreso': progreso,
+        }
+
+        if mode == 'diario':
+            with _export_registros(conn, where, params) as registros:
+                dias, filas, totales_dia = _pivot_diario(registros, por_obra, fecha_inicio, fecha_fin)
+            headers = ['Obra', 'Clientes'] + [_dia_texto(d) for d in dias] + ['Total']
+            return _excel_report_file(
+                filas, headers,
+                title='Reporte Por Día de Ventas',
+                currency_cols=list(range(2, len(dias) + 3)),
+                totals=['', 'Total por Día'] + totales_dia + [sum(totales_dia)],
+                **opciones
+            )
+
+        # Los totales salen de una sola consulta agregada; las filas se escriben mientras se leen
+        cursor.execute(*sql(
+            f"""SELECT SUM(totalCobrar) AS cobrar, SUM(totalPagado) AS pagado, SUM(totalCantidad) AS cantidad
+                FROM registros WHERE {where}""",
+            params
+        ))
+        t = _report_totals(cursor.fetchone())
+        montos = [t['totalCobrar'], t['totalCobrado'], t['totalPendiente']]
+
+        with _export_registros(conn, where, params) as registros:
+            if mode == 'general':
+                return _excel_report_file(
+                    _filas_general(registros),
+                    ['Fecha', 'Obra', 'Cantidad', 'A Cobrar', 'Cobrado', 'Pendiente', 'Estado'],
+                    title='Reporte General de Ventas',
+                    currency_cols=[3, 4, 5],
+                    totals=['', 'TOTALES:', ''] + montos + [''],
+                    **opciones
+                )
+            return _excel_report_file(
+                _filas_detallado(registros, cedulas, por_obra),
+                ['Fecha', 'Cliente', 'Cédula', 'Obra', 'Cantidad', 'A Cobrar', 'Cobrado', 'Pendiente', 'Estado'],
+                title='Reporte Detallado de Ventas',
+                currency_cols=[5, 6, 7],
+                totals=['', '', '', 'TOTALES:', ''] + montos + [''],
+                **opciones
+            )
+
+
+def _validate_export_params(mode, fecha_inicio, fecha_fin):
+    if mode not in EXCEL_REPORT_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"mode debe ser uno de: {', '.join(EXCEL_REPORT_MODES)}"}
+        )
+    try:
+        for fecha in (fecha_inicio, fecha_fin):
+            if fecha:
+                date.fromisoformat(fecha)
+    except ValueError:
+        raise HTTPException(status_code=400, detail={"message": "Las fechas deben tener formato YYYY-MM-DD"})
+
+
+@app.get("/api/reportes/export-excel")
+def export_reportes_excel_db(username: str, mode: str = "general", obra: str = None,
+                             fecha_inicio: str = None, fecha_fin: str = None):
+    """Genera el Excel de reportes en el servidor a partir de los filtros.
+
+    A diferencia del POST, el cliente no envía las filas: se leen de la base
+    de datos con un cursor y se escriben directamente en el libro.
+    """
+    _validate_export_params(mode, fecha_inicio, fecha_fin)
+    try:
+        path = _excel_report_from_db(username, obra, fecha_inicio, fecha_fin, mode)
+        return _temp_file_response(path, f"reportes_{mode}_{datetime.now().strftime('%Y-%m-%d')}.xlsx")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en export_reportes_excel_db: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+# ============================================================================
+# EXPORTACIÓN DE DATOS (CSV, NDJSON, PARQUET)
+# ============================================================================
+# Cada formato se genera mientras se lee el cursor, sin cargar la tabla en
+# memoria. CSV y NDJSON se envían en streaming; Parquet se escribe por lotes
+# a un archivo temporal (el formato necesita el pie al final) y se envía por partes.
+
+EXPORT_COLUMNS = {
+    "registros": ["id", "fecha", "obra", "totalCantidad", "totalCobrar", "totalPagado", "status",
+                  "clientesAdicionales", "detalles", "created_at"],
+    "clientes": ["id", "nombre", "cedula", "obra", "estado", "fecha", "created_at"],
+    "obras": ["id", "nombre", "ubicacion", "estado", "created_at"],
+    "productos": ["id", "nombre", "precio", "created_at"],
+}
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Columnas no textuales en Parquet (el resto se exporta como texto)
+EXPORT_PARQUET_TYPES = {
+    "id": "int64",
+    "totalCantidad": "int64",
+    "totalCobrar": "float64",
+    "totalPagado": "float64",
+    "precio": "float64",
+}
+
+
+@contextmanager
+def _export_cursor(conn, entidad, where, params):
+    """Cursor del lado del servidor sobre las filas a exportar, en orden de id."""
+    # Alias entre comillas: conserva mayúsculas (totalCobrar) también en PostgreSQL;
+    # las columnas JSONB se leen como texto para no decodificarlas
+    select = [
+        f'CAST({c} AS TEXT) AS "{c}"' if entidad == "registros" and c in REGISTROS_JSON_COLUMNS else f'{c} AS "{c}"'
+        for c in EXPORT_COLUMNS[entidad]
+    ]
+    cursor = _server_cursor(conn)
+    try:
+        cursor.execute(*sql(f"SELECT {', '.join(select)} FROM {entidad} WHERE {where} ORDER BY id", params))
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _export_csv(entidad, where, params):
+    """Genera el CSV por bloques de EXPORT_FETCH_SIZE filas."""
+    columns = EXPORT_COLUMNS[entidad]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM para que Excel reconozca UTF-8 al abrir el archivo
+    buf.write("\ufeff")
+    writer.writerow(columns)
+    with get_db() as conn, _export_cursor(conn, entidad, where, params) as cursor:
+        for n, row in enumerate(cursor, start=1):
+            writer.writerow([_csv_value(row[c]) for c in columns])
+            if n % EXPORT_FETCH_SIZE == 0:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def _export_ndjson(entidad, where, params):
+    """Genera una línea JSON por fila; detalles y clientesAdicionales se insertan sin decodificar."""
+    columns = EXPORT_COLUMNS[entidad]
+    chunk = []
+    with get_db() as conn, _export_cursor(conn, entidad, where, params) as cursor:
+        for row in cursor:
+            chunk.append(_registro_json({c: row[c] for c in columns}))
+            if len(chunk) >= EXPORT_FETCH_SIZE:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def _export_parquet_file(entidad, where, params):
+    """Escribe el Parquet por lotes en un archivo temporal y devuelve su ruta."""
+    columns = EXPORT_COLUMNS[entidad]
+    schema = pa.schema([(c, getattr(pa, EXPORT_PARQUET_TYPES.get(c, "string"))()) for c in columns])
+
+    def batch(rows):
+        data = {c: [] for c in columns}
+        for row in rows:
+            for c in columns:
+                value = row[c]
+                if isinstance(value, (datetime, date)):
+                    value = value.isoformat()
+                elif value is not None and EXPORT_PARQUET_TYPES.get(c) == "int64":
+                    # SQLite no impone el tipo: filas antiguas pueden tener 2.5
+                    value = int(value)
+                data[c].append(value)
+        return pa.RecordBatch.from_pydict(data, schema=schema)
+
+    fd, path = tempfile.mkstemp(prefix=f"fintrack_{entidad}_", suffix=".parquet")
+    os.close(fd)
+    try:
+        with get_db() as conn, _export_cursor(conn, entidad, where, params) as cursor:
+            with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+                while True:
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    writer.write_batch(batch(rows))
+    except Exception:
+        _remove_file(path)
+        raise
+    return path
+
+
+@app.get("/api/export/{entidad}")
+def export_entidad(
+    entidad: str,
+    username: str,
+    formato: str = "ndjson",
+    obra: str = None,
+    fecha_inicio: str = None,
+    fecha_fin: str = None
+):
+    """Exporta todas las filas de una entidad del usuario en CSV, NDJSON o Parquet.
+
+    obra, fecha_inicio y fecha_fin filtran los registros. Parquet requiere pyarrow.
+    """
+    if entidad not in EXPORT_COLUMNS:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"entidad debe ser una de: {', '.join(EXPORT_COLUMNS)}"}
+        )
+    if formato not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail={"message": f"formato debe ser uno de: {', '.join(EXPORT_FORMATS)}"}
+        )
+    if formato == "parquet" and not PYARROW_AVAILABLE:
+        raise HTTPException(
+            status_code=501,
+            detail={"message": "La exportación Parquet requiere pyarrow (pip install pyarrow)"}
+        )
+
+    try:
+        with get_db() as conn:
+            user_id = get_user_id(conn, username)
+        if user_id is None:
+            raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+
+        if entidad == "registros":
+            where, params = _registros_where(user_id, obra, fecha_inicio, fecha_fin)
+        else:
+            where, params = "user_id = ?", [user_id]
+        filename = f"{entidad}_{datetime.now().strftime('%Y-%m-%d')}.{formato}"
+
+        if formato == "parquet":
+            path = _export_parquet_file(entidad, where, params)
+            return _temp_file_response(path, filename, media_type=EXPORT_FORMATS[formato])
+
+        generator = _export_csv if formato == "csv" else _export_ndjson
+        return StreamingResponse(
+            generator(entidad, where, params),
+            media_type=EXPORT_FORMATS[formato],
+            headers={"Content-Disposition": f"attachment; filename=\"{filename}\""}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error exportando {entidad}: {e}")
+        raise HTTPException(status_code=500, detail={"message": f"Error al exportar {entidad}"})
+
+
+# ============================================================================
+# TRABAJOS EN SEGUNDO PLANO
+# ============================================================================
+# Las exportaciones, importaciones y deduplicaciones grandes se encolan como
+# trabajos: la petición responde enseguida con el id y el cliente consulta
+# GET /api/jobs/{id} hasta que termina. Los trabajos corren en un pool de
+# hilos propio del proceso (JOB_WORKERS) y cada usuario puede tener como
+# máximo JOB_MAX_PER_USER trabajos pendientes o en ejecución.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "2"))
+JOB_TTL_HOURS = float(os.getenv("JOB_TTL_HOURS", "24"))
+JOBS_DIR = os.getenv("JOBS_DIR") or os.path.join(tempfile.gettempdir(), "fintrack_jobs")
+JOB_ACTIVE_STATES = ("pendiente", "ejecutando")
+JOB_LIST_LIMIT = 50
+
+
+def _job_owner():
+    """Proceso que ejecuta los trabajos que encola ("host:pid")."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _process_alive(pid):
+    """True si el proceso pid sigue en ejecución en esta máquina."""
+    if os.name == "nt":
+        # os.kill(pid, 0) terminaría el proceso en Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        try:
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        finally:
+            kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobCancelled(Exception):
+    """El trabajo fue cancelado mientras se ejecutaba."""
+
+
+def _job_payload_path(job_id):
+    """Archivo con los datos de entrada grandes de un trabajo (p.ej. el respaldo a importar)."""
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+class JobQueue:
+    """Cola de trabajos persistida en la tabla jobs y ejecutada en un pool de hilos.
+
+    El estado (pendiente, ejecutando, completado, error, cancelado) vive en la
+    base de datos; el progreso de los trabajos en curso se guarda en memoria y
+    se persiste al terminar, así no compite por la DB con la transacción del
+    propio trabajo.
+    """
+
+    def __init__(self, workers, max_per_user):
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fintrack-job")
+        self._lock = threading.Lock()
+        self._cancel = {}
+        self._progress = {}
+        self._running = set()
+
+    def submit(self, user_id, tipo, parametros, payload=None):
+        """Registra el trabajo y lo encola; devuelve su id."""
+        job_id = os.urandom(16).hex()
+        # El lock evita que dos peticiones del mismo usuario superen juntas el límite
+        with self._lock, get_db() as conn:
+            cursor = conn.cursor()
+            _purge_old_jobs(cursor)
+            cursor.execute(*sql(
+                f"SELECT COUNT(*) AS n FROM jobs WHERE user_id = ? AND estado IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)})",
+                [user_id] + list(JOB_ACTIVE_STATES)
+            ))
+            if cursor.fetchone()["n"] >= self.max_per_user:
+                raise HTTPException(
+                    status_code=429,
+                    detail={"message": f"Ya tienes {self.max_per_user} trabajos en curso; espera a que terminen"}
+                )
+            if payload is not None:
+                os.makedirs(JOBS_DIR, exist_ok=True)
+                with open(_job_payload_path(job_id), "w", encoding="utf-8") as f:
+                    json.dump(payload, f, ensure_ascii=False)
+            cursor.execute(*sql(
+                "INSERT INTO jobs (id, user_id, tipo, estado, parametros, owner) VALUES (?, ?, ?, 'pendiente', ?, ?)",
+                (job_id, user_id, tipo, json.dumps(parametros, ensure_ascii=False), _job_owner())
+            ))
+            conn.commit()
+            self._cancel[job_id] = threading.Event()
+
+        self.executor.submit(self._run, job_id, tipo, parametros)
+        logger.info(f"Trabajo {tipo} {job_id} encolado (usuario {user_id})")
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancela un trabajo pendiente de inmediato; uno en ejecución se detiene en su próximo punto de control."""
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*sql(
+                "UPDATE jobs SET estado = 'cancelado', finished_at = CURRENT_TIMESTAMP WHERE id = ? AND estado = 'pendiente'",
+                (job_id,)
+            ))
+            conn.commit()
+        event = self._cancel.get(job_id)
+        if event:
+            event.set()
+
+    def progress(self, job_id):
+        return self._progress.get(job_id)
+
+    def _run(self, job_id, tipo, parametros):
+        event = self._cancel.get(job_id) or threading.Event()
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute(*sql(
+                    "UPDATE jobs SET estado = 'ejecutando', started_at = CURRENT_TIMESTAMP WHERE id = ? AND estado = 'pendiente'",
+                    (job_id,)
+                ))
+                conn.commit()
+                if cursor.rowcount == 0:
+                    return  # cancelado antes de empezar
+
+            self._running.add(job_id)
+
+            def progreso(**datos):
+                if event.is_set():
+                    raise JobCancelled()
+                self._progress[job_id] = datos
+
+            resultado, archivo = JOB_TYPES[tipo](job_id, parametros, progreso)
+            if event.is_set():
+                if archivo:
+                    _remove_file(archivo)
+                raise JobCancelled()
+            self._finish(job_id, "completado", resultado=resultado, archivo=archivo)
+            logger.info(f"Trabajo {tipo} {job_id} completado")
+        except JobCancelled:
+            self._finish(job_id, "cancelado")
+            logger.info(f"Trabajo {tipo} {job_id} cancelado")
+        except HTTPException as e:
+            detail = e.detail if isinstance(e.detail, dict) else {"message": str(e.detail)}
+            self._finish(job_id, "error", error=detail.get("message"))
+        except Exception as e:
+            logger.error(f"Error en trabajo {tipo} {job_id}: {e}")
+            self._finish(job_id, "error", error=str(e))
+        finally:
+            self._running.discard(job_id)
+            self._cancel.pop(job_id, None)
+            self._progress.pop(job_id, None)
+            if os.path.exists(_job_payload_path(job_id)):
+                _remove_file(_job_payload_path(job_id))
+
+    def _finish(self, job_id, estado, resultado=None, archivo=None, error=None):
+        progreso = self._progress.get(job_id)
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute(*sql(
+                    """UPDATE jobs SET estado = ?, progreso = ?, resultado = ?, archivo = ?, error = ?,
+                                       finished_at = CURRENT_TIMESTAMP
+                       WHERE id = ?""",
+                    (estado,
+                     json.dumps(progreso, ensure_ascii=False) if progreso is not None else None,
+                     json.dumps(resultado, ensure_ascii=False, default=_json_default) if resultado is not None else None,
+                     archivo, error, job_id)
+                ))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"No se pudo guardar el estado del trabajo {job_id}: {e}")
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": len(self._running),
+            "queued": max(0, len(self._cancel) - len(self._running)),
+        }
+
+    def shutdown(self):
+        for event in list(self._cancel.values()):
+            event.set()
+        self.executor.shutdown(wait=False)
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_MAX_PER_USER)
+
+
+def _purge_old_jobs(cursor):
+    """Borra los trabajos terminados hace más de JOB_TTL_HOURS junto con sus archivos."""
+    limite = (datetime.utcnow() - timedelta(hours=JOB_TTL_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute(*sql(
+        f"SELECT id, archivo FROM jobs WHERE estado NOT IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)}) AND finished_at < ?",
+        list(JOB_ACTIVE_STATES) + [limite]
+    ))
+    viejos = cursor.fetchall()
+    if not viejos:
+        return
+    for row in viejos:
+        if row["archivo"] and os.path.exists(row["archivo"]):
+            _remove_file(row["archivo"])
+    ids = [row["id"] for row in viejos]
+    condition, params = _ids_condition(ids)
+    cursor.execute(*sql(f"DELETE FROM jobs WHERE {condition}", params))
+
+
+# --- Tipos de trabajo: (job_id, parametros, progreso) -> (resultado, archivo) ---
+
+def _job_export_excel(job_id, p, progreso):
+    mode = p.get("mode", "general")
+    path = _excel_report_from_db(
+        p["username"], p.get("obra"), p.get("fecha_inicio"), p.get("fecha_fin"), mode,
+        directorio=JOBS_DIR, progreso=lambda filas: progreso(filas=filas)
+    )
+    nombre = f"reportes_{mode}_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+    return {"nombre": nombre}, path
+
+
+def _job_import_backup(job_id, p, progreso):
+    with open(_job_payload_path(job_id), encoding="utf-8") as f:
+        body = json.load(f)
+    body["username"] = p["username"]
+    resultado = _import_backup(
+        body, progreso=lambda entidad, importados: progreso(entidad=entidad, importados=importados)
+    )
+    return resultado, None
+
+
+def _job_dedupe(job_id, p, progreso):
+    resultado = _run_dedupe(
+        p["username"], _dedupe_entities(p.get("entidad", "todas")), p.get("aplicar", False),
+        p.get("fecha_inicio"), p.get("fecha_fin"),
+        progreso=lambda entidad, resultados: progreso(entidad=entidad, revisadas=list(resultados))
+    )
+    return resultado, None
+
+
+JOB_TYPES = {
+    "export-excel": _job_export_excel,
+    "import-backup": _job_import_backup,
+    "dedupe": _job_dedupe,
+}
+
+
+def _job_request(body):
+    """Valida la petición y separa parámetros (en la tabla) y datos de entrada (en archivo)."""
+    tipo = body.get("tipo")
+    if tipo not in JOB_TYPES:
+        raise HTTPException(status_code=400, detail={"message": f"tipo debe ser uno de: {', '.join(JOB_TYPES)}"})
+    username = body.get("username")
+    if not username:
+        raise HTTPException(status_code=400, detail={"message": "username es requerido"})
+
+    if tipo == "export-excel":
+        parametros = {k: body.get(k) for k in ("obra", "fecha_inicio", "fecha_fin")}
+        parametros["mode"] = body.get("mode") or "general"
+        _validate_export_params(parametros["mode"], parametros["fecha_inicio"], parametros["fecha_fin"])
+        return username, parametros, None
+    if tipo == "dedupe":
+        parametros = {k: body.get(k) for k in ("fecha_inicio", "fecha_fin")}
+        parametros["entidad"] = body.get("entidad") or "todas"
+        parametros["aplicar"] = bool(body.get("aplicar", False))
+        _dedupe_entities(parametros["entidad"])
+        return username, parametros, None
+    payload = {entidad: body.get(entidad) or [] for entidad in IMPORT_ENTITIES}
+    resumen = {entidad: len(v) if isinstance(v, list) else None for entidad, v in payload.items()}
+    return username, {"filas": resumen}, payload
+
+
+def _job_response(row):
+    """Fila de jobs -> JSON de la API (con el progreso en memoria si sigue en curso)."""
+    job = dict(row)
+    for key in ("parametros", "progreso", "resultado"):
+        if job.get(key):
+            job[key] = json.loads(job[key])
+    for key in ("created_at", "started_at", "finished_at"):
+        if isinstance(job.get(key), datetime):
+            job[key] = job[key].isoformat()
+    if job["estado"] in JOB_ACTIVE_STATES:
+        job["progreso"] = job_queue.progress(job["id"]) or job["progreso"]
+    archivo = job.pop("archivo", None)
+    job.pop("user_id", None)
+    job.pop("owner", None)
+    job["descarga"] = f"/api/jobs/{job['id']}/download" if archivo and job["estado"] == "completado" else None
+    return job
+
+
+def _get_job(conn, job_id, username):
+    """Trabajo del usuario (404 si no existe o pertenece a otro)."""
+    user_id = get_user_id(conn, username)
+    cursor = conn.cursor()
+    cursor.execute(*sql("SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id)))
+    row = cursor.fetchone()
+    if user_id is None or row is None:
+        raise HTTPException(status_code=404, detail={"message": "Trabajo no encontrado"})
+    return row
+
+
+def _job_orphaned(owner):
+    """True si el proceso dueño del trabajo ya no existe.
+
+    Solo se revisan los procesos de esta máquina: los trabajos de otro
+    servidor los recupera ese servidor al reiniciar. Los trabajos sin dueño
+    son anteriores a la columna owner.
+    """
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    # Este proceso recién arranca: un trabajo con su pid es de un arranque anterior
+    return int(pid) == os.getpid() or not _process_alive(int(pid))
+
+
+@app.on_event("startup")
+def recover_jobs():
+    """Marca como interrumpidos los trabajos que quedaron a medias en un arranque anterior.
+
+    La cola vive en el proceso: con varios workers de uvicorn cada uno ejecuta
+    solo los trabajos que recibió, y al arrancar solo marca los de procesos
+    que ya terminaron, no los que siguen corriendo en otro worker.
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*sql(
+                f"SELECT id, owner FROM jobs WHERE estado IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)})",
+                list(JOB_ACTIVE_STATES)
+            ))
+            ids = [row["id"] for row in cursor.fetchall() if _job_orphaned(row["owner"])]
+            if not ids:
+                return
+            condition, params = _ids_condition(ids)
+            cursor.execute(*sql(
+                f"""UPDATE jobs SET estado = 'error', error = ?, finished_at = CURRENT_TIMESTAMP
+                    WHERE {condition} AND estado IN ({', '.join('?' for _ in JOB_ACTIVE_STATES)})""",
+                ["Interrumpido por reinicio del servidor"] + params + list(JOB_ACTIVE_STATES)
+            ))
+            conn.commit()
+            if cursor.rowcount:
+                logger.warning(f"{cursor.rowcount} trabajos interrumpidos por el reinicio")
+    except Exception as e:
+        logger.error(f"No se pudieron revisar los trabajos pendientes: {e}")
+
+
+@app.on_event("shutdown")
+def stop_jobs():
+    """Pide a los trabajos en curso que se detengan."""
+    job_queue.shutdown()
+
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(request: Request):
+    """Encola un trabajo de exportación, importación o deduplicación.
+
+    Body JSON: username, tipo (export-excel | import-backup | dedupe) y los
+    mismos parámetros que el endpoint equivalente. Responde 202 con el trabajo;
+    el progreso se consulta en GET /api/jobs/{id}.
+    """
+    try:
+        body = await request.json()
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail={"message": "Se esperaba un objeto JSON"})
+        return await run_in_threadpool(_create_job, body)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creando trabajo: {e}")
+        raise HTTPException(status_code=500, detail={"message": str(e)})
+
+
+def _create_job(body):
+    username, parametros, payload = _job_request(body)
+    with get_db() as conn:
+        user_id = get_user_id(conn, username)
+    if user_id is None:
+        raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+    parametros["username"] = username
+    job_id = job_queue.submit(user_id, body["tipo"], parametros, payload)
+    with get_db() as conn:
+        return {"success": True, "job": _job_response(_get_job(conn, job_id, username))}
+
+
+@app.get("/api/jobs")
+def list_jobs(username: str, limit: int = 20):
+    """Trabajos recientes del usuario (más nuevos primero)."""
+    limit = max(1, min(limit, JOB_LIST_LIMIT))
+    try:
+        with get_db() as conn:
+            user_id = get_user_id(conn, username)
+            if user_id is None:
+                raise HTTPException(status_code=404, detail={"message": "Usuario no encontrado"})
+            cursor = conn.cursor()
+            cursor.execute(*sql(
+                "SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, limit)
+            ))
+            return {"jobs": [_job_response(row) for row in cursor.fetchall()]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listando trabajos: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al listar trabajos"})
+
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str, username: str):
+    """Estado, progreso y resultado de un trabajo."""
+    try:
+        with get_db() as conn:
+            return {"job": _job_response(_get_job(conn, job_id, username))}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error consultando trabajo: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al consultar el trabajo"})
+
+
+@app.post("/api/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, username: str):
+    """Cancela un trabajo pendiente o en ejecución. Lo que no se confirmó se revierte."""
+    try:
+        with get_db() as conn:
+            row = _get_job(conn, job_id, username)
+        if row["estado"] not in JOB_ACTIVE_STATES:
+            raise HTTPException(status_code=409, detail={"message": f"El trabajo ya terminó ({row['estado']})"})
+        job_queue.cancel(job_id)
+        with get_db() as conn:
+            return {"success": True, "job": _job_response(_get_job(conn, job_id, username))}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error cancelando trabajo: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Error al cancelar el trabajo"})
+
+
+@app.get("/api/jobs/{job_id}/download")
+def download_job(job_id: str, username: str):
+    """Descarga el archivo generado por un trabajo completado."""
+    with get_db() as conn:
+        row = _get_job(conn, job_id, username)
+    if row["estado"] != "completado" or not row["archivo"] or not os.path.exists(row["archivo"]):
+        raise HTTPException(status_code=409, detail={"message": "El trabajo no tiene un archivo listo para descargar"})
+    resultado = json.loads(row["resultado"]) if row["resultado"] else {}
+    return FileResponse(
+        row["archivo"],
+        media_type=EXCEL_MEDIA_TYPE,
+        filename=resultado.get("nombre") or os.path.basename(row["archivo"])
+    )
 
 
 if __name__ == "__main__":
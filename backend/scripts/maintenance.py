@@ -2,45 +2,127 @@ import argparse
 import json
 import os
 import sys
-from collections import defaultdict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # Default backend API base (override with env BACKEND_BASE_URL)
 BASE_URL = os.environ.get("BACKEND_BASE_URL", "https://aplicaci-n-mi.onrender.com")
+# Clave de los endpoints /api/admin (env ADMIN_SECRET)
+ADMIN_SECRET = os.environ.get("ADMIN_SECRET", "")
+
+
+# Conexiones simultáneas al backend y límite de peticiones por segundo
+MAX_WORKERS = int(os.environ.get("MAINTENANCE_WORKERS", "4"))
+RATE_LIMIT = float(os.environ.get("MAINTENANCE_RATE_LIMIT", "10"))
+# Filas por página al descargar tablas (máximo del backend: 1000)
+PAGE_SIZE = 1000
 
 
 def _url(path: str) -> str:
     return f"{BASE_URL}{path}"
 
 
-def _ts(s: str) -> float:
-    try:
-        # created_at is in SQLite default CURRENT_TIMESTAMP format
-        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S").timestamp()
-    except Exception:
-        return 0.0
+class RateLimiter:
+    """Token bucket compartido entre hilos: como máximo `rate` peticiones por segundo."""
 
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-def get_clientes(username: str) -> List[Dict]:
-    r = requests.get(_url("/api/clientes"), params={"username": username}, timeout=20)
+    def wait(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def _make_session() -> requests.Session:
+    """Sesión keep-alive con pool de conexiones y reintentos con backoff exponencial.
+
+    Solo se reintentan métodos idempotentes (GET/PUT/DELETE); los POST no,
+    porque un cuerpo en streaming no se puede reenviar.
+    """
+    retry = Retry(
+        total=4,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _make_session()
+_limiter = RateLimiter(RATE_LIMIT)
+
+
+def _request(method: str, path: str, timeout: float = 30, **kwargs) -> requests.Response:
+    """Petición al backend por la sesión compartida, respetando el rate limit."""
+    _limiter.wait()
+    r = _session.request(method, _url(path), timeout=timeout, **kwargs)
     r.raise_for_status()
-    return r.json().get("clientes", [])
+    return r
+
+
+def run_concurrently(fn: Callable, items: Iterable, workers: int = None) -> List:
+    """Aplica fn a cada item con un pool de hilos; devuelve los resultados en orden.
+
+    Los errores no detienen el resto: se devuelven como la excepción en su posición.
+    """
+    def call(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers or MAX_WORKERS) as pool:
+        return list(pool.map(call, items))
+
+
+def _get_all(path: str, key: str, params: Dict) -> List[Dict]:
+    """Descarga una tabla completa página por página (keyset, sin OFFSET)."""
+    rows: List[Dict] = []
+    params = dict(params, limit=PAGE_SIZE)
+    while True:
+        data = _request("GET", path, params=params).json()
+        rows.extend(data.get(key, []))
+        if not data.get("next_cursor"):
+            return rows
+        params["cursor"] = data["next_cursor"]
+
+
+def get_clientes(username: str) -> List[Dict]:
+    return _get_all("/api/clientes", "clientes", {"username": username})
 
 
 def get_obras(username: str) -> List[Dict]:
-    r = requests.get(_url("/api/obras"), params={"username": username}, timeout=20)
-    r.raise_for_status()
-    return r.json().get("obras", [])
+    return _get_all("/api/obras", "obras", {"username": username})
 
 
 def get_productos(username: str) -> List[Dict]:
-    r = requests.get(_url("/api/productos"), params={"username": username}, timeout=20)
-    r.raise_for_status()
-    return r.json().get("productos", [])
+    return _get_all("/api/productos", "productos", {"username": username})
 
 
 def get_registros(username: str, fecha_inicio: str = None, fecha_fin: str = None) -> List[Dict]:
@@ -49,307 +131,410 @@ def get_registros(username: str, fecha_inicio: str = None, fecha_fin: str = None
         params["fecha_inicio"] = fecha_inicio
     if fecha_fin:
         params["fecha_fin"] = fecha_fin
-    r = requests.get(_url("/api/registros"), params=params, timeout=30)
-    r.raise_for_status()
-    return r.json().get("registros", [])
+    return _get_all("/api/registros", "registros", params)
 
 
-def delete_cliente(username: str, cliente_id: int) -> None:
-    r = requests.delete(_url(f"/api/clientes/{cliente_id}"), params={"username": username}, timeout=20)
-    r.raise_for_status()
+def get_all(username: str, fecha_inicio: str = None, fecha_fin: str = None) -> Dict[str, List[Dict]]:
+    """Descarga clientes, obras, productos y registros en paralelo."""
+    loaders = {
+        "clientes": lambda: get_clientes(username),
+        "obras": lambda: get_obras(username),
+        "productos": lambda: get_productos(username),
+        "registros": lambda: get_registros(username, fecha_inicio, fecha_fin),
+    }
+    results = run_concurrently(lambda load: load(), loaders.values())
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return dict(zip(loaders, results))
 
 
-def delete_obra(username: str, obra_id: int) -> None:
-    r = requests.delete(_url(f"/api/obras/{obra_id}"), params={"username": username}, timeout=20)
-    r.raise_for_status()
+def get_version(username: str) -> Dict:
+    """Versión de los datos del usuario: {"version", "entidades": {entidad: versión}}."""
+    return _request("GET", "/api/sync/version", params={"username": username}).json()
 
 
-def delete_producto(username: str, producto_id: int) -> None:
-    r = requests.delete(_url(f"/api/productos/{producto_id}"), params={"username": username}, timeout=20)
-    r.raise_for_status()
+def get_changes(username: str, since: int = 0) -> Dict:
+    """Cambios desde la versión `since` (todas las páginas de /api/sync).
 
-
-def delete_registro(username: str, registro_id: int) -> None:
-    r = requests.delete(_url(f"/api/registros/{registro_id}"), params={"username": username}, timeout=20)
-    r.raise_for_status()
+    Devuelve {"version", "completo", "cambios": {entidad: [filas]},
+    "eliminados": {entidad: [ids]}}; con completo=True "cambios" es la copia
+    entera y reemplaza a la anterior.
+    """
+    params = {"username": username, "since": since, "limit": PAGE_SIZE}
+    result = {"cambios": {e: [] for e in BACKUP_ENTITIES}, "eliminados": {e: [] for e in BACKUP_ENTITIES}}
+    while True:
+        data = _request("GET", "/api/sync", params=params).json()
+        result["version"], result["completo"] = data["version"], data["completo"]
+        for e in BACKUP_ENTITIES:
+            result["cambios"][e].extend(data["cambios"].get(e, []))
+            result["eliminados"][e].extend(data["eliminados"].get(e, []))
+        if not data.get("next_cursor"):
+            return result
+        params["cursor"] = data["next_cursor"]
+
+
+def _sort_rows(entidad: str, rows: List[Dict]) -> List[Dict]:
+    """Mismo orden que los listados del backend (más recientes primero)."""
+    rows.sort(key=lambda r: (r.get("created_at") or "", r["id"]), reverse=True)
+    if entidad == "registros":
+        rows.sort(key=lambda r: r.get("fecha") or "", reverse=True)
+    return rows
+
+
+def apply_changes(datos: Dict[str, List[Dict]], changes: Dict) -> Dict[str, List[Dict]]:
+    """Aplica el resultado de get_changes a una copia {entidad: [filas]}."""
+    result = {}
+    for e in BACKUP_ENTITIES:
+        filas = {} if changes["completo"] else {r["id"]: r for r in datos.get(e, [])}
+        for row in changes["cambios"][e]:
+            row.pop("updated_at", None)  # mismas columnas que los listados
+            filas[row["id"]] = row
+        for row_id in changes["eliminados"][e]:
+            filas.pop(row_id, None)
+        result[e] = _sort_rows(e, list(filas.values()))
+    return result
+
+
+def _load_json_backup(path: str) -> Dict:
+    """Respaldo JSON escrito por export-all ({} si no existe o no se puede leer)."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
 
 
-def dedupe_clientes(username: str, apply: bool) -> Dict:
-    clientes = get_clientes(username)
-    groups: Dict[Tuple[str, str, str], List[Dict]] = defaultdict(list)
-    for c in clientes:
-        key = (c.get("nombre", ""), c.get("obra", ""), c.get("cedula", ""))
-        groups[key].append(c)
+def bulk_delete(username: str, entidad: str, apply: bool, **criteria) -> Dict[str, int]:
+    """Elimina en el servidor (/api/bulk-delete) por ids o filtro, en una sola petición.
 
-    to_delete: List[int] = []
-    for key, items in groups.items():
-        if len(items) <= 1:
-            continue
-        # Keep oldest (first created) to minimize breaking expectations
-        items_sorted = sorted(items, key=lambda x: _ts(x.get("created_at", "")))
-        keep = items_sorted[0]
-        for dup in items_sorted[1:]:
-            to_delete.append(dup["id"])
-    if apply:
-        for cid in to_delete:
-            delete_cliente(username, cid)
-    return {"total": len(clientes), "groups": len(groups), "deleted": len(to_delete)}
-
-
-def dedupe_obras(username: str, apply: bool) -> Dict:
-    obras = get_obras(username)
-    groups: Dict[str, List[Dict]] = defaultdict(list)
-    for o in obras:
-        groups[o.get("nombre", "")].append(o)
-
-    to_delete: List[int] = []
-    for nombre, items in groups.items():
-        if len(items) <= 1:
-            continue
-        items_sorted = sorted(items, key=lambda x: _ts(x.get("created_at", "")))
-        keep = items_sorted[0]
-        for dup in items_sorted[1:]:
-            to_delete.append(dup["id"])
-    if apply:
-        for oid in to_delete:
-            delete_obra(username, oid)
-    return {"total": len(obras), "groups": len(groups), "deleted": len(to_delete)}
-
-
-def dedupe_productos(username: str, apply: bool) -> Dict:
-    productos = get_productos(username)
-    groups: Dict[Tuple[str, float], List[Dict]] = defaultdict(list)
-    for p in productos:
-        key = (p.get("nombre", ""), float(p.get("precio", 0)))
-        groups[key].append(p)
-
-    to_delete: List[int] = []
-    for key, items in groups.items():
-        if len(items) <= 1:
-            continue
-        items_sorted = sorted(items, key=lambda x: _ts(x.get("created_at", "")))
-        keep = items_sorted[0]
-        for dup in items_sorted[1:]:
-            to_delete.append(dup["id"])
-    if apply:
-        for pid in to_delete:
-            delete_producto(username, pid)
-    return {"total": len(productos), "groups": len(groups), "deleted": len(to_delete)}
-
-
-def _reg_key(r: Dict) -> Tuple:
-    # Prefer key without detalles to identify aggregates; when duplicates exist,
-    # we will keep whichever has non-empty detalles.
-    return (
-        r.get("fecha", ""),
-        r.get("obra", ""),
-        int(r.get("totalCantidad", 0) or 0),
-        float(r.get("totalCobrar", 0) or 0.0),
-        float(r.get("totalPagado", 0) or 0.0),
-        r.get("status", "pendiente"),
-    )
+    criteria: ids, obra, fecha_inicio, fecha_fin o todos=True. Sin apply solo cuenta.
+    """
+    payload = {"username": username, "entidad": entidad, "simular": not apply}
+    payload.update({k: v for k, v in criteria.items() if v is not None})
+    r = _request("POST", "/api/bulk-delete", json=payload, timeout=120)
+    return r.json().get("eliminados", {})
 
 
 def purge_all(username: str, apply: bool) -> Dict:
     """Elimina todos los clientes, obras, productos, y registros del usuario."""
-    clientes = get_clientes(username)
-    obras = get_obras(username)
-    productos = get_productos(username)
-    registros = get_registros(username)
+    return bulk_delete(username, "todas", apply, todos=True)
 
-    counts = {"clientes": 0, "obras": 0, "productos": 0, "registros": 0}
 
-    if apply:
-        # Delete in reverse order: registros first, then clientes/obras/productos
-        for r in registros:
-            try:
-                delete_registro(username, r["id"])
-                counts["registros"] += 1
-            except Exception as e:
-                print(f"Error deleting registro {r['id']}: {e}")
+def dedupe(username: str, entidad: str, apply: bool, fecha_inicio: str = None, fecha_fin: str = None) -> Dict:
+    """Deduplica en el servidor (/api/dedupe) en una sola petición.
 
-        for c in clientes:
-            try:
-                delete_cliente(username, c["id"])
-                counts["clientes"] += 1
-            except Exception as e:
-                print(f"Error deleting cliente {c['id']}: {e}")
+    entidad: clientes, obras, productos, registros o todas. Sin apply solo informa.
+    """
+    payload = {"username": username, "entidad": entidad, "aplicar": "true" if apply else "false"}
+    if fecha_inicio:
+        payload["fecha_inicio"] = fecha_inicio
+    if fecha_fin:
+        payload["fecha_fin"] = fecha_fin
+    r = _request("POST", "/api/dedupe", data=payload, timeout=120)
+    return {
+        e: {"total": res["total"], "groups": res["grupos"], "duplicates": res["duplicados"], "deleted": res["eliminados"]}
+        for e, res in r.json().get("resultados", {}).items()
+    }
 
-        for o in obras:
-            try:
-                delete_obra(username, o["id"])
-                counts["obras"] += 1
-            except Exception as e:
-                print(f"Error deleting obra {o['id']}: {e}")
 
-        for p in productos:
-            try:
-                delete_producto(username, p["id"])
-                counts["productos"] += 1
-            except Exception as e:
-                print(f"Error deleting producto {p['id']}: {e}")
-    else:
-        counts = {"clientes": len(clientes), "obras": len(obras), "productos": len(productos), "registros": len(registros)}
+def verify_resumen(username: str, apply: bool) -> Dict:
+    """Compara el resumen de reportes con los registros; con apply lo reconstruye."""
+    payload = {"admin_secret": ADMIN_SECRET, "username": username, "reparar": "true" if apply else "false"}
+    r = _request("POST", "/api/admin/resumen/verify", data=payload, timeout=120)
+    data = r.json()
+    for d in data.get("diferencias", []):
+        print(f"  {d['fecha'] or 'Sin fecha'} / {d['obra'] or 'Sin obra'}: esperado={d['esperado']} actual={d['actual']}")
+    return {"ok": data.get("ok"), "diferencias": len(data.get("diferencias", [])), "reparado": data.get("reparado")}
 
-    return counts
 
+BACKUP_ENTITIES = ("clientes", "obras", "productos", "registros")
+_WS = " \t\r\n"
 
-def dedupe_registros(username: str, apply: bool, fecha_inicio: str = None, fecha_fin: str = None) -> Dict:
-    registros = get_registros(username, fecha_inicio, fecha_fin)
-    groups: Dict[Tuple, List[Dict]] = defaultdict(list)
-    for r in registros:
-        groups[_reg_key(r)].append(r)
 
-    to_delete: List[int] = []
-    for key, items in groups.items():
-        if len(items) <= 1:
+def _iter_json_backup(f, chunk_size: int = 1 << 16) -> Iterator[Tuple[str, Dict]]:
+    """Recorre un backup JSON {"clientes": [...], ...} fila por fila, sin cargarlo completo.
+
+    Solo mantiene en memoria el bloque leído y la fila en curso.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WS:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return ""
+
+    def expect(char: str) -> None:
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Backup JSON inválido: se esperaba {char!r} en la posición {pos}")
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # Un valor al final del bloque puede estar cortado (p.ej. un número)
+                if end < len(buf) or eof:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key in BACKUP_ENTITIES and peek() == "[":
+            pos += 1
+            if peek() != "]":
+                while True:
+                    yield key, value()
+                    if peek() == ",":
+                        pos += 1
+                        continue
+                    break
+            expect("]")
+        else:
+            value()  # meta u otras claves: se descartan
+        if peek() == ",":
+            pos += 1
             continue
-        # Prefer record with non-empty detalles; otherwise keep oldest
-        with_detalles = [i for i in items if (i.get("detalles") or [])]
-        if with_detalles:
-            keep = sorted(with_detalles, key=lambda x: _ts(x.get("created_at", "")))[0]
+        expect("}")
+        return
+
+
+def _iter_backup(path: str) -> Iterator[Tuple[str, Dict]]:
+    """Filas (entidad, datos) de un backup .json o .ndjson/.jsonl."""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    yield rec["entidad"], rec["datos"]
         else:
-            keep = sorted(items, key=lambda x: _ts(x.get("created_at", "")))[0]
-        for dup in items:
-            if dup["id"] != keep["id"]:
-                to_delete.append(dup["id"])
-    if apply:
-        for rid in to_delete:
-            delete_registro(username, rid)
-    return {"total": len(registros), "groups": len(groups), "deleted": len(to_delete)}
-
-
-def import_registros_from_backup(username: str, path: str, apply: bool) -> Dict:
-    """Importa clientes, obras, productos y registros desde un backup JSON.
-    Espera un objeto con claves 'clientes', 'obras', 'productos', 'registros'.
+            yield from _iter_json_backup(f)
+
+
+def _checkpoint_path(path: str) -> str:
+    return path + ".checkpoint.json"
+
+
+def import_registros_from_backup(username: str, path: str, apply: bool, resume: bool = False) -> Dict:
+    """Importa clientes, obras, productos y registros desde un backup JSON o NDJSON.
+    El archivo se lee de forma incremental y se envía como NDJSON en streaming
+    a /api/import-backup/stream, que inserta y confirma por lotes.
+
+    Las filas ya existentes se omiten en el servidor (hash de contenido), así que
+    reintentar es seguro. Si la importación falla, el avance confirmado se guarda
+    en <backup>.checkpoint.json y con resume se continúa desde ahí.
     """
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    
-    clientes = data.get("clientes", [])
-    obras = data.get("obras", [])
-    productos = data.get("productos", [])
-    registros = data.get("registros", [])
-    
-    counts = {"clientes": 0, "obras": 0, "productos": 0, "registros": 0}
-    
-    if apply:
-        # Import clientes
-        for c in clientes:
-            try:
-                payload = {
-                    "username": username,
-                    "nombre": c.get("nombre", ""),
-                    "cedula": c.get("cedula"),
-                    "obra": c.get("obra"),
-                    "estado": c.get("estado", "activo"),
-                    "fecha": c.get("fecha"),
-                }
-                r = requests.post(_url("/api/clientes"), data=payload, timeout=30)
-                r.raise_for_status()
-                if r.json().get("success"):
-                    counts["clientes"] += 1
-            except Exception as e:
-                print(f"Error importing cliente {c.get('nombre')}: {e}")
-        
-        # Import obras
-        for o in obras:
-            try:
-                payload = {
-                    "username": username,
-                    "nombre": o.get("nombre", ""),
-                    "ubicacion": o.get("ubicacion"),
-                    "estado": o.get("estado", "activa"),
-                }
-                r = requests.post(_url("/api/obras"), data=payload, timeout=30)
-                r.raise_for_status()
-                if r.json().get("success"):
-                    counts["obras"] += 1
-            except Exception as e:
-                print(f"Error importing obra {o.get('nombre')}: {e}")
-        
-        # Import productos
-        for p in productos:
-            try:
-                payload = {
-                    "username": username,
-                    "nombre": p.get("nombre", ""),
-                    "precio": float(p.get("precio", 0)),
-                }
-                r = requests.post(_url("/api/productos"), data=payload, timeout=30)
-                r.raise_for_status()
-                if r.json().get("success"):
-                    counts["productos"] += 1
-            except Exception as e:
-                print(f"Error importing producto {p.get('nombre')}: {e}")
-        
-        # Import registros
-        for rec in registros:
-            try:
-                payload = {
-                    "username": username,
-                    "fecha": rec.get("fecha") or rec.get("dia") or rec.get("fechaRegistro"),
-                    "obra": rec.get("obra"),
-                    "totalCantidad": rec.get("totalCantidad", 0),
-                    "totalCobrar": rec.get("totalCobrar", 0),
-                    "totalPagado": rec.get("totalPagado", 0),
-                    "status": rec.get("status", "pendiente"),
-                    # Map 'items' to 'detalles'
-                    "detalles": rec.get("items") or rec.get("detalles") or [],
-                }
-                # Derivar clientesAdicionales si existen en items
-                adicionales = []
-                for it in payload["detalles"]:
-                    if str(it.get("tipo", "")).lower() == "adicional":
-                        adicionales.append({"cliente": it.get("cliente"), "valor": it.get("costo", it.get("precio", 0))})
-                if adicionales:
-                    payload["clientesAdicionales"] = adicionales
-                r = requests.post(_url("/api/registros"), json=payload, timeout=30)
-                r.raise_for_status()
-                if r.json().get("success"):
-                    counts["registros"] += 1
-            except Exception as e:
-                print(f"Error importing registro {rec.get('fecha')}: {e}")
-    
-    return {"imported": counts, "total_in_file": {"clientes": len(clientes), "obras": len(obras), "productos": len(productos), "registros": len(registros)}}
+    total_in_file = {e: 0 for e in BACKUP_ENTITIES}
+    checkpoint: Dict[str, int] = {}
+    cp_path = _checkpoint_path(path)
+    if resume and os.path.exists(cp_path):
+        with open(cp_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        print("Resuming from checkpoint:", checkpoint)
+
+    def lines() -> Iterator[bytes]:
+        for entidad, datos in _iter_backup(path):
+            total_in_file[entidad] += 1
+            if total_in_file[entidad] <= checkpoint.get(entidad, 0):
+                continue
+            yield (json.dumps({"entidad": entidad, "datos": datos}, ensure_ascii=False) + "\n").encode("utf-8")
+
+    if not apply:
+        for _ in lines():
+            pass
+        return {"imported": {e: 0 for e in BACKUP_ENTITIES}, "total_in_file": total_in_file}
 
+    params = {"username": username}
+    if checkpoint:
+        params["checkpoint"] = json.dumps(checkpoint)
+    # Sin _request: si falla hay que leer el checkpoint antes de lanzar el error
+    _limiter.wait()
+    r = _session.post(
+        _url("/api/import-backup/stream"),
+        params=params,
+        data=lines(),
+        headers={"Content-Type": "application/x-ndjson"},
+        timeout=600,
+    )
+    if not r.ok:
+        print(f"Import failed ({r.status_code}): {r.text[:500]}")
+        try:
+            progress = r.json().get("detail", {}).get("checkpoint")
+        except (ValueError, AttributeError):
+            progress = None
+        if progress:
+            with open(cp_path, "w", encoding="utf-8") as f:
+                json.dump(progress, f)
+            print(f"Checkpoint saved to {cp_path}; re-run with --resume to continue")
+    r.raise_for_status()
+    if os.path.exists(cp_path):
+        os.remove(cp_path)
+    data = r.json()
+    for rej in data.get("rechazados", []):
+        print(f"  Rechazado {rej.get('entidad')} #{rej.get('indice')}: {rej.get('motivo')}")
+    return {
+        "imported": data.get("imported"),
+        "omitidos": data.get("omitidos"),
+        "rechazados": data.get("rechazados_total", 0),
+        "lotes": data.get("lotes"),
+        "total_in_file": total_in_file,
+    }
+
+
+EXPORT_FORMATS = ("json", "ndjson", "csv", "parquet")
+
+
+def _export_stream(username: str, entidad: str, formato: str,
+                   fecha_inicio: str = None, fecha_fin: str = None) -> requests.Response:
+    """Abre la descarga en streaming de /api/export/{entidad}."""
+    params = {"username": username, "formato": formato}
+    if entidad == "registros":
+        if fecha_inicio:
+            params["fecha_inicio"] = fecha_inicio
+        if fecha_fin:
+            params["fecha_fin"] = fecha_fin
+    return _request("GET", f"/api/export/{entidad}", params=params, stream=True, timeout=600)
+
+
+def export_all(username: str, out_path: str, formato: str,
+               fecha_inicio: str = None, fecha_fin: str = None) -> List[str]:
+    """Exporta las cuatro entidades sin cargarlas en memoria; devuelve los archivos escritos.
+
+    ndjson escribe un solo archivo con líneas {"entidad", "datos"}, el mismo
+    formato que acepta import-backup. csv y parquet escriben un archivo por
+    entidad (<out>_<entidad>.<formato>).
+    """
+    if formato == "ndjson":
+        with open(out_path, "wb") as f:
+            for entidad in BACKUP_ENTITIES:
+                prefix = ('{"entidad":"%s","datos":' % entidad).encode("utf-8")
+                with _export_stream(username, entidad, "ndjson", fecha_inicio, fecha_fin) as r:
+                    for line in r.iter_lines():
+                        if line:
+                            f.write(prefix + line + b"}\n")
+        return [out_path]
+
+    base = os.path.splitext(out_path)[0]
+    paths = []
+    for entidad in BACKUP_ENTITIES:
+        path = f"{base}_{entidad}.{formato}"
+        with _export_stream(username, entidad, formato, fecha_inicio, fecha_fin) as r, open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def _export_stamp_path(out_path: str) -> str:
+    return out_path + ".version"
+
+
+def _read_export_stamp(out_path: str) -> Dict:
+    """Versión y filtros con los que se escribió una exportación anterior ({} si no hay)."""
+    try:
+        with open(_export_stamp_path(out_path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
 def main():
     parser = argparse.ArgumentParser(description="Maintenance tools: dedupe and import")
     parser.add_argument("--username", required=True, help="Target username (e.g., Panchita's Catering)")
     parser.add_argument("--action", required=True, choices=[
-        "dry-run", "export-all", "purge-all", "dedupe-all", "dedupe-clientes", "dedupe-obras", "dedupe-productos", "dedupe-registros", "import-backup"
+        "dry-run", "export-all", "purge-all", "dedupe-all", "dedupe-clientes", "dedupe-obras", "dedupe-productos", "dedupe-registros", "import-backup", "verify-resumen"
     ])
-    parser.add_argument("--backup", help="Path to backup JSON for import-backup/export-all")
+    parser.add_argument("--backup", help="Path to backup JSON (or .ndjson) for import-backup/export-all")
     parser.add_argument("--fecha_inicio", help="Start date for registros dedupe YYYY-MM-DD")
     parser.add_argument("--fecha_fin", help="End date for registros dedupe YYYY-MM-DD")
     parser.add_argument("--apply", action="store_true", help="Apply changes; otherwise just report")
+    parser.add_argument("--resume", action="store_true", help="Resume import-backup from its saved checkpoint")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="json",
+                        help="export-all format: json (single file), ndjson (streamed, importable), csv or parquet (one file per entity)")
+    parser.add_argument("--if-changed", action="store_true",
+                        help="export-all: skip the download if the data version is the same as the previous export to --backup")
+    parser.add_argument("--incremental", action="store_true",
+                        help="export-all (json, no date filters): download only the changes since the previous export to --backup")
     args = parser.parse_args()
 
     username = args.username
 
     if args.action == "dry-run":
         print("Backend:", BASE_URL)
-        print("Clientes:", len(get_clientes(username)))
-        print("Obras:", len(get_obras(username)))
-        print("Productos:", len(get_productos(username)))
-        regs = get_registros(username, args.fecha_inicio, args.fecha_fin)
-        print("Registros:", len(regs))
+        print("Data version:", get_version(username).get("version"))
+        data = get_all(username, args.fecha_inicio, args.fecha_fin)
+        for key, rows in data.items():
+            print(f"{key.capitalize()}:", len(rows))
         return
 
     if args.action == "export-all":
-        out_path = args.backup or f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        pkg = {
-            "clientes": get_clientes(username),
-            "obras": get_obras(username),
-            "productos": get_productos(username),
-            "registros": get_registros(username, args.fecha_inicio, args.fecha_fin),
-            "meta": {"backend": BASE_URL, "username": username, "fecha_inicio": args.fecha_inicio, "fecha_fin": args.fecha_fin}
-        }
-        with open(out_path, "w", encoding="utf-8") as f:
-            json.dump(pkg, f, ensure_ascii=False, indent=2)
-        print("Exported:", out_path)
+        out_path = args.backup or f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{args.format}"
+        # La versión se lee antes de descargar: si algo cambia durante la
+        # exportación, la próxima corrida verá una versión mayor y exportará.
+        stamp = {"version": get_version(username).get("version"), "format": args.format,
+                 "fecha_inicio": args.fecha_inicio, "fecha_fin": args.fecha_fin}
+        if args.if_changed and _read_export_stamp(out_path) == stamp:
+            print("Unchanged since last export:", out_path)
+            return
+        if args.format != "json":
+            for path in export_all(username, out_path, args.format, args.fecha_inicio, args.fecha_fin):
+                print("Exported:", path)
+        elif args.incremental and not (args.fecha_inicio or args.fecha_fin):
+            previo = _load_json_backup(out_path)
+            meta = previo.get("meta") or {}
+            # Solo sirve de base un respaldo completo del mismo usuario
+            usable = meta.get("username") == username and not (meta.get("fecha_inicio") or meta.get("fecha_fin"))
+            since = (meta.get("version") or 0) if usable else 0
+            changes = get_changes(username, since)
+            stamp["version"] = changes["version"]
+            pkg = apply_changes(previo, changes)
+            pkg["meta"] = {"backend": BASE_URL, "username": username, "fecha_inicio": None,
+                           "fecha_fin": None, "version": changes["version"]}
+            with open(out_path, "w", encoding="utf-8") as f:
+                json.dump(pkg, f, ensure_ascii=False)
+            modo = "full" if changes["completo"] else f"changes since version {since}"
+            print(f"Exported ({modo}):", out_path)
+        else:
+            pkg = get_all(username, args.fecha_inicio, args.fecha_fin)
+            pkg["meta"] = {"backend": BASE_URL, "username": username, "fecha_inicio": args.fecha_inicio,
+                           "fecha_fin": args.fecha_fin, "version": stamp["version"]}
+            with open(out_path, "w", encoding="utf-8") as f:
+                json.dump(pkg, f, ensure_ascii=False)
+            print("Exported:", out_path)
+        with open(_export_stamp_path(out_path), "w", encoding="utf-8") as f:
+            json.dump(stamp, f)
         return
 
     if args.action == "purge-all":
@@ -357,33 +542,27 @@ def main():
         print("Purged:", res)
         return
 
-        res = dedupe_clientes(username, apply=args.apply)
-        print("Clientes:", res)
-        if args.action == "dedupe-clientes":
-            return
-
-    if args.action in ("dedupe-obras", "dedupe-all"):
-        res = dedupe_obras(username, apply=args.apply)
-        print("Obras:", res)
-        if args.action == "dedupe-obras":
-            return
-
-    if args.action in ("dedupe-productos", "dedupe-all"):
-        res = dedupe_productos(username, apply=args.apply)
-        print("Productos:", res)
-        if args.action == "dedupe-productos":
-            return
+    if args.action.startswith("dedupe-"):
+        entidad = args.action[len("dedupe-"):]
+        res = dedupe(username, "todas" if entidad == "all" else entidad, apply=args.apply,
+                     fecha_inicio=args.fecha_inicio, fecha_fin=args.fecha_fin)
+        for e, counts in res.items():
+            print(f"{e.capitalize()}:", counts)
+        return
 
-    if args.action in ("dedupe-registros", "dedupe-all"):
-        res = dedupe_registros(username, apply=args.apply, fecha_inicio=args.fecha_inicio, fecha_fin=args.fecha_fin)
-        print("Registros:", res)
+    if args.action == "verify-resumen":
+        if not ADMIN_SECRET:
+            print("ADMIN_SECRET env var is required")
+            sys.exit(2)
+        res = verify_resumen(username, apply=args.apply)
+        print("Resumen:", res)
         return
 
     if args.action == "import-backup":
         if not args.backup:
             print("--backup path is required")
             sys.exit(2)
-        res = import_registros_from_backup(username, args.backup, apply=args.apply)
+        res = import_registros_from_backup(username, args.backup, apply=args.apply, resume=args.resume)
         print("Import:", res)
         return
 
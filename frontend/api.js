@@ -316,6 +316,99 @@ const API = {
         });
     },
 
+    // ============== SINCRONIZACIÓN ==============
+    // { version, entidades: { clientes, obras, productos, registros } }
+    // Si la versión de una entidad no cambió, tampoco cambió su listado.
+    async getSyncVersion() {
+        const username = this.getUsername();
+        if (!username) throw new Error('Usuario no autenticado');
+        
+        return await this.request(`/api/sync/version?username=${encodeURIComponent(username)}`);
+    },
+
+    // Copia local de los datos (sessionStorage, como la sesión, o memoria si
+    // no está disponible) que se actualiza solo con lo que cambió desde la
+    // última sincronización. Se borra al cerrar la pestaña o la sesión.
+    _syncCache: {},
+
+    _loadSyncCopy(username) {
+        try {
+            const raw = sessionStorage.getItem(`fintrack_sync_${username}`);
+            if (raw) return JSON.parse(raw);
+        } catch (e) {
+            // Sin sessionStorage o copia corrupta: se usa la de memoria
+        }
+        return this._syncCache[username] || null;
+    },
+
+    _saveSyncCopy(username, copia) {
+        this._syncCache[username] = copia;
+        try {
+            sessionStorage.setItem(`fintrack_sync_${username}`, JSON.stringify(copia));
+        } catch (e) {
+            // Cuota llena o modo privado: queda solo en memoria
+        }
+    },
+
+    // Borra las copias locales de todos los usuarios (al cerrar sesión)
+    clearSyncData() {
+        this._syncCache = {};
+        [sessionStorage, localStorage].forEach(storage => {
+            try {
+                Object.keys(storage)
+                    .filter(key => key.startsWith('fintrack_sync_'))
+                    .forEach(key => storage.removeItem(key));
+            } catch (e) {
+                // Almacenamiento no disponible: no hay nada que borrar
+            }
+        });
+    },
+
+    // Devuelve { clientes, obras, productos, registros } en el mismo orden
+    // que los listados, descargando solo los cambios desde la copia local.
+    async syncData() {
+        const username = this.getUsername();
+        if (!username) throw new Error('Usuario no autenticado');
+
+        const entidades = ['clientes', 'obras', 'productos', 'registros'];
+        const anterior = this._loadSyncCopy(username);
+        const since = anterior ? anterior.version : 0;
+        let copia = null;
+        let cursor = null;
+        let data;
+        do {
+            let url = `/api/sync?username=${encodeURIComponent(username)}&since=${since}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+            data = await this.request(url);
+            if (!copia) {
+                copia = { version: data.version, datos: {} };
+                entidades.forEach(e => {
+                    const filas = (!data.completo && anterior) ? anterior.datos[e] || [] : [];
+                    copia.datos[e] = new Map(filas.map(fila => [fila.id, fila]));
+                });
+            }
+            entidades.forEach(e => {
+                (data.cambios[e] || []).forEach(fila => copia.datos[e].set(fila.id, fila));
+                (data.eliminados[e] || []).forEach(id => copia.datos[e].delete(id));
+            });
+            cursor = data.next_cursor;
+        } while (cursor);
+
+        const porCreacion = (a, b) => String(b.created_at || '').localeCompare(String(a.created_at || '')) || b.id - a.id;
+        const orden = {
+            clientes: porCreacion,
+            obras: porCreacion,
+            productos: porCreacion,
+            registros: (a, b) => String(b.fecha || '').localeCompare(String(a.fecha || '')) || porCreacion(a, b),
+        };
+        const resultado = {};
+        entidades.forEach(e => {
+            resultado[e] = Array.from(copia.datos[e].values()).sort(orden[e]);
+        });
+        this._saveSyncCopy(username, { version: copia.version, datos: resultado });
+        return resultado;
+    },
+
     // ============== REPORTES ==============
     async getReportes(filters = {}) {
         const username = this.getUsername();
@@ -332,6 +425,9 @@ const API = {
         if (filters.fecha_fin) {
             url += `&fecha_fin=${filters.fecha_fin}`;
         }
+        if (filters.incluir_registros) {
+            url += `&incluir_registros=true`;
+        }
         
         return await this.request(url);
     }